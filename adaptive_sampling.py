@@ -0,0 +1,117 @@
+'''Adaptive, surrogate-guided sampling of the RES capacity space.
+
+Sizing starts from a small LHS design. After every batch, RBF surrogates of the surrogate targets (required storage
+capacity and EAC/MWh by default) are fitted over the unit capacity space and their accuracy is estimated by k-fold
+cross-validation. New samples are picked greedily from a large candidate design. A candidate scores higher when
+it is far from all evaluated samples, when the nearest sized sample has a large cross-validation error (the
+surrogate is uncertain there), and when its predicted EAC/MWh is among the lowest (near the cost optimum).
+Sampling stops when the sample budget is spent or when the relative cross-validation error of every target
+is below the tolerance.'''
+import numpy as np
+import pandas as pd
+from scipy.interpolate import RBFInterpolator
+from scipy.spatial import cKDTree
+from instrumentation import instrumentation
+
+
+class AdaptiveSampler:
+
+    def __init__(self, lhs, initial_samples=10, batch_size=5, max_samples=50, tolerance=0.05,
+                 surrogate_targets=('battery_capacity (MWh)', 'EAC/MWh (€/MWh)'), optimum_target='EAC/MWh (€/MWh)',
+                 optimum_fraction=0.2, candidates_per_sample=50, cross_validation_folds=5):
+        self.lhs = lhs
+        self.initial_samples = int(initial_samples)
+        self.batch_size = max(int(batch_size), 1)
+        self.max_samples = int(max_samples)
+        self.tolerance = float(tolerance)
+        self.surrogate_targets = list(surrogate_targets)
+        self.optimum_target = optimum_target
+        self.optimum_fraction = optimum_fraction
+        self.candidates_per_sample = candidates_per_sample
+        self.cross_validation_folds = cross_validation_folds
+        self.surrogates = {}
+        self.history = []
+        return
+
+    def get_training_data(self, unit_design, output_df):
+        '''Unit coordinates and targets of the samples that were sized (infeasible samples have no output row)'''
+        targets = output_df.reindex(columns=self.surrogate_targets).apply(pd.to_numeric, errors='coerce')
+        sized = targets.index[np.isfinite(targets.to_numpy(dtype=float)).all(axis=1)]
+        return unit_design[np.asarray(sized, dtype=int)], targets.loc[sized].to_numpy(dtype=float)
+
+    def fit_surrogate(self, points, values):
+        return RBFInterpolator(points, values, kernel='thin_plate_spline', degree=1)
+
+    def cross_validate(self, points, values, rng):
+        '''Held-out error of every sized sample and relative RMSE (RMSE over the range of each target)'''
+        errors = np.zeros(values.shape)
+        folds = np.array_split(rng.permutation(points.shape[0]), min(self.cross_validation_folds, points.shape[0]))
+        for fold in folds:
+            training = np.setdiff1d(np.arange(points.shape[0]), fold)
+            errors[fold] = self.fit_surrogate(points[training], values[training])(points[fold]) - values[fold]
+        value_range = np.ptp(values, axis=0)
+        value_range[value_range == 0] = 1
+        relative_rmse = np.sqrt((errors**2).mean(axis=0))/value_range
+        return np.abs(errors)/value_range, relative_rmse
+
+    def select_batch(self, unit_design, points, local_errors, rng, batch_size):
+        '''Greedy batch selection from a candidate LHS design'''
+        dimensions = unit_design.shape[1]
+        candidates = self.lhs.get_unit_design(self.candidates_per_sample*batch_size, dimensions, rng)
+        distance = cKDTree(unit_design).query(candidates)[0]
+        uncertainty = np.full(candidates.shape[0], 0.5)
+        near_optimum = np.zeros(candidates.shape[0])
+        if local_errors is not None:
+            nearest_sized = cKDTree(points).query(candidates)[1]
+            uncertainty += local_errors[nearest_sized].mean(axis=1)/max(local_errors.mean(axis=1).max(), 1e-12)
+            if self.optimum_target in self.surrogates:
+                predicted_optimum_target = self.surrogates[self.optimum_target](candidates)
+                near_optimum = (predicted_optimum_target <= np.quantile(predicted_optimum_target, self.optimum_fraction)).astype(float)
+        batch = []
+        for sample in range(batch_size):
+            score = distance*(uncertainty + near_optimum)
+            best_candidate = int(np.argmax(score))
+            batch.append(candidates[best_candidate])
+            distance = np.minimum(distance, np.linalg.norm(candidates - candidates[best_candidate], axis=1)) # keep the batch spread out
+        return np.array(batch)
+
+    def run(self, sampling_ranges, evaluate, seed=None):
+        '''evaluate(sampled_res_capacities) sizes a batch of res combinations and returns its output_df (indexed like the batch).
+        Returns all sampled res capacities and the concatenated outputs'''
+        rng = np.random.default_rng(seed)
+        names = [sampling_range[0] for sampling_range in sampling_ranges]
+        dimensions = len(sampling_ranges)
+        unit_design = np.empty((0, dimensions))
+        batch = self.lhs.get_unit_design(min(self.initial_samples, self.max_samples), dimensions, rng)
+        output_df = None
+        while True:
+            batch_index = pd.RangeIndex(unit_design.shape[0], unit_design.shape[0] + batch.shape[0])
+            batch_output_df = evaluate(pd.DataFrame(self.lhs.rescale(batch, sampling_ranges), columns=names, index=batch_index))
+            output_df = batch_output_df if output_df is None else pd.concat([output_df, batch_output_df])
+            unit_design = np.vstack([unit_design, batch])
+
+            points, values = self.get_training_data(unit_design, output_df)
+            local_errors = None
+            if points.shape[0] >= max(dimensions + 2, self.cross_validation_folds):
+                local_errors, relative_rmse = self.cross_validate(points, values, rng)
+                self.surrogates = {target: self.fit_surrogate(points, values[:, i]) for i, target in enumerate(self.surrogate_targets)}
+                self.history.append({'samples': unit_design.shape[0], 'sized samples': points.shape[0], **{target + ' relative CV error': error for target, error in zip(self.surrogate_targets, relative_rmse)}})
+                instrumentation.log('     Adaptive sampling: ' + str(unit_design.shape[0]) + ' samples, relative cross-validation error ' + ', '.join(target + ' ' + str(round(error, 4)) for target, error in zip(self.surrogate_targets, relative_rmse)))
+                if (relative_rmse <= self.tolerance).all():
+                    instrumentation.log('     Adaptive sampling reached the surrogate tolerance')
+                    break
+            else:
+                instrumentation.log('     Adaptive sampling: ' + str(unit_design.shape[0]) + ' samples, ' + str(points.shape[0]) + ' sized, too few to fit the surrogates')
+            if unit_design.shape[0] >= self.max_samples:
+                instrumentation.log('     Adaptive sampling spent its budget of ' + str(self.max_samples) + ' samples')
+                break
+            batch = self.select_batch(unit_design, points, local_errors, rng, min(self.batch_size, self.max_samples - unit_design.shape[0]))
+        sampled_res_capacities = pd.DataFrame(self.lhs.rescale(unit_design, sampling_ranges), columns=names)
+        return sampled_res_capacities, output_df
+
+    def predict(self, sampling_ranges, sampled_res_capacities):
+        '''Surrogate predictions of every target at the given res capacities'''
+        lower_bounds = np.array([min(sampling_range[1:]) for sampling_range in sampling_ranges], dtype=float)
+        upper_bounds = np.array([max(sampling_range[1:]) for sampling_range in sampling_ranges], dtype=float)
+        points = (sampled_res_capacities[[sampling_range[0] for sampling_range in sampling_ranges]].to_numpy(dtype=float) - lower_bounds)/np.where(upper_bounds > lower_bounds, upper_bounds - lower_bounds, 1)
+        return pd.DataFrame({target: surrogate(points) for target, surrogate in self.surrogates.items()}, index=sampled_res_capacities.index)
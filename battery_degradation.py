@@ -0,0 +1,122 @@
+'''Streaming rainflow counting of battery state-of-charge series and depth-of-discharge dependent capacity fade.
+
+Reversals of the state of charge are detected while the series is read and pushed on a small stack where the
+three-point rule of ASTM E1049 closes cycles as soon as they are complete, so a year costs one linear pass and
+only the open reversals (the residue) are kept between calls. The residue is counted as half cycles when the
+year is finalized.
+Every cycle of depth d (range over the nominal capacity of the year) fades the capacity by
+    degradation_rate_per_cycle (%) * (d / reference depth)^dod_exponent
+With dod_exponent 1 and a reference depth of 100% this is the throughput/(2 x capacity) rule of the
+original model, larger exponents make deep cycles age the battery faster than shallow ones.'''
+import numpy as np
+from dispatch_kernel import njit
+
+
+@njit(cache=True)
+def close_cycles(stack, size, capacity, rate, reference_depth, dod_exponent, totals):
+    '''Three-point rule on the reversal stack. Closed cycles are added to totals (fade (%), equivalent cycles, cycles)'''
+    while size >= 3:
+        x = abs(stack[size-1] - stack[size-2])
+        y = abs(stack[size-2] - stack[size-3])
+        if x < y:
+            break
+        depth = y/capacity
+        if size == 3:
+            # the range contains the first reversal: half cycle, the first reversal is discarded
+            weight = 0.5
+            stack[0] = stack[1]
+            stack[1] = stack[2]
+            size = 2
+        else:
+            weight = 1.0
+            stack[size-3] = stack[size-1]
+            size -= 2
+        totals[0] += weight*rate*(depth/reference_depth)**dod_exponent
+        totals[1] += weight*depth
+        totals[2] += weight
+    return size
+
+
+@njit(cache=True)
+def rainflow_pass(series, stack, size, last, direction, capacity, rate, reference_depth, dod_exponent, totals):
+    '''Reads one block of a series. Returns the new stack size, the last value and the direction of the running half cycle'''
+    for value in series:
+        if size == 0:
+            stack[0] = value
+            size = 1
+            last = value
+            continue
+        if value == last:
+            continue
+        new_direction = 1 if value > last else -1
+        if direction != 0 and new_direction != direction:
+            stack[size] = last # the previous value was a reversal
+            size = close_cycles(stack, size + 1, capacity, rate, reference_depth, dod_exponent, totals)
+        last = value
+        direction = new_direction
+    return size, last, direction
+
+
+@njit(cache=True)
+def count_residue(stack, size, capacity, rate, reference_depth, dod_exponent, totals):
+    '''Ranges left on the stack at the end of the year are half cycles'''
+    for i in range(size - 1):
+        depth = abs(stack[i+1] - stack[i])/capacity
+        totals[0] += 0.5*rate*(depth/reference_depth)**dod_exponent
+        totals[1] += 0.5*depth
+        totals[2] += 0.5
+
+
+class RainflowDegradation:
+    '''Capacity fade of a batch of batteries (one per res combination) over a year.
+    update() takes (combinations x steps) blocks of state of charge (MWh) in chronological order'''
+
+    def __init__(self, nominal_capacities, degradation_rate_per_cycle, dod_exponent=1.0, reference_dod=100.0):
+        self.nominal_capacities = np.atleast_1d(np.asarray(nominal_capacities, dtype=float))
+        self.degradation_rate_per_cycle = float(degradation_rate_per_cycle)
+        self.dod_exponent = float(dod_exponent)
+        self.reference_depth = float(reference_dod)/100
+        combinations = self.nominal_capacities.shape[0]
+        self.totals = np.zeros((combinations, 3)) # capacity fade (%), equivalent full cycles, counted cycles
+        self.stacks = [np.empty(0) for combination in range(combinations)]
+        self.last = np.zeros(combinations)
+        self.direction = np.zeros(combinations, dtype=np.int64)
+        self.finalized = False
+        return
+
+    def update(self, soc):
+        soc = np.atleast_2d(np.asarray(soc, dtype=float))
+        for combination in range(soc.shape[0]):
+            if self.nominal_capacities[combination] <= 0:
+                continue
+            residue = self.stacks[combination]
+            stack = np.empty(residue.shape[0] + soc.shape[1] + 1) # a block cannot add more reversals than it has steps
+            stack[:residue.shape[0]] = residue
+            size, self.last[combination], self.direction[combination] = rainflow_pass(soc[combination], stack, residue.shape[0], self.last[combination], self.direction[combination],
+                                                                                      self.nominal_capacities[combination], self.degradation_rate_per_cycle, self.reference_depth, self.dod_exponent, self.totals[combination])
+            self.stacks[combination] = stack[:size].copy()
+        return
+
+    def finalize(self):
+        '''Closes the year: the last value is the final reversal and the residue is counted as half cycles'''
+        if self.finalized:
+            return
+        for combination, residue in enumerate(self.stacks):
+            if residue.shape[0] == 0:
+                continue
+            stack = np.append(residue, self.last[combination]) if self.last[combination] != residue[-1] else residue.copy()
+            size = close_cycles(stack, stack.shape[0], self.nominal_capacities[combination], self.degradation_rate_per_cycle, self.reference_depth, self.dod_exponent, self.totals[combination])
+            count_residue(stack, size, self.nominal_capacities[combination], self.degradation_rate_per_cycle, self.reference_depth, self.dod_exponent, self.totals[combination])
+            self.stacks[combination] = np.empty(0)
+        self.finalized = True
+        return
+
+    def get_capacity_fade(self):
+        return self.totals[:, 0].copy()
+
+    def get_equivalent_cycles(self):
+        return self.totals[:, 1].copy()
+
+    def get_capacities(self):
+        '''Usable capacity after the fade of the cycles counted so far'''
+        return self.nominal_capacities*(100 - self.totals[:, 0])/100
@@ -0,0 +1,415 @@
+'''Benchmarks of the hot paths of STREEM on synthetic data.
+
+A synthetic data/ tree (ENTSO-E style demand and RES timeseries, historical capacities and projections) is written to
+a temporary working directory and the model classes run on it unchanged. Storage, technoeconomic and simulation
+settings are copied from data/ of the repository. Every benchmark is timed repeat times (after one warm-up run that
+also compiles the numba kernels) and the results are written as JSON:
+
+    python benchmark.py --output benchmark_results.json
+    python benchmark.py --historical-years 3 --resolution 15 --samples 20 --compare benchmark_results.json
+
+With --compare the best time of every benchmark is checked against the baseline file and the run fails (exit code 1)
+when any benchmark is slower than the baseline by more than --tolerance. Dispatch and sizing benchmarks also report
+simulated hours per second. Before any timing, the run fails (exit code 1) when one of the numerical checks fails:
+ - engines: one res combination dispatched with the dataframe, array and batched engines gives the same results
+ - rainflow: the rainflow counting of battery_degradation.py finds the cycles of the ASTM E1049 example, in one block
+   and streamed step by step
+ - representative days: with one representative day per day of the year, the dispatch of time_series_aggregation.py
+   gives the results of the full-year batched dispatch
+ - linear program: the capacities of the linear program are at or below those of the iterative sizing'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+REPOSITORY_PATH = os.path.dirname(os.path.abspath(__file__))
+COPIED_SETTINGS_FILES = ['simulation_customization.xlsx', 'battery_characteristics.xlsx', 'phs_characteristics.xlsx', 'technoeconomic_assumptions.xlsx']
+DEMAND_COLUMN = 'Actual Total Load [MW] - Greece (GR)'
+GENERATION_LABELS = {'solar': 'solar generation (MWh)', 'wind': 'wind generation (MWh)', 'hydro': 'hydro generation (MWh) (excluding PHS)'}
+# rainflow counting example of ASTM E1049-85 (5.4.4): load series and counted cycles by range
+ASTM_E1049_SERIES = [-2, 1, -3, 5, -1, 3, -4, 4, -2]
+ASTM_E1049_CYCLES = {3: 0.5, 4: 1.5, 6: 0.5, 8: 1.0, 9: 0.5}
+
+
+def synthetic_index(years, resolution_minutes):
+    return pd.date_range(pd.Timestamp(years[0], 1, 1), pd.Timestamp(years[-1] + 1, 1, 1), freq=str(resolution_minutes) + 'min', inclusive='left')
+
+
+def synthetic_demand(index, peak_load, rng):
+    '''Daily and seasonal load shape with noise (MW)'''
+    hour = index.hour + index.minute/60
+    daily = 0.75 + 0.25*np.sin((hour - 8)/24*2*np.pi)
+    seasonal = 1 + 0.15*np.cos((index.dayofyear - 15)/365*2*np.pi)
+    return peak_load*daily*seasonal*(1 + 0.03*rng.standard_normal(index.shape[0]))
+
+
+def synthetic_solar(index, capacity, rng):
+    '''Clear-sky bell between 06:00 and 18:00, longer in summer, scaled by a random daily cloudiness (MW)'''
+    hour = index.hour + index.minute/60
+    day_length = 12 + 3*np.sin((index.dayofyear - 80)/365*2*np.pi)
+    sun = np.clip(np.sin(np.pi*(hour - (12 - day_length/2))/day_length), 0, None)
+    days = (index.normalize() - index[0].normalize()).days
+    cloudiness = rng.uniform(0.3, 1.0, days.max() + 1)[days]
+    return capacity*0.85*sun*cloudiness
+
+
+def synthetic_wind(index, capacity, rng, persistence=0.98):
+    '''Capacity factor of a persistent (AR(1)) random wind speed through a smooth power curve (MW)'''
+    noise = rng.standard_normal(index.shape[0])*np.sqrt(1 - persistence**2)
+    speed = np.empty(index.shape[0])
+    speed[0] = noise[0]
+    for t in range(1, index.shape[0]):
+        speed[t] = persistence*speed[t-1] + noise[t]
+    return capacity/(1 + np.exp(-2*(speed - 0.3)))
+
+
+def synthetic_hydro(index, capacity, rng):
+    '''Seasonal run-of-river generation, higher in spring (MW)'''
+    return capacity*np.clip(0.35 + 0.25*np.cos((index.dayofyear - 100)/365*2*np.pi) + 0.05*rng.standard_normal(index.shape[0]), 0, 1)
+
+
+def format_mtu(index, resolution_minutes, suffix=''):
+    end = index + pd.Timedelta(minutes=resolution_minutes)
+    return index.strftime('%d.%m.%Y %H:%M') + ' - ' + end.strftime('%d.%m.%Y %H:%M') + suffix
+
+
+def write_synthetic_inputs(path, historical_years=1, resolution_minutes=60, simulation_years=(2025,), peak_load=8000.0, seed=0):
+    '''Writes a complete data/ tree for the model under path'''
+    rng = np.random.default_rng(seed)
+    data_path = os.path.join(path, 'data')
+    for folder in ['demand/input', 'demand/calculated', 'res_data/input', 'res_data/calculated', 'results']:
+        os.makedirs(os.path.join(data_path, folder), exist_ok=True)
+    for file_name in COPIED_SETTINGS_FILES:
+        shutil.copy(os.path.join(REPOSITORY_PATH, 'data', file_name), os.path.join(data_path, file_name))
+
+    years = list(range(min(simulation_years) - historical_years - 1, min(simulation_years) - 1))
+    index = synthetic_index(years, resolution_minutes)
+    demand_growth = 1.01**np.arange(len(years))
+    demand = synthetic_demand(index, peak_load, rng)*demand_growth[index.year - years[0]]
+    pd.DataFrame({'Time (CET)': format_mtu(index, resolution_minutes), DEMAND_COLUMN: demand}).to_csv(os.path.join(data_path, 'demand/input/historical_timeseries.csv'), index=False)
+    annual_demand = pd.Series(demand).groupby(index.year).sum()*resolution_minutes/60/1000000
+    pd.DataFrame({'annual demand': annual_demand.to_numpy()}, index=years).to_csv(os.path.join(data_path, 'demand/input/historical_annual_demand.csv'))
+    pd.DataFrame({'annual demand growth (%)': 1.0}, index=list(simulation_years)).to_excel(os.path.join(data_path, 'demand/input/demand_projections.xlsx'))
+
+    historical_capacity = pd.DataFrame({'solar capacity (MW)': np.linspace(3000, 5000, len(years)), 'wind capacity (MW)': np.linspace(4000, 5000, len(years)),
+                                        'hydro capacity (MW)': 3000.0}, index=years)
+    historical_capacity.to_csv(os.path.join(data_path, 'res_data/input/historical_capacity.csv'))
+    capacity = historical_capacity.loc[index.year]
+    generation = pd.DataFrame({'Area': 'Synthetic', 'MTU': format_mtu(index, resolution_minutes, ' (EET/EEST)'),
+                               GENERATION_LABELS['solar']: synthetic_solar(index, capacity['solar capacity (MW)'].to_numpy(), rng),
+                               GENERATION_LABELS['wind']: synthetic_wind(index, capacity['wind capacity (MW)'].to_numpy(), rng),
+                               GENERATION_LABELS['hydro']: synthetic_hydro(index, capacity['hydro capacity (MW)'].to_numpy(), rng)})
+    generation.to_csv(os.path.join(data_path, 'res_data/input/historical_timeseries.csv'), index=False)
+    pd.DataFrame({'min solar capacity (MW)': 5000.0, 'max solar capacity (MW)': 25000.0, 'min wind capacity (MW)': 4000.0, 'max wind capacity (MW)': 15000.0},
+                 index=list(simulation_years)).to_excel(os.path.join(data_path, 'res_data/input/res_capacity_projections.xlsx'))
+    pd.DataFrame({'simulation years': list(simulation_years)}).to_excel(os.path.join(data_path, 'simulation_years.xlsx'), index=False)
+    return data_path
+
+
+def check_rainflow(tolerance=1e-9):
+    '''Counts the ASTM E1049 example with RainflowDegradation (capacity 1, so that depths are the ranges). With dod_exponent
+    1 and 2 the capacity fade is the sum of the counted ranges and of their squares. Returns the results that differ'''
+    from battery_degradation import RainflowDegradation
+    series = np.array(ASTM_E1049_SERIES, dtype=float) - min(ASTM_E1049_SERIES) # a state of charge cannot be negative
+    mismatches = []
+    for dod_exponent in [1.0, 2.0]:
+        expected = [sum(cycles*cycle_range**dod_exponent for cycle_range, cycles in ASTM_E1049_CYCLES.items()), sum(ASTM_E1049_CYCLES.values())]
+        for blocks in [1, len(series)]:
+            degradation = RainflowDegradation([1.0], 1.0, dod_exponent, reference_dod=100)
+            for block in np.array_split(series, blocks):
+                degradation.update(block[None, :])
+            degradation.finalize()
+            if not np.allclose([degradation.get_capacity_fade()[0], degradation.totals[0, 2]], expected, rtol=tolerance, atol=0):
+                mismatches.append('dod_exponent ' + str(dod_exponent) + ' in ' + str(blocks) + ' blocks')
+    return mismatches
+
+
+class ModelBenchmarks:
+    '''asv-style benchmarks: setup() prepares the model on the synthetic data, every time_* method is one timed operation and
+    returns the simulated hours of its dispatches (None when it does not dispatch)'''
+
+    def __init__(self, resolution_minutes=60, samples=10, dispatch_engine='array'):
+        self.resolution_minutes = resolution_minutes
+        self.samples = samples
+        self.dispatch_engine = dispatch_engine
+        self.year = 2025
+        return
+
+    def setup(self):
+        from streem import Main
+        from demand_projections import Demand_Projections
+        from res_generation_projections import RES_Generation_Projections
+        from storage_v02 import StorageSimulations
+        from technoeconomic_calculations import TechnoeconomicCalculations
+        from instrumentation import instrumentation
+        instrumentation.configure(verbosity='quiet') # console output is not part of the timed work
+        self.main = Main()
+        for option, value in [('number_of_res_capacity_samples', self.samples), ('simulation_resolution (minutes)', self.resolution_minutes), ('dispatch_engine', self.dispatch_engine),
+                              ('statistics_cache', False), ('export_res_profiles', True), ('trace_level', 'none'), ('trace_excel_export', False), ('parallel_workers', 1), ('sizing_method', 'iterative')]:
+            self.main.simulation_details.loc[option, 'value'] = value
+        self.demand_projections = Demand_Projections(self.main)
+        self.res_generation_projections = RES_Generation_Projections(self.main)
+        self.storage = StorageSimulations(self.main, self.res_generation_projections.profile_store)
+        self.technoeconomic_calculations = TechnoeconomicCalculations(self.main)
+        self.demand = self.demand_projections.calculate_demand(self.year)
+        self.sampled_res_capacities = self.res_generation_projections.get_sampled_res_capacities(self.year, seed=0)
+        self.simulated_hours_per_year = len(self.demand.index)*self.storage.time_step_hours
+        self.entso_demand_df = self.demand_projections.reshape_data()
+        self.sizing_output_df = None
+        return
+
+    def get_dispatch_inputs(self, res_combination):
+        '''Same preparation as StorageSimulations.size_res_combination'''
+        res_generation = self.storage.load_res_generation(self.year, res_combination, self.sampled_res_capacities)
+        demand = self.demand.copy()
+        if 'hydro' in res_generation.keys():
+            demand.iloc[:,0] -= res_generation['hydro'].iloc[:,0]
+        aggregated_res_generation_df = pd.DataFrame(0.0, index=demand.index, columns=['res_generation'])
+        for technology in res_generation.keys():
+            aggregated_res_generation_df.iloc[:,0] += res_generation[technology].iloc[:,0]
+        return res_generation, aggregated_res_generation_df, demand
+
+    def get_dispatch_capacity(self, demand):
+        return float(demand.iloc[:,0].mean()/self.storage.time_step_hours)*4
+
+    def dispatch(self, energy_simulations):
+        res_combination = self.sampled_res_capacities.index[0]
+        res_generation, aggregated_res_generation_df, demand = self.get_dispatch_inputs(res_combination)
+        storage_capacity = self.get_dispatch_capacity(demand)
+        bess_pch_max, bess_pdis_max, bess_min_discharge_level = self.storage.update_bess_specifications(storage_capacity)
+        phs_pmax_dis, phs_min_discharge_level = self.storage.update_phs_specifications(self.storage.storage_specifications["phs"].loc['capacity (MWh)']['value'])
+        self.storage.simulations_df = pd.DataFrame(np.nan, index=demand.index, columns=self.storage.simulation_columns)
+        self.storage.reset_simulations_df(res_generation, demand)
+        energy_simulations(self.sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+        return self.simulated_hours_per_year
+
+    def check_engines(self, tolerance=1e-6):
+        '''Dispatches the first res combination with the dataframe, array and batched engines. Returns the results that differ
+        from those of the dataframe engine by more than tolerance (relative to the largest value of the result)'''
+        self.dispatch(self.storage.hourly_energy_simulations)
+        reference = self.storage.simulations_df.copy()
+        self.dispatch(self.storage.array_energy_simulations)
+        results = {'array ' + column: self.storage.simulations_df[column] for column in reference.columns}
+        res_combination = self.sampled_res_capacities.index[0]
+        batched_inputs = self.storage.build_batched_inputs(self.year, self.demand, self.sampled_res_capacities.loc[[res_combination]], aggregate_by_technology=True)
+        summaries = self.storage.batched_energy_simulations(batched_inputs, np.array([[self.get_dispatch_capacity(self.get_dispatch_inputs(res_combination)[2])]]))
+        for column in ['curtailment', 'RES penetration', 'energy shortage']:
+            results['batched ' + column] = pd.Series(np.ravel(summaries[column])[0], index=[0])
+        mismatches = []
+        for name, values in results.items():
+            column = name.split(' ', 1)[1]
+            expected = reference[column] if name.startswith('array') else pd.Series(reference[column].sum(), index=[0])
+            if expected.dtype == object or values.dtype == object:
+                if not (expected.astype(str).to_numpy() == values.astype(str).to_numpy()).all():
+                    mismatches.append(name)
+                continue
+            expected, values = expected.to_numpy(dtype=float), values.to_numpy(dtype=float)
+            if not np.allclose(values, expected, rtol=0, atol=tolerance*max(np.abs(expected).max(), 1e-12)):
+                mismatches.append(name)
+        return mismatches
+
+    def check_representative_days(self, tolerance=1e-9, interpolation_tolerance=1e-3, soc_levels=50):
+        '''Dispatches the res combinations over representative days, one per day of the year, and over the full year. Without
+        storage the days are dispatched from their actual levels, so the results agree to rounding (tolerance). With storage
+        the chained end levels are interpolated between soc_levels dispatched levels, so they agree within interpolation_tolerance.
+        Tolerances are relative to the largest value of the result. Returns the results that differ'''
+        from dispatch_kernel import simulate_batched_dispatch
+        from time_series_aggregation import RepresentativeDays
+        technologies = [technology for technology in self.sampled_res_capacities.columns if technology != 'year']
+        demand = self.demand.iloc[:,0].to_numpy(dtype=float)
+        steps_per_day = int(round(24/self.storage.time_step_hours))
+        aggregation = RepresentativeDays(demand, {technology: self.storage.profile_store.shapes[technology] for technology in technologies}, steps_per_day,
+                                         demand.shape[0]//steps_per_day, 'hierarchical', soc_levels)
+        batched_inputs = self.storage.build_batched_inputs(self.year, self.demand, self.sampled_res_capacities, aggregate_by_technology=True)
+        storage_capacities = np.array([0.0, self.get_dispatch_capacity(self.demand)])
+        parameters = self.storage.resolve_batched_dispatch_parameters()
+        arguments = (batched_inputs['res_generation'], batched_inputs['demand'], batched_inputs['hydro_generation'], batched_inputs['net_billing_cap'], storage_capacities, parameters)
+        full_year, representative_days = simulate_batched_dispatch(*arguments), aggregation.simulate_dispatch(*arguments)
+        mismatches = []
+        for result in ['curtailment', 'RES penetration', 'energy shortage', 'battery throughput energy (MWh)']:
+            for candidate, allowed in enumerate([tolerance, interpolation_tolerance]):
+                expected = full_year[result][:, candidate]
+                if not np.allclose(representative_days[result][:, candidate], expected, rtol=0, atol=allowed*max(np.abs(expected).max(), 1e-12)):
+                    mismatches.append(result + ' at ' + str(storage_capacities[candidate]) + 'MWh')
+        return mismatches
+
+    def check_linear_program(self, combinations=3, target_offset=1e-4, tolerance=1e-3):
+        '''Sizes the first res combinations with the linear program and with the iterative method (to target_offset (%)). The
+        perfect-foresight capacity must be at or below the iterative one, which may end below the exact capacity by its
+        target_offset, hence the relative tolerance. Returns the res combinations that break the bound'''
+        settings = {option: self.main.simulation_details.loc[option, 'value'] for option in ['target', 'target_threshold (%)', 'target_offset (%)']}
+        sizing_method = self.storage.sizing_method
+        sampled_res_capacities = self.sampled_res_capacities.iloc[:combinations]
+        capacities = {}
+        try:
+            for option, value in [('target', 'demand'), ('target_threshold (%)', 70), ('target_offset (%)', target_offset)]:
+                self.main.simulation_details.loc[option, 'value'] = value
+            for method in ['linear_program', 'iterative']:
+                self.storage.sizing_method = method
+                output_df = self.storage.size_res_combinations(self.year, self.demand, sampled_res_capacities)
+                capacities[method] = pd.to_numeric(output_df['battery_capacity (MWh)'], errors='coerce')
+        finally:
+            self.storage.sizing_method = sizing_method
+            for option, value in settings.items():
+                self.main.simulation_details.loc[option, 'value'] = value
+        above = capacities['linear_program'] > capacities['iterative']*(1 + tolerance)
+        return [str(res_combination) for res_combination in above.index[above]]
+
+    def size(self, target, target_threshold, sizing):
+        self.main.simulation_details.loc['target', 'value'] = target
+        self.main.simulation_details.loc['target_threshold (%)', 'value'] = target_threshold
+        self.storage.output_df = pd.DataFrame(None, columns=self.storage.output_columns)
+        self.storage.simulations_df = pd.DataFrame(np.nan, index=self.demand.index, columns=self.storage.simulation_columns)
+        simulations = 0
+        for res_combination in self.sampled_res_capacities.index[:2]:
+            res_generation, aggregated_res_generation_df, demand = self.get_dispatch_inputs(res_combination)
+            getattr(self.storage, sizing)(res_combination, res_generation, aggregated_res_generation_df, demand, self.sampled_res_capacities)
+            simulations += self.storage.output_df.loc[res_combination, 'sizing iterations']
+        return simulations*self.simulated_hours_per_year
+
+    def time_hourly_energy_simulations(self):
+        return self.dispatch(self.storage.hourly_energy_simulations)
+
+    def time_array_energy_simulations(self):
+        return self.dispatch(self.storage.array_energy_simulations)
+
+    def time_maximize_self_consumption(self):
+        return self.size('demand', 70, 'maximize_self_consumption')
+
+    def time_minimize_curtailment(self):
+        return self.size('curtailment', 5, 'minimize_curtailment')
+
+    def time_size_res_combinations(self):
+        self.main.simulation_details.loc['target', 'value'] = 'demand'
+        self.main.simulation_details.loc['target_threshold (%)', 'value'] = 70
+        self.sizing_output_df = self.storage.size_res_combinations(self.year, self.demand, self.sampled_res_capacities).copy()
+        return pd.to_numeric(self.sizing_output_df['sizing iterations'], errors='coerce').fillna(0).sum()*self.simulated_hours_per_year
+
+    def time_calculate_data_distribution(self):
+        self.demand_projections.calculate_data_distribution(self.entso_demand_df)
+
+    def time_calculate_demand(self):
+        self.demand_projections.calculate_demand(self.year)
+
+    def time_calculate_res_generation_profile(self):
+        self.res_generation_projections.calculate_res_generation_profile(self.year, self.sampled_res_capacities)
+
+    def time_lhs_sample(self):
+        self.res_generation_projections.lhs.sample(max(self.samples, 1000), self.res_generation_projections.get_sampling_ranges(self.year), seed=0)
+
+    def time_calculate_eac(self):
+        if self.sizing_output_df is None:
+            self.time_size_res_combinations()
+        self.technoeconomic_calculations.calculate_eac(self.year, self.sizing_output_df)
+
+
+def run_benchmark(function, repeat):
+    '''One warm-up run, then repeat timed runs. Model output is captured so that console I/O is not timed'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+        timings = []
+        for run in range(repeat):
+            start = time.perf_counter()
+            simulated_hours = function()
+            timings.append(time.perf_counter() - start)
+    result = {'best (s)': min(timings), 'median (s)': statistics.median(timings), 'repeat': repeat}
+    if simulated_hours is not None:
+        result['simulated hours'] = float(simulated_hours)
+        result['simulated hours per second'] = float(simulated_hours)/min(timings)
+    return result
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    '''Returns the names of the benchmarks that are slower than the baseline by more than tolerance'''
+    regressions = []
+    print ('\n' + 'benchmark'.ljust(40) + 'baseline (s)'.rjust(14) + 'current (s)'.rjust(14) + 'ratio'.rjust(8))
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        ratio = result['best (s)']/baseline['benchmarks'][name]['best (s)']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print (name.ljust(40) + ('%.4f' % baseline['benchmarks'][name]['best (s)']).rjust(14) + ('%.4f' % result['best (s)']).rjust(14) + ('%.2f' % ratio).rjust(8) + flag)
+    if baseline.get('settings') != results['settings']:
+        print ('Baseline settings differ from this run: ' + str(baseline.get('settings')))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the STREEM hot paths on synthetic data')
+    parser.add_argument('--historical-years', type=int, default=1, help='number of synthetic historical years')
+    parser.add_argument('--resolution', type=int, default=60, help='simulation resolution in minutes, also used for the synthetic data')
+    parser.add_argument('--samples', type=int, default=10, help='number of sampled res combinations')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark')
+    parser.add_argument('--slow-repeat', type=int, default=1, help='timed runs of the dataframe dispatch engine (hourly_energy_simulations)')
+    parser.add_argument('--only', nargs='*', default=None, help='names of the benchmarks to run (without time_)')
+    parser.add_argument('--output', default=None, help='JSON file the results are written to')
+    parser.add_argument('--compare', default=None, help='baseline JSON file of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline (0.25 = 25%%)')
+    parser.add_argument('--keep-data', action='store_true', help='keep the synthetic data directory')
+    args = parser.parse_args(arguments)
+
+    settings = {'historical years': args.historical_years, 'resolution (minutes)': args.resolution, 'samples': args.samples}
+    results = {'settings': settings, 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+               'machine': platform.machine(), 'processor': platform.processor(), 'benchmarks': {}}
+    working_path = tempfile.mkdtemp(prefix='streem_benchmark_')
+    original_path = os.getcwd()
+    sys.path.insert(0, REPOSITORY_PATH)
+    try:
+        print ('Writing synthetic data to ' + working_path)
+        write_synthetic_inputs(working_path, args.historical_years, args.resolution)
+        os.chdir(working_path)
+        benchmarks = ModelBenchmarks(args.resolution, args.samples)
+        with contextlib.redirect_stdout(io.StringIO()):
+            benchmarks.setup()
+        checks = {'engines': benchmarks.check_engines, 'rainflow': check_rainflow, 'representative days': benchmarks.check_representative_days,
+                  'linear program': benchmarks.check_linear_program}
+        failed = False
+        for name, check in checks.items():
+            with contextlib.redirect_stdout(io.StringIO()):
+                mismatches = check()
+            print (('Check ' + name).ljust(40) + ('failed: ' + ', '.join(mismatches) if len(mismatches) > 0 else 'passed'))
+            failed |= len(mismatches) > 0
+        if failed:
+            return 1
+        names = [name[len('time_'):] for name in dir(benchmarks) if name.startswith('time_')]
+        if args.only is not None:
+            names = [name for name in names if name in args.only]
+        for name in names:
+            repeat = args.slow_repeat if name == 'hourly_energy_simulations' else args.repeat
+            result = run_benchmark(getattr(benchmarks, 'time_' + name), repeat)
+            results['benchmarks'][name] = result
+            throughput = ', ' + str(int(result['simulated hours per second'])) + ' simulated hours/s' if 'simulated hours per second' in result else ''
+            print (name.ljust(40) + ('%.4f s' % result['best (s)']).rjust(12) + throughput)
+    finally:
+        os.chdir(original_path)
+        if not args.keep_data:
+            shutil.rmtree(working_path, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print ('Results written to ' + args.output)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print (str(len(regressions)) + ' benchmarks regressed: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+'''Durable per-year journal of finished res combinations, so that interrupted sizing and dispatch runs can resume.
+
+Every stage and year has a JSON lines journal in data/results/checkpoints (e.g. "sizing - 2030.jsonl"). The first
+line holds a sha256 signature of everything the results depend on (settings, storage specifications, demand, RES
+shapes and, in dispatch mode, the storage capacities of the year). Every finished res combination then appends one
+line with its res capacities and its output row, and a last line marks the year as completed. Lines are flushed and
+fsync'ed as they are written, so a crash loses at most the combinations in progress.
+With checkpoint_resume, a journal with the same signature is read back on restart. Its combinations are not simulated
+again (a combination is only reused when its res capacities are unchanged) and their outputs are put back into the
+output of the year in the order of the sampled res capacities. A line cut short by a crash is dropped, and a journal
+with another signature is started over. The signature also covers JOURNAL_VERSION and a sha256 of the modules that
+calculate the journaled outputs (RESULT_MODULES), so a journal written by other model code is never resumed, while
+changes to the tools around the model (benchmark.py, scenario_runner.py...) keep it.'''
+import hashlib
+import json
+import os
+import numpy as np
+from instrumentation import instrumentation
+
+JOURNAL_VERSION = 2 # increase when the journal format or what the signature covers changes
+# options that change how a run is executed or reported, but not its results
+RUN_OPTIONS = ('verbosity', 'progress_bar', 'profile_dispatch', 'profile_sampling_interval (ms)', 'run_report', 'checkpointing', 'checkpoint_resume', 'parallel_workers',
+               'pipeline_workers', 'trace_level', 'trace_excel_export', 'trace_chunk_size', 'statistics_cache', 'clear_statistics_cache', 'export_res_profiles',
+               'ensemble_realizations', 'ensemble_chunk_size', 'dispatch_cache', 'dispatch_cache_size', 'dispatch_cache_traces', 'dispatch_cache_persist', 'dispatch_cache_disk_size (MB)',
+               'aggregation_validation_samples', 'sensitivity_analysis', 'sensitivity_variation (%)', 'sensitivity_samples', 'sensitivity_top_k')
+# modules next to this one that the sizing and dispatch outputs depend on
+RESULT_MODULES = ('storage_v02.py', 'dispatch_kernel.py', 'sizing_solver.py', 'sizing_screening.py', 'lp_sizing.py', 'time_series_aggregation.py', 'battery_degradation.py',
+                  'dispatch_cache.py', 'res_profile_store.py')
+
+
+_code_digest = None
+
+
+def get_code_digest():
+    '''sha256 of RESULT_MODULES, computed once per process'''
+    global _code_digest
+    if _code_digest is None:
+        digest = hashlib.sha256()
+        for module in RESULT_MODULES:
+            digest.update(module.encode())
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module), 'rb') as file:
+                digest.update(file.read())
+        _code_digest = digest.hexdigest()
+    return _code_digest
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class CheckpointJournal:
+
+    def __init__(self, checkpoint_path, enabled=False, resume=True):
+        self.checkpoint_path = checkpoint_path
+        self.enabled = enabled
+        self.resume = resume
+        self.file = None
+        self.entries = {} # res combination (as text) -> (res capacities, output row or None for infeasible combinations)
+        self.completed = False
+        return
+
+    def get_signature(self, simulation_details, inputs, arrays):
+        '''sha256 of the result-relevant rows of simulation_details, of other inputs (storage specifications...) and of the input arrays'''
+        settings = [[str(option), str(value)] for option, value in simulation_details['value'].items() if option not in RUN_OPTIONS]
+        digest = hashlib.sha256()
+        digest.update(json.dumps({'version': JOURNAL_VERSION, 'code': get_code_digest(), 'settings': settings, 'inputs': inputs}, sort_keys=True, default=str).encode())
+        for array in arrays:
+            digest.update(np.ascontiguousarray(np.asarray(array, dtype=float)).tobytes())
+        return digest.hexdigest()
+
+    def get_file_path(self, stage, year):
+        return os.path.join(self.checkpoint_path, stage + ' - ' + str(year) + '.jsonl')
+
+    def open(self, stage, year, signature):
+        '''Starts or resumes the journal of a year. Returns the number of res combinations that can be reused'''
+        self.close()
+        self.entries = {}
+        self.completed = False
+        if not self.enabled:
+            return 0
+        os.makedirs(self.checkpoint_path, exist_ok=True)
+        file_path = self.get_file_path(stage, year)
+        records = []
+        if self.resume and os.path.exists(file_path):
+            records = self.read(file_path)
+            if len(records) == 0 or records[0].get('signature') != signature:
+                if len(records) > 0:
+                    instrumentation.log('     The ' + stage + ' checkpoint of year ' + str(year) + ' was written with other inputs, settings or model code, starting over')
+                records = []
+        if len(records) == 0:
+            records = [{'signature': signature, 'stage': stage, 'year': year}]
+        for record in records[1:]:
+            if record.get('completed', False):
+                self.completed = True
+            elif 'res combination' in record:
+                self.entries[str(record['res combination'])] = (np.array(record['res capacities'], dtype=float), record['output'])
+        # the journal is rewritten without any line cut short by a crash before new lines are appended
+        temporary_file_path = file_path + '.tmp'
+        with open(temporary_file_path, 'w') as file:
+            for record in records:
+                file.write(json.dumps(record, default=_to_json) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_file_path, file_path)
+        self.file = open(file_path, 'a')
+        if len(self.entries) > 0:
+            instrumentation.log('     Resuming ' + stage + ' of year ' + str(year) + ' from checkpoint: ' + str(len(self.entries)) + ' res combinations already finished' + (', year completed' if self.completed else ''))
+        return len(self.entries)
+
+    def read(self, file_path):
+        records = []
+        with open(file_path) as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break # the last line was cut short
+        return records
+
+    def write(self, record, sync=True):
+        self.file.write(json.dumps(record, default=_to_json) + '\n')
+        if sync:
+            self.sync()
+        return
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return
+
+    def get(self, res_combination, res_capacities):
+        '''Returns (True, output row) when the res combination was finished with the same res capacities, (False, None) otherwise.
+        The output row is None for combinations that were found infeasible'''
+        entry = self.entries.get(str(res_combination))
+        if entry is None or not np.array_equal(entry[0], np.asarray(res_capacities, dtype=float)):
+            return False, None
+        return True, entry[1]
+
+    def record(self, res_combination, res_capacities, output_df, sync=True):
+        '''Appends a finished res combination with its row of output_df (if it has one). Without sync the line is made durable by the next sync()'''
+        if self.file is None:
+            return
+        output = None
+        if res_combination in output_df.index:
+            output = {str(column): value for column, value in output_df.loc[res_combination].items()} # json keeps NaN apart from None
+        res_capacities = [float(capacity) for capacity in res_capacities]
+        self.write({'res combination': res_combination, 'res capacities': res_capacities, 'output': output}, sync)
+        self.entries[str(res_combination)] = (np.array(res_capacities), output)
+        return
+
+    def complete(self):
+        if self.file is not None and not self.completed:
+            self.write({'completed': True})
+        self.completed = True
+        return
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.entries = {}
+        self.completed = False
+        return
+
+
+def restore_output(output_df, res_combination, output):
+    '''Puts a journaled output row back into output_df'''
+    if output is None:
+        return
+    for column, value in output.items():
+        output_df.loc[res_combination, column] = value
+    return
@@ -0,0 +1,156 @@
+'''Memoization of full-year dispatch evaluations of the storage sizing.
+
+The sizing search simulates the same year again when it returns to a capacity it already tried, and identical
+(RES generation, demand, storage capacity) inputs come back when res combinations or whole runs are repeated. The
+key is a sha256 of the aggregated RES generation, hydro generation and demand arrays and of every dispatch
+parameter (storage capacity, battery and PHS specifications, net billing cap, step length, precision and engine).
+An entry holds the summary metrics of the evaluation and, with dispatch_cache_traces, the simulated series, so that
+traces can be written without simulating the year again.
+Entries are kept in memory in least recently used order, up to dispatch_cache_size entries. With
+dispatch_cache_persist they are also written as .npz files to data/results/dispatch_cache and read back by later
+runs. The least recently used files are deleted when the folder grows beyond dispatch_cache_disk_size (MB).
+Hits and misses are counted in the run report. Process pool workers keep a cache of their own.'''
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from instrumentation import instrumentation
+
+CACHE_VERSION = 1 # increase when the dispatch rules change
+
+
+class DispatchCache:
+
+    def __init__(self, cache_path, enabled=True, max_entries=1024, store_traces=False, persist=False, max_disk_size=512):
+        self.cache_path = cache_path
+        self.enabled = enabled and int(max_entries) > 0
+        self.max_entries = int(max_entries)
+        self.store_traces = store_traces
+        self.persist = persist
+        self.max_disk_size = float(max_disk_size)*1024**2 # in bytes
+        self.entries = OrderedDict() # key -> (metrics, trace columns or None), most recently used last
+        self.disk_size = None # bytes in cache_path, measured on the first write
+        return
+
+    def get_key(self, arrays, parameters):
+        digest = hashlib.sha256()
+        digest.update(json.dumps({'version': CACHE_VERSION, 'parameters': parameters}, sort_keys=True, default=str).encode())
+        for array in arrays:
+            array = np.ascontiguousarray(np.broadcast_to(np.asarray(array, dtype=float), np.shape(arrays[0])))
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def get_file_path(self, key):
+        return os.path.join(self.cache_path, key[:32] + '.npz')
+
+    def get(self, key, need_trace=False):
+        '''Returns (metrics, trace columns) of a cached evaluation, or None on a miss. The trace columns are None when they were not stored'''
+        if not self.enabled:
+            return None
+        entry = self.entries.get(key)
+        if entry is None and self.persist:
+            entry = self.load(key)
+            if entry is not None:
+                self.add(key, entry)
+        if entry is None or (need_trace and entry[1] is None):
+            instrumentation.count('dispatch cache misses')
+            return None
+        self.entries.move_to_end(key)
+        instrumentation.count('dispatch cache hits')
+        return entry
+
+    def put(self, key, metrics, simulations_df=None):
+        if not self.enabled:
+            return
+        trace = None
+        if self.store_traces and simulations_df is not None:
+            trace = {column: simulations_df[column].to_numpy(copy=True) for column in simulations_df.columns}
+        entry = ({name: float(value) for name, value in metrics.items()}, trace)
+        self.add(key, entry)
+        if self.persist:
+            self.save(key, entry)
+        return
+
+    def add(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return
+
+    def load(self, key):
+        file_path = self.get_file_path(key)
+        if not os.path.exists(file_path):
+            return None
+        try:
+            with np.load(file_path, allow_pickle=False) as archive:
+                if str(archive['key']) != key:
+                    return None
+                metrics = dict(zip(archive['metric_names'].tolist(), archive['metric_values'].tolist()))
+                trace = None
+                if 'trace_columns' in archive:
+                    trace = {column: archive['trace_' + str(i)] for i, column in enumerate(archive['trace_columns'].tolist())}
+            os.utime(file_path) # the modification time orders the files for eviction
+        except (OSError, KeyError, ValueError):
+            instrumentation.log('          Ignoring unreadable dispatch cache entry ' + file_path, 'quiet')
+            return None
+        return metrics, trace
+
+    def save(self, key, entry):
+        metrics, trace = entry
+        arrays = {'key': np.array(key), 'metric_names': np.array(list(metrics.keys())), 'metric_values': np.array(list(metrics.values()), dtype=float)}
+        if trace is not None:
+            arrays['trace_columns'] = np.array(list(trace.keys()))
+            for i, values in enumerate(trace.values()):
+                arrays['trace_' + str(i)] = values.astype(str) if values.dtype == object else values
+        os.makedirs(self.cache_path, exist_ok=True)
+        if self.disk_size is None:
+            self.disk_size = sum(size for file_path, modified, size in self.list_files())
+        file_path = self.get_file_path(key)
+        temporary_file_path = file_path + '.tmp'
+        try:
+            with open(temporary_file_path, 'wb') as file:
+                np.savez(file, **arrays)
+            previous_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            os.replace(temporary_file_path, file_path)
+            self.disk_size += os.path.getsize(file_path) - previous_size
+        except OSError:
+            instrumentation.log('          Could not write dispatch cache entry ' + file_path, 'quiet')
+            return
+        if self.disk_size > self.max_disk_size:
+            self.evict_files()
+        return
+
+    def list_files(self):
+        '''(file path, modification time, size) of the cache files'''
+        files = []
+        for file_name in os.listdir(self.cache_path):
+            if file_name.endswith('.npz'):
+                file_path = os.path.join(self.cache_path, file_name)
+                try:
+                    status = os.stat(file_path)
+                except OSError:
+                    continue # removed by another process
+                files.append((file_path, status.st_mtime, status.st_size))
+        return files
+
+    def evict_files(self):
+        '''Deletes the least recently used files until the folder is back under max_disk_size'''
+        files = sorted(self.list_files(), key=lambda file: file[1])
+        self.disk_size = sum(size for file_path, modified, size in files)
+        for file_path, modified, size in files:
+            if self.disk_size <= self.max_disk_size:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                continue
+            self.disk_size -= size
+        return
+
+
+def restore_simulations_df(trace, index, columns):
+    '''simulations_df of a cached evaluation'''
+    return pd.DataFrame({column: trace[column] for column in columns}, index=index, columns=columns)
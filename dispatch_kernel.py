@@ -0,0 +1,268 @@
+'''Array-backed dispatch kernel used by StorageSimulations.
+
+The storage-independent part of the hourly dispatch (net-billing cap, HV to LV losses,
+surplus/deficit split) is calculated in one vectorized pass and only the state-of-charge
+recurrence is stepped hour by hour. The recurrence is compiled with numba when it is
+installed and runs as plain Python otherwise.
+
+The kernels do not assume hourly steps: generation and demand are energy per simulation step (MWh), while
+storage power limits and the net-billing cap are given in MW and converted to energy per step with
+time_step_hours. Outputs and the batched state use the dtype of dispatch_precision (float64 or the compact
+float32), charge states are int8 and annual sums are always accumulated in float64.'''
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+CHARGING = 1
+DISCHARGING = 2
+CHARGE_STATE_LABELS = np.array(['', 'Charging!', 'Discharging!'], dtype=object)
+
+
+def prepare_dispatch_inputs(res_generation, demand, hydro_generation, net_billing_cap, hv_to_lv_factor):
+    '''Vectorized pre-pass of everything in the hourly loop that does not depend on the storage state'''
+    res_generation = np.ascontiguousarray(res_generation, dtype=np.float64)
+    demand = np.ascontiguousarray(demand, dtype=np.float64)
+
+    # Εάν υπάρχει περιορισμός ταυτοχρονισμού όπως στο ΑΠΟΛΛΩΝ
+    over_cap = res_generation > net_billing_cap
+    eligible_res_generation = np.where(over_cap, net_billing_cap*hv_to_lv_factor, res_generation*hv_to_lv_factor)
+    energy_to_be_stored = np.where(over_cap, res_generation - (net_billing_cap*hv_to_lv_factor)/hv_to_lv_factor, 0.0)
+
+    surplus = eligible_res_generation >= demand
+    energy_to_be_stored = np.where(surplus, energy_to_be_stored + (eligible_res_generation - demand)/hv_to_lv_factor, energy_to_be_stored)
+    base_penetration = hydro_generation + np.where(surplus, demand, eligible_res_generation)
+    missing_energy = np.where(surplus, 0.0, demand - eligible_res_generation)
+    return demand, surplus, np.ascontiguousarray(energy_to_be_stored), np.ascontiguousarray(missing_energy), np.ascontiguousarray(base_penetration, dtype=np.float64)
+
+
+@njit(cache=True)
+def dispatch_recurrence(demand, surplus, energy_to_be_stored, missing_energy, base_penetration,
+                        storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, bess_rte,
+                        phs_capacity, phs_pch_max, phs_pdis_max, phs_min_discharge_level, phs_rte, phs_enabled, hv_to_lv_factor,
+                        initial_soc, initial_phs_level, initial_state, initial_periods,
+                        battery_p_ch, battery_p_dis, battery_soc, battery_stored_energy, battery_throughput, battery_charge_state,
+                        phs_p_ch, phs_p_dis, phs_soc, phs_stored_energy, res_penetration, curtailment, energy_shortage,
+                        modified_demand, periods_since_state_change):
+    '''Sequential state-of-charge recurrence: batteries first, then PHS. Results are written in the output arrays'''
+    soc = initial_soc
+    phs_level = initial_phs_level
+    state = initial_state
+    periods = initial_periods
+    for t in range(demand.shape[0]):
+        remaining_capacity = storage_capacity - soc
+        remaining_stored_energy = soc - bess_min_discharge_level
+        p_ch = min(bess_pch_max, remaining_capacity)
+        p_dis = min(bess_pdis_max, remaining_stored_energy*bess_rte*hv_to_lv_factor)
+        phs_remaining_capacity = phs_capacity - phs_level
+        phs_remaining_stored_energy = phs_level - phs_min_discharge_level
+        phs_ch = min(phs_pch_max, phs_remaining_capacity)
+        phs_dis = min(phs_pdis_max, phs_remaining_stored_energy*phs_rte*hv_to_lv_factor)
+        phs_stored = 0.0
+        shortage = 0.0
+        penetration = base_penetration[t]
+        modified = demand[t]
+
+        if surplus[t]:
+            stored = min(energy_to_be_stored[t], remaining_capacity, p_ch)
+            throughput = abs(stored)
+            modified += stored
+            curtailed = energy_to_be_stored[t] - stored
+            soc = soc + stored
+            if state == CHARGING and stored > 0:
+                periods += 1
+            else:
+                periods = 1.0
+            state = CHARGING
+
+            if curtailed > 0 and phs_enabled:
+                phs_stored = min(curtailed, phs_remaining_capacity, phs_ch)
+                modified += phs_stored
+                curtailed -= phs_stored
+            phs_level = phs_level + phs_stored
+        else:
+            missing = missing_energy[t]
+            discharged = -min(missing, remaining_stored_energy*bess_rte*hv_to_lv_factor, p_dis)
+            throughput = abs((discharged/bess_rte)/hv_to_lv_factor)
+            shortage = missing + discharged
+            penetration += abs(discharged)
+            modified -= abs(discharged)
+            soc = soc + (discharged/bess_rte)/hv_to_lv_factor
+            if state == DISCHARGING and discharged < 0:
+                periods += 1
+            else:
+                periods = 1.0
+            state = DISCHARGING
+
+            # Αποθήκευση ενέργειας που δεν μπορεί να ταυτοχρονιστεί
+            stored = min(energy_to_be_stored[t], storage_capacity - soc, p_ch)
+            modified += stored
+            curtailed = energy_to_be_stored[t] - stored
+            soc = soc + stored
+
+            if shortage > 0 and phs_enabled:
+                phs_stored = -min(shortage, phs_remaining_stored_energy*phs_rte*hv_to_lv_factor, phs_dis)
+                modified -= abs(phs_stored)
+                shortage += phs_stored
+                penetration += abs(phs_stored)
+            phs_level = phs_level + (phs_stored/phs_rte)/hv_to_lv_factor
+
+        battery_p_ch[t] = p_ch
+        battery_p_dis[t] = p_dis
+        battery_soc[t] = soc
+        battery_stored_energy[t] = stored
+        battery_throughput[t] = throughput
+        battery_charge_state[t] = state
+        phs_p_ch[t] = phs_ch
+        phs_p_dis[t] = phs_dis
+        phs_soc[t] = phs_level
+        phs_stored_energy[t] = phs_stored
+        res_penetration[t] = penetration
+        curtailment[t] = curtailed
+        energy_shortage[t] = shortage
+        modified_demand[t] = modified
+        periods_since_state_change[t] = periods
+
+
+def simulate_dispatch(res_generation, demand, hydro_generation, parameters, initial_state=None):
+    '''Runs the full-year dispatch on plain arrays and returns one array per column of StorageSimulations.simulations_df.
+    initial_state continues the dispatch of a previous block of steps: the last battery_soc, phs_soc, battery_charge_state and
+    periods since battery state change of that block (the year starts at the minimum discharge levels otherwise)'''
+    time_step_hours = parameters['time_step_hours']
+    if initial_state is None:
+        initial_state = {'battery_soc': parameters['bess_min_discharge_level'], 'phs_soc': parameters['phs_min_discharge_level'], 'battery_charge_state': 0, 'periods since battery state change': 0.0}
+    demand, surplus, energy_to_be_stored, missing_energy, base_penetration = prepare_dispatch_inputs(
+        res_generation, demand, hydro_generation, parameters['net_billing_cap']*time_step_hours, parameters['hv_to_lv_factor'])
+
+    frames = demand.shape[0]
+    results = {column: np.empty(frames, dtype=parameters['dispatch_precision']) for column in ['battery_p_ch', 'battery_p_dis', 'battery_soc', 'battery_stored_energy', 'battery throughput energy (MWh)', \
+                                                                        'phs_p_ch', 'phs_p_dis', 'phs_soc', 'phs_stored_energy', 'RES penetration', 'curtailment', 'energy shortage', \
+                                                                        'modified demand', 'periods since battery state change']}
+    charge_state = np.zeros(frames, dtype=np.int8)
+    dispatch_recurrence(demand, surplus, energy_to_be_stored, missing_energy, base_penetration,
+                        parameters['storage_capacity'], parameters['bess_pch_max']*time_step_hours, parameters['bess_pdis_max']*time_step_hours, parameters['bess_min_discharge_level'], parameters['bess_rte'],
+                        parameters['phs_capacity'], parameters['phs_pch_max']*time_step_hours, parameters['phs_pdis_max']*time_step_hours, parameters['phs_min_discharge_level'], parameters['phs_rte'],
+                        parameters['phs_enabled'], parameters['hv_to_lv_factor'],
+                        float(initial_state['battery_soc']), float(initial_state['phs_soc']), int(initial_state['battery_charge_state']), float(initial_state['periods since battery state change']),
+                        results['battery_p_ch'], results['battery_p_dis'], results['battery_soc'], results['battery_stored_energy'], results['battery throughput energy (MWh)'], charge_state,
+                        results['phs_p_ch'], results['phs_p_dis'], results['phs_soc'], results['phs_stored_energy'], results['RES penetration'], results['curtailment'],
+                        results['energy shortage'], results['modified demand'], results['periods since battery state change'])
+    results['battery_charge_state'] = charge_state
+    return results
+
+
+def simulate_batched_dispatch(res_generation, demand, hydro_generation, net_billing_cap, storage_capacities, parameters):
+    '''Moves a (combinations x candidate capacities) state forward step by step with vector operations across the batch.
+    
+    res_generation: (combinations, frames) aggregated RES generation per step
+    demand, hydro_generation: (combinations, frames) or (frames,) when shared by all combinations
+    net_billing_cap: (combinations,) net-billing cap of each combination (MW)
+    storage_capacities: (candidates,) shared by all combinations or (combinations, candidates)
+    Returns per-member summaries as (combinations, candidates) arrays. Peaks of curtailment and shortage are hourly rates.'''
+    res_generation = np.atleast_2d(np.asarray(res_generation, dtype=np.float64))
+    combinations, frames = res_generation.shape
+    demand = np.broadcast_to(np.asarray(demand, dtype=np.float64), (combinations, frames))
+    hydro_generation = np.broadcast_to(np.asarray(hydro_generation, dtype=np.float64), (combinations, frames))
+    net_billing_cap = np.asarray(net_billing_cap, dtype=np.float64).reshape(combinations, 1)
+    storage_capacities = np.asarray(storage_capacities, dtype=np.float64)
+    if storage_capacities.ndim == 1:
+        storage_capacities = np.broadcast_to(storage_capacities, (combinations, storage_capacities.shape[0]))
+    candidates = storage_capacities.shape[1]
+    hv_to_lv_factor = parameters['hv_to_lv_factor']
+    time_step_hours = parameters['time_step_hours']
+    dtype = np.dtype(parameters['dispatch_precision'])
+
+    demand, surplus, energy_to_be_stored, missing_energy, base_penetration = prepare_dispatch_inputs(
+        res_generation, demand, hydro_generation, net_billing_cap*time_step_hours, hv_to_lv_factor)
+    # step-major layout, so that each step reads one contiguous row
+    surplus = np.ascontiguousarray(surplus.T)
+    energy_to_be_stored = np.ascontiguousarray(energy_to_be_stored.T, dtype=dtype)
+    missing_energy = np.ascontiguousarray(missing_energy.T, dtype=dtype)
+    base_penetration = np.ascontiguousarray(np.broadcast_to(base_penetration, (combinations, frames)).T, dtype=dtype)
+
+    member_combination = np.repeat(np.arange(combinations), candidates)
+    storage_capacity = storage_capacities.reshape(-1).astype(dtype)
+    bess_power = storage_capacities.reshape(-1)/parameters['bess_duration'] # MW
+    # power limits as energy per step
+    bess_pch_max = storage_capacity*(parameters['bess_charging_rate']/100)*time_step_hours
+    bess_pdis_max = storage_capacity/parameters['bess_duration']*time_step_hours
+    bess_min_discharge_level = storage_capacity*((100-parameters['bess_depth_of_discharge'])/100)
+    bess_rte = parameters['bess_rte']
+    phs_capacity = parameters['phs_capacity']
+    phs_min_discharge_level = parameters['phs_min_discharge_level']
+    phs_rte = parameters['phs_rte']
+    phs_enabled = parameters['phs_enabled']
+
+    members = storage_capacity.shape[0]
+    soc = bess_min_discharge_level.copy()
+    phs_level = np.full(members, phs_min_discharge_level, dtype=dtype)
+    state = np.zeros(members, dtype=np.int8)
+    periods = np.zeros(members, dtype=dtype)
+    summaries = {key: np.zeros(members) for key in ['curtailment', 'RES penetration', 'energy shortage', 'battery throughput energy (MWh)']}
+    max_curtailment = np.full(members, -np.inf)
+    max_shortage = np.full(members, -np.inf)
+    max_periods = np.full(members, -np.inf)
+
+    for t in range(frames):
+        is_surplus = surplus[t][member_combination]
+        to_be_stored = energy_to_be_stored[t][member_combination]
+        missing = missing_energy[t][member_combination]
+        penetration = base_penetration[t][member_combination]
+
+        remaining_capacity = storage_capacity - soc
+        remaining_stored_energy = soc - bess_min_discharge_level
+        p_ch = np.minimum(bess_pch_max, remaining_capacity)
+        p_dis = np.minimum(bess_pdis_max, remaining_stored_energy*bess_rte*hv_to_lv_factor)
+        phs_remaining_capacity = phs_capacity - phs_level
+        phs_remaining_stored_energy = phs_level - phs_min_discharge_level
+        phs_ch = np.minimum(parameters['phs_pch_max']*time_step_hours, phs_remaining_capacity)
+        phs_dis = np.minimum(parameters['phs_pdis_max']*time_step_hours, phs_remaining_stored_energy*phs_rte*hv_to_lv_factor)
+
+        # surplus steps: batteries first
+        stored_on_surplus = np.minimum(np.minimum(to_be_stored, remaining_capacity), p_ch)
+        # deficit steps: discharge, then store the energy that cannot be netted
+        discharged = -np.minimum(np.minimum(missing, remaining_stored_energy*bess_rte*hv_to_lv_factor), p_dis)
+        discharged = np.where(is_surplus, 0.0, discharged)
+        soc_after_discharge = soc + (discharged/bess_rte)/hv_to_lv_factor
+        stored_on_deficit = np.minimum(np.minimum(to_be_stored, storage_capacity - soc_after_discharge), p_ch)
+
+        stored = np.where(is_surplus, stored_on_surplus, stored_on_deficit)
+        soc = np.where(is_surplus, soc + stored_on_surplus, soc_after_discharge + stored_on_deficit)
+        curtailed = to_be_stored - stored
+        shortage = np.where(is_surplus, 0.0, missing + discharged)
+        penetration = penetration + np.abs(discharged)
+        throughput = np.where(is_surplus, np.abs(stored_on_surplus), np.abs((discharged/bess_rte)/hv_to_lv_factor))
+
+        new_state = np.where(is_surplus, CHARGING, DISCHARGING).astype(np.int8)
+        active = np.where(is_surplus, stored_on_surplus > 0, discharged < 0)
+        periods = np.where((state == new_state) & active, periods + 1, 1.0)
+        state = new_state
+
+        # then phs
+        if phs_enabled:
+            phs_charged = np.where(is_surplus & (curtailed > 0), np.minimum(np.minimum(curtailed, phs_remaining_capacity), phs_ch), 0.0)
+            curtailed = curtailed - phs_charged
+            phs_discharged = np.where(~is_surplus & (shortage > 0), -np.minimum(np.minimum(shortage, phs_remaining_stored_energy*phs_rte*hv_to_lv_factor), phs_dis), 0.0)
+            shortage = shortage + phs_discharged
+            penetration = penetration + np.abs(phs_discharged)
+            phs_level = phs_level + phs_charged + (phs_discharged/phs_rte)/hv_to_lv_factor
+
+        summaries['curtailment'] += curtailed
+        summaries['RES penetration'] += penetration
+        summaries['energy shortage'] += shortage
+        summaries['battery throughput energy (MWh)'] += throughput
+        np.maximum(max_curtailment, curtailed, out=max_curtailment)
+        np.maximum(max_shortage, shortage, out=max_shortage)
+        np.maximum(max_periods, periods, out=max_periods)
+
+    summaries['max hourly curtailment'] = max_curtailment/time_step_hours
+    summaries['peak missing energy'] = max_shortage/time_step_hours
+    summaries['max periods since battery state change'] = max_periods
+    summaries['storage capacity'] = storage_capacities.reshape(-1)
+    summaries['bess_pdis_max'] = bess_power
+    return {key: value.reshape(combinations, candidates) for key, value in summaries.items()}
@@ -0,0 +1,45 @@
+'''Seeded Monte Carlo ensemble of demand and RES generation realizations.
+
+Like the stochastic "Option 1" of the projections, every step of a realization is the projected mean plus a
+uniform draw in [-1, 1] times the historical volatility of that step, drawn independently for demand and
+each RES technology. Demand is kept non-negative and RES generation within [0, installed capacity x step length].
+All draws come from one numpy Generator seeded once and are taken chunk by chunk as (realizations x series x
+frames) arrays, so a realization does not depend on the chunk size and only one chunk is held in memory.
+The same weather realizations are used for every res combination.'''
+import numpy as np
+
+
+class StochasticEnsemble:
+
+    def __init__(self, demand_mean, demand_volatility, profile_store, technologies, seed=None):
+        self.demand_mean = np.asarray(demand_mean, dtype=float)
+        self.demand_volatility = np.asarray(demand_volatility, dtype=float)
+        self.technologies = list(technologies)
+        # generation per MW of installed capacity, before clipping
+        self.mean_shapes = np.vstack([profile_store.mean_shapes[technology] for technology in self.technologies])
+        self.volatility_shapes = np.vstack([profile_store.volatility_shapes[technology] for technology in self.technologies])
+        self.time_step_hours = profile_store.time_step_hours
+        self.rng = np.random.default_rng(seed)
+        return
+
+    def draw(self, number_of_realizations):
+        '''Next realizations as demand (realizations x frames) and RES shapes (realizations x technologies x frames)'''
+        draws = self.rng.uniform(-1, 1, size=(number_of_realizations, 1 + len(self.technologies), self.demand_mean.shape[0]))
+        demand = np.maximum(self.demand_mean + draws[:, 0]*self.demand_volatility, 0)
+        shapes = np.clip(self.mean_shapes + draws[:, 1:]*self.volatility_shapes, 0, self.time_step_hours)
+        return demand, shapes
+
+    def chunks(self, number_of_realizations, chunk_size):
+        '''Yields (first realization, demand, shapes) for consecutive chunks of at most chunk_size realizations'''
+        chunk_size = max(int(chunk_size), 1)
+        for first_realization in range(0, number_of_realizations, chunk_size):
+            demand, shapes = self.draw(min(chunk_size, number_of_realizations - first_realization))
+            yield first_realization, demand, shapes
+
+
+def summarize_ensemble(values, percentiles=(10, 50, 90)):
+    '''Mean and percentiles over the realizations (first axis) of an ensemble metric'''
+    summary = {'mean': values.mean(axis=0)}
+    for percentile, value in zip(percentiles, np.percentile(values, percentiles, axis=0)):
+        summary['P' + str(percentile)] = value
+    return summary
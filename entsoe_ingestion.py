@@ -0,0 +1,68 @@
+'''Bulk ingestion of ENTSO-E transparency platform timeseries exports.
+
+Only the time column and the requested value columns are read. The "MTU" interval strings
+("01.01.2023 00:00 - 01.01.2023 01:00 (EET/EEST)") are parsed vectorially into the local start time of
+each interval, and the result is put on a complete regular DatetimeIndex covering the data years:
+ - rows without an interval (e.g. trailing blank rows of an export) are dropped
+ - duplicated intervals of the autumn DST change are averaged
+ - missing intervals of the spring DST change (and any other gap) are filled by time interpolation
+Values are average power over each interval (MW, equal to MWh per interval for hourly data). When a simulation
+resolution is given, finer data are averaged over each simulation step and coarser data are held constant within
+each of their intervals (e.g. hourly data on a 15-minute calendar).'''
+import pandas as pd
+from instrumentation import instrumentation
+
+MTU_FORMAT = '%d.%m.%Y %H:%M'
+
+
+def find_time_column(columns):
+    for column in columns:
+        if column.startswith('MTU') or column.startswith('Time'):
+            return column
+    raise KeyError('No MTU/Time column found in ENTSO-E file. Available columns: ' + ', '.join(columns))
+
+
+def parse_mtu(mtu):
+    '''Returns the start and end of every MTU interval string as naive local times'''
+    mtu = mtu.astype(str)
+    interval_start = pd.to_datetime(mtu.str.slice(0, 16), format=MTU_FORMAT)
+    interval_end = pd.to_datetime(mtu.str.slice(19, 35), format=MTU_FORMAT)
+    return interval_start, interval_end
+
+
+def read_entsoe_timeseries(file_path, columns, data_years, time_column=None, resolution=None):
+    '''Reads the given value columns of an ENTSO-E export in one pass.
+    Returns a float DataFrame indexed by the start of each MTU, at the resolution of the file (or the given
+    resolution), from the first hour of data_years[0] to the last interval of data_years[-1].'''
+    if time_column is None:
+        time_column = find_time_column(pd.read_csv(file_path, nrows=0).columns.tolist())
+    data = pd.read_csv(file_path, usecols=[time_column] + list(columns), header=0)
+    data = data[data[time_column].notna()]
+
+    interval_start, interval_end = parse_mtu(data[time_column])
+    file_resolution = (interval_end - interval_start).mode().iloc[0]
+    values = data[list(columns)].apply(pd.to_numeric, errors='coerce') # "n/e" and "-" entries become missing values
+    values.index = pd.DatetimeIndex(interval_start.to_numpy())
+    if values.index.has_duplicates:
+        instrumentation.log('          Averaging ' + str(values.index.duplicated().sum()) + ' duplicated intervals (DST change)', 'verbose')
+        values = values.groupby(level=0).mean()
+
+    full_index = pd.date_range(pd.Timestamp(int(data_years[0]), 1, 1), pd.Timestamp(int(data_years[-1])+1, 1, 1), freq=file_resolution, inclusive='left')
+    values = values.reindex(full_index)
+    missing_intervals = values.isna().any(axis=1).sum()
+    if missing_intervals > 0:
+        instrumentation.log('          Interpolating ' + str(missing_intervals) + ' missing intervals (DST change or gaps)', 'verbose')
+        values = values.interpolate(method='time', limit_direction='both')
+    if resolution is not None and pd.Timedelta(resolution) != file_resolution:
+        values = resample_timeseries(values, file_resolution, resolution)
+    return values.astype(float)
+
+
+def resample_timeseries(values, file_resolution, resolution):
+    '''Puts a regular timeseries of average power on the calendar of another resolution'''
+    resolution = pd.Timedelta(resolution)
+    instrumentation.log('          Resampling ' + str(int(file_resolution.total_seconds()//60)) + '-minute data to ' + str(int(resolution.total_seconds()//60)) + '-minute steps', 'verbose')
+    if resolution > file_resolution:
+        return values.resample(resolution).mean()
+    index = pd.date_range(values.index[0], values.index[-1] + file_resolution, freq=resolution, inclusive='left')
+    return values.reindex(index, method='ffill')
@@ -0,0 +1,37 @@
+'''Vectorized statistics of historical timeseries, shared by Demand_Projections and RES_Generation_Projections.
+
+Each historical year is normalized at once and the mean and volatility (sample standard deviation) of every
+(month, day, hour, minute) of the calendar year are calculated with one groupby over all years. Like the
+original per-hour loops, the calendar is the one of the latest data year: Feb-29 of earlier leap years is
+ignored when the latest year is not a leap year, and Feb-29 is removed from the returned statistics.'''
+import numpy as np
+import pandas as pd
+
+
+def normalize_years(data, normalization_factors):
+    '''Divides the values of every year by its normalization factor ({year: factor}, years not given are left as they are)'''
+    index = pd.DatetimeIndex(data.index)
+    factors = pd.Series(index.year).map(normalization_factors).fillna(1).to_numpy(dtype=float)
+    normalized_data = data.astype(float)
+    normalized_data.iloc[:,0] = normalized_data.iloc[:,0].to_numpy(dtype=float)/factors
+    return normalized_data
+
+
+def calculate_calendar_statistics(data, data_years, statistics_header_labels=('mean', 'volatility')):
+    '''Mean and volatility of each frame of the calendar year of the latest data year, over all data years (Feb-29 excluded)'''
+    index = pd.DatetimeIndex(data.index)
+    values = data.iloc[:,0].to_numpy(dtype=float)
+    in_data_years = np.isin(index.year, np.asarray(data_years))
+    index = index[in_data_years]
+    values = values[in_data_years]
+
+    grouped = pd.Series(values).groupby([index.month, index.day, index.hour, index.minute])
+    mean = grouped.mean()
+    volatility = grouped.std(ddof=1).fillna(0) # a single observation has zero volatility
+
+    latest_year_index = index[index.year == data_years[-1]]
+    latest_year_index = latest_year_index[~((latest_year_index.month == 2) & (latest_year_index.day == 29))]
+    calendar = pd.MultiIndex.from_arrays([latest_year_index.month, latest_year_index.day, latest_year_index.hour, latest_year_index.minute])
+    historical_statistics_df_non_leap = pd.DataFrame({statistics_header_labels[0]: mean.reindex(calendar).to_numpy(),
+                                                      statistics_header_labels[1]: volatility.reindex(calendar).to_numpy()}, index=latest_year_index)
+    return historical_statistics_df_non_leap
@@ -0,0 +1,249 @@
+'''Run instrumentation: console verbosity, stage timers, counters, progress bars and an optional profiler of the dispatch kernels.
+
+Model messages go through log() with a level, and verbosity in simulation_customization.xlsx selects what is printed:
+ - quiet: warnings only
+ - normal: stage messages (a few per simulated year)
+ - verbose: also the messages of every sizing iteration and projected series (the former console output)
+stage() times a block and accumulates calls, total, min and max seconds under its name. count() adds to a named
+counter (dispatch simulations, simulated hours, sizing iterations...). progress() returns a tqdm bar with throughput
+and ETA when progress_bar is set. profile_dispatch (none, cprofile or sampling) profiles every call of a dispatch
+kernel: cprofile collects deterministic call statistics, sampling records the stack of the dispatching thread every
+profile_sampling_interval (ms) from a background thread. write_report() writes stages and counters as JSON and CSV,
+and the profile next to them.
+Process pool workers reset() before a task and send their timers, counters and profile back with snapshot(), which
+the main process adds to its own with merge().'''
+import cProfile
+import contextlib
+import json
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+import pandas as pd
+from tqdm import tqdm
+
+VERBOSITY_LEVELS = ('quiet', 'normal', 'verbose')
+PROFILERS = ('none', 'cprofile', 'sampling')
+
+
+class SamplingProfiler:
+    '''Samples the function stack of the thread that enabled it at a fixed interval'''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.own_samples = Counter() # (file, first line, function) of the innermost frame -> samples
+        self.cumulative_samples = Counter() # (file, first line, function) anywhere on the stack -> samples
+        self.total_samples = 0
+        self.thread_id = None
+        self.stop_event = None
+        self.sampler = None
+        return
+
+    def enable(self):
+        self.thread_id = threading.get_ident()
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+        return
+
+    def disable(self):
+        self.stop_event.set()
+        self.sampler.join()
+        return
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.total_samples += 1
+            self.own_samples[self.get_function(frame)] += 1
+            for function in set(self.get_stack(frame)):
+                self.cumulative_samples[function] += 1
+        return
+
+    def get_function(self, frame):
+        return (frame.f_code.co_filename, frame.f_code.co_firstlineno, frame.f_code.co_name)
+
+    def get_stack(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self.get_function(frame))
+            frame = frame.f_back
+        return stack
+
+
+class _ProfileData:
+    '''Holds collected cProfile statistics, which pstats.Stats accepts like a profiler'''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        return
+
+
+class Instrumentation:
+
+    def __init__(self):
+        self.configure()
+        self.reset()
+        return
+
+    def configure(self, verbosity='verbose', progress_bar=False, profile_dispatch='none', profile_sampling_interval=5):
+        if verbosity not in VERBOSITY_LEVELS:
+            raise ValueError('verbosity must be one of ' + ', '.join(VERBOSITY_LEVELS) + ', got ' + str(verbosity))
+        if profile_dispatch not in PROFILERS:
+            raise ValueError('profile_dispatch must be one of ' + ', '.join(PROFILERS) + ', got ' + str(profile_dispatch))
+        self.settings = {'verbosity': verbosity, 'progress_bar': bool(progress_bar), 'profile_dispatch': profile_dispatch, 'profile_sampling_interval': float(profile_sampling_interval)}
+        self.verbosity = VERBOSITY_LEVELS.index(verbosity)
+        self.progress_bar = bool(progress_bar)
+        self.profile_dispatch = profile_dispatch
+        self.profile_sampling_interval = float(profile_sampling_interval)/1000
+        return
+
+    def configure_from_main(self, main):
+        '''Reads verbosity, progress_bar, profile_dispatch and profile_sampling_interval (ms) of simulation_customization.xlsx'''
+        self.configure(main.get_simulation_option('verbosity', 'verbose'), main.get_simulation_option('progress_bar', False), main.get_simulation_option('profile_dispatch', 'none'),
+                       main.get_simulation_option('profile_sampling_interval (ms)', 5))
+        return
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.stages = {} # name -> [calls, total (s), min (s), max (s)]
+        self.counters = {}
+        self.profiler = None
+        self.merged_profiles = []
+        return
+
+    def log(self, message, level='normal'):
+        if VERBOSITY_LEVELS.index(level) <= self.verbosity:
+            tqdm.write(str(message)) # keeps an open progress bar intact
+        return
+
+    def add_stage_time(self, name, seconds, calls=1, min_seconds=None, max_seconds=None):
+        min_seconds = seconds if min_seconds is None else min_seconds
+        max_seconds = seconds if max_seconds is None else max_seconds
+        if name not in self.stages:
+            self.stages[name] = [calls, seconds, min_seconds, max_seconds]
+            return
+        stage = self.stages[name]
+        self.stages[name] = [stage[0] + calls, stage[1] + seconds, min(stage[2], min_seconds), max(stage[3], max_seconds)]
+        return
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+        return
+
+    @contextlib.contextmanager
+    def profile(self):
+        if self.profile_dispatch == 'none':
+            yield
+            return
+        if self.profiler is None:
+            self.profiler = cProfile.Profile() if self.profile_dispatch == 'cprofile' else SamplingProfiler(self.profile_sampling_interval)
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    @contextlib.contextmanager
+    def dispatch(self, simulations, simulated_hours):
+        '''Counts, times and (with profile_dispatch) profiles one call of a dispatch kernel'''
+        self.count('dispatch simulations', simulations)
+        self.count('simulated hours', simulated_hours)
+        with self.stage('dispatch kernel'), self.profile():
+            yield
+
+    def progress(self, total, description, unit='res combination'):
+        bar = tqdm(total=total, desc=description, unit=unit, disable=not self.progress_bar, leave=False, dynamic_ncols=True)
+        bar.initial_simulated_hours = self.counters.get('simulated hours', 0)
+        return bar
+
+    def advance(self, bar, steps=1):
+        '''Moves a progress bar forward and shows the simulated hours per second since it was opened'''
+        if not bar.disable:
+            simulated_hours = self.counters.get('simulated hours', 0) - bar.initial_simulated_hours
+            bar.set_postfix_str(str(int(simulated_hours/max(bar.format_dict['elapsed'], 1e-9))) + ' simulated h/s', refresh=False)
+        bar.update(steps)
+        return
+
+    def get_profile_data(self):
+        if self.profile_dispatch == 'cprofile':
+            profiles = [stats for profile in self.merged_profiles for stats in profile.get('cprofile', [])]
+            if self.profiler is not None:
+                self.profiler.create_stats()
+                profiles = [self.profiler.stats] + profiles
+            return {'cprofile': profiles} if len(profiles) > 0 else {}
+        if self.profile_dispatch == 'sampling':
+            own_samples, cumulative_samples, total_samples = Counter(), Counter(), 0
+            for profile in self.merged_profiles + ([{'own': self.profiler.own_samples, 'cumulative': self.profiler.cumulative_samples, 'total': self.profiler.total_samples}] if self.profiler is not None else []):
+                own_samples.update(profile['own'])
+                cumulative_samples.update(profile['cumulative'])
+                total_samples += profile['total']
+            return {'own': own_samples, 'cumulative': cumulative_samples, 'total': total_samples}
+        return {}
+
+    def snapshot(self):
+        '''Timers, counters and profile collected since the last reset(), to be merged into the main process'''
+        return {'stages': self.stages, 'counters': self.counters, 'profile': self.get_profile_data()}
+
+    def merge(self, snapshot):
+        for name, (calls, seconds, min_seconds, max_seconds) in snapshot['stages'].items():
+            self.add_stage_time(name, seconds, calls, min_seconds, max_seconds)
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+        if len(snapshot['profile']) > 0:
+            self.merged_profiles.append(snapshot['profile'])
+        return
+
+    def get_report(self):
+        stages = {name: {'calls': calls, 'total (s)': seconds, 'mean (s)': seconds/calls, 'min (s)': min_seconds, 'max (s)': max_seconds} for name, (calls, seconds, min_seconds, max_seconds) in self.stages.items()}
+        report = {'wall time (s)': time.perf_counter() - self.start_time, 'settings': self.settings, 'stages': stages, 'counters': dict(self.counters)}
+        if 'dispatch kernel' in self.stages and self.stages['dispatch kernel'][1] > 0:
+            report['simulated hours per dispatch second'] = self.counters.get('simulated hours', 0)/self.stages['dispatch kernel'][1]
+        cache_lookups = self.counters.get('dispatch cache hits', 0) + self.counters.get('dispatch cache misses', 0)
+        if cache_lookups > 0:
+            report['dispatch cache hit rate (%)'] = 100*self.counters.get('dispatch cache hits', 0)/cache_lookups
+        return report
+
+    def write_report(self, file_path):
+        '''Writes file_path.json, file_path.csv and, when profiling, the dispatch profile (file_path - dispatch profile.*)'''
+        report = self.get_report()
+        with open(file_path + '.json', 'w') as file:
+            json.dump(report, file, indent=2, default=float)
+        rows = [{'kind': 'stage', 'name': name, **values} for name, values in report['stages'].items()]
+        rows += [{'kind': 'counter', 'name': name, 'value': value} for name, value in report['counters'].items()]
+        rows += [{'kind': 'total', 'name': 'wall time (s)', 'value': report['wall time (s)']}]
+        pd.DataFrame(rows, columns=['kind', 'name', 'calls', 'total (s)', 'mean (s)', 'min (s)', 'max (s)', 'value']).astype({'calls': 'Int64'}).to_csv(file_path + '.csv', index=False)
+        profile = self.get_profile_data()
+        if 'cprofile' in profile:
+            statistics = pstats.Stats(_ProfileData(profile['cprofile'][0]))
+            for stats in profile['cprofile'][1:]:
+                statistics.add(_ProfileData(stats))
+            statistics.dump_stats(file_path + ' - dispatch profile.prof')
+            with open(file_path + ' - dispatch profile.txt', 'w') as file:
+                statistics.stream = file
+                statistics.sort_stats('cumulative').print_stats(40)
+        elif 'own' in profile and profile['total'] > 0:
+            functions = list(profile['cumulative'].keys())
+            pd.DataFrame({'file': [function[0] for function in functions], 'line': [function[1] for function in functions], 'function': [function[2] for function in functions],
+                          'own samples (%)': [100*profile['own'][function]/profile['total'] for function in functions],
+                          'cumulative samples (%)': [100*profile['cumulative'][function]/profile['total'] for function in functions]}
+                         ).sort_values('cumulative samples (%)', ascending=False).to_csv(file_path + ' - dispatch profile.csv', index=False)
+        self.log('     Run report written to ' + file_path + '.json')
+        return
+
+
+# One instance per process, shared by every module of the model
+instrumentation = Instrumentation()
@@ -1,26 +1,75 @@
+import numpy as np
 import pandas as pd
-from pyDOE import lhs
+from scipy.stats import qmc
+from scipy.spatial import cKDTree
+from instrumentation import instrumentation
 
 
 class LHS:
-    
-    def __init__(self):
-        
+    '''Space-filling designs of the RES capacity space.
+    Methods:
+      maximin   - best of maximin_iterations random latin hypercubes by minimum pairwise distance (the former pyDOE criterion)
+      lhs       - a single random latin hypercube
+      optimized - latin hypercube optimized for centered discrepancy (scipy random-cd, slow beyond a few thousand samples)
+      sobol     - scrambled Sobol sequence
+      halton    - scrambled Halton sequence'''
+
+    sampling_methods = ('maximin', 'lhs', 'optimized', 'sobol', 'halton')
+    discrepancy_sample_limit = 5000 # the centered discrepancy costs O(samples^2), it is skipped for larger designs
+
+    def __init__(self, method='maximin', maximin_iterations=5):
+        if method not in self.sampling_methods:
+            raise ValueError('Sampling method must be one of ' + ', '.join(self.sampling_methods) + ', got ' + str(method))
+        self.method = method
+        self.maximin_iterations = max(int(maximin_iterations), 1)
+        self.quality = {}
         return
-    
-    def rescale(self, column, params, index):
-        interval = params[index]
-        return column * (max(interval[1:]) - min(interval[1:])) + min(interval[1:])
-    
-    def sample(self, number_of_samples, sampling_ranges):
-        num_samples = number_of_samples #Set parametrwn pou theloume
+
+    def rescale(self, design, sampling_ranges):
+        # every range is [name, bound, bound, ...], samples are spread between the smallest and the largest bound
+        lower_bounds = np.array([min(sampling_range[1:]) for sampling_range in sampling_ranges], dtype=float)
+        upper_bounds = np.array([max(sampling_range[1:]) for sampling_range in sampling_ranges], dtype=float)
+        return lower_bounds + design*(upper_bounds - lower_bounds)
+
+    def latin_hypercube(self, number_of_samples, dimensions, rng):
+        # one random permutation of the strata per dimension, jittered inside each stratum
+        strata = rng.permuted(np.tile(np.arange(number_of_samples), (dimensions, 1)), axis=1).T
+        return (strata + rng.random((number_of_samples, dimensions)))/number_of_samples
+
+    def minimum_distance(self, design):
+        if design.shape[0] < 2:
+            return np.nan
+        distances, neighbours = cKDTree(design).query(design, k=2)
+        return distances[:,1].min()
+
+    def get_unit_design(self, number_of_samples, dimensions, seed=None):
+        rng = np.random.default_rng(seed)
+        if self.method == 'lhs':
+            return self.latin_hypercube(number_of_samples, dimensions, rng)
+        if self.method == 'maximin':
+            designs = [self.latin_hypercube(number_of_samples, dimensions, rng) for iteration in range(self.maximin_iterations)]
+            return max(designs, key=self.minimum_distance)
+        if self.method == 'optimized':
+            return qmc.LatinHypercube(d=dimensions, optimization='random-cd', seed=rng).random(number_of_samples)
+        if self.method == 'sobol':
+            sampler = qmc.Sobol(d=dimensions, scramble=True, seed=rng)
+            if number_of_samples & (number_of_samples - 1) == 0:
+                return sampler.random_base2(int(np.log2(number_of_samples)))
+            return sampler.random(2**int(np.ceil(np.log2(number_of_samples))))[:number_of_samples] # balance properties hold for powers of 2 only
+        return qmc.Halton(d=dimensions, scramble=True, seed=rng).random(number_of_samples)
+
+    def get_quality(self, design):
+        '''Space-filling quality of a unit design: centered L2 discrepancy (lower is better) and minimum pairwise distance (higher is better)'''
+        quality = {'minimum distance': self.minimum_distance(design), 'centered discrepancy': np.nan}
+        if 1 < design.shape[0] <= self.discrepancy_sample_limit:
+            quality['centered discrepancy'] = qmc.discrepancy(design, method='CD')
+        return quality
+
+    def sample(self, number_of_samples, sampling_ranges, seed=None):
         params = sampling_ranges
+        design = self.get_unit_design(int(number_of_samples), len(params), seed)
+        self.quality = self.get_quality(design)
+        instrumentation.log('     Sampled ' + str(int(number_of_samples)) + ' res combinations with ' + self.method + ' design (minimum distance ' + str(round(self.quality['minimum distance'], 4)) + ', centered discrepancy ' + str(round(self.quality['centered discrepancy'], 6)) + ')')
 
-        design = lhs(len(params), samples=num_samples, criterion='maximin') #Latin-Hypercube me maximin criterion
-        
-        for i in range(len(params)):
-            design[:, i] = self.rescale(design[:, i], params, i)
-        
-        output_df = pd.DataFrame(design, columns=[sublist[0] for sublist in params])
-        # output_df.to_csv('res_capacity_sampling.csv', sep=',')
-        return output_df
\ No newline at end of file
+        output_df = pd.DataFrame(self.rescale(design, params), columns=[sublist[0] for sublist in params])
+        return output_df
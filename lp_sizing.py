@@ -0,0 +1,137 @@
+'''Perfect-foresight linear program that sizes the battery of one res combination in a single solve.
+
+The storage-independent quantities of the dispatch kernel (energy that cannot be netted, missing energy and the
+directly covered demand of every step) are the inputs. The variables are the battery capacity C and, for every
+step, the stored energy, the delivered energy and the state of charge, plus the same three series of PHS (at its
+fixed capacity) when it is enabled. The constraints are those of update_bess_specifications and the kernel:
+ - state of charge between C*(100-depth_of_discharge)/100 and C, starting from the lower limit
+ - stored energy up to C*charging rate (%)/100 per hour, delivered energy up to C/duration per hour
+ - stored energy is counted 1:1, delivered energy costs 1/(round trip efficiency x HV to LV factor)
+ - only the energy that cannot be netted (net-billing cap and surplus) can be stored, only missing energy delivered
+The objective is the smallest C that reaches the RES penetration or curtailment target. Storage is scheduled with
+perfect foresight instead of the greedy rules of the kernel, so C is a lower bound of the simulated sizing.
+Energies are scaled to the mean demand before the solve to keep HiGHS within its tolerances.'''
+import numpy as np
+from scipy import sparse
+from scipy.optimize import linprog
+
+
+def _dynamics(steps, efficiency, first_column, columns, rows_offset=0):
+    '''COO entries of state(t) - state(t-1) - stored(t) + delivered(t)/efficiency = 0 for the (stored, delivered, state) block starting at first_column'''
+    t = np.arange(steps)
+    stored, delivered, state = first_column + t, first_column + steps + t, first_column + 2*steps + t
+    rows = np.concatenate([t, t, t, t[1:]]) + rows_offset
+    cols = np.concatenate([state, stored, delivered, state[:-1]])
+    values = np.concatenate([np.ones(steps), -np.ones(steps), np.full(steps, 1/efficiency), -np.ones(steps - 1)])
+    return rows, cols, values
+
+
+def build_storage_lp(energy_to_be_stored, missing_energy, base_penetration, parameters, target, target_threshold, total_res_generation, total_demand):
+    '''Vectorized sparse assembly of the sizing program. Returns the linprog arguments and the column of every variable block'''
+    steps = energy_to_be_stored.shape[0]
+    time_step_hours = parameters['time_step_hours']
+    phs_enabled = parameters['phs_enabled'] and parameters['phs_capacity'] > 0
+    t = np.arange(steps)
+    columns = {'capacity': 0, 'stored': 1, 'delivered': 1 + steps, 'soc': 1 + 2*steps}
+    variables = 1 + 3*steps
+    if phs_enabled:
+        columns.update({'phs stored': variables, 'phs delivered': variables + steps, 'phs soc': variables + 2*steps})
+        variables += 3*steps
+    min_soc_ratio = (100 - parameters['bess_depth_of_discharge'])/100
+
+    # state of charge recurrences (the battery starts at C*min_soc_ratio, PHS at its minimum discharge level)
+    rows, cols, values = _dynamics(steps, parameters['bess_rte']*parameters['hv_to_lv_factor'], columns['stored'], variables)
+    rows, cols, values = np.append(rows, 0), np.append(cols, columns['capacity']), np.append(values, -min_soc_ratio)
+    b_eq = np.zeros(steps)
+    if phs_enabled:
+        phs_rows, phs_cols, phs_values = _dynamics(steps, parameters['phs_rte']*parameters['hv_to_lv_factor'], columns['phs stored'], variables, rows_offset=steps)
+        rows, cols, values = np.concatenate([rows, phs_rows]), np.concatenate([cols, phs_cols]), np.concatenate([values, phs_values])
+        b_eq = np.concatenate([b_eq, np.zeros(steps)])
+        b_eq[steps] = parameters['phs_min_discharge_level']
+    A_eq = sparse.coo_matrix((values, (rows, cols)), shape=(b_eq.shape[0], variables)).tocsr()
+
+    # capacity-dependent limits: soc <= C, C*min_soc_ratio <= soc, stored <= C*charging rate, delivered <= C/duration (per step)
+    limits = [(columns['soc'], 1.0, -1.0), (columns['soc'], -1.0, min_soc_ratio),
+              (columns['stored'], 1.0, -(parameters['bess_charging_rate']/100)*time_step_hours), (columns['delivered'], 1.0, -time_step_hours/parameters['bess_duration'])]
+    rows, cols, values = [], [], []
+    for block, (first_column, sign, capacity_coefficient) in enumerate(limits):
+        rows += [block*steps + t, block*steps + t]
+        cols += [first_column + t, np.zeros(steps, dtype=int)]
+        values += [np.full(steps, sign), np.full(steps, capacity_coefficient)]
+    b_ub = [np.zeros(4*steps)]
+    upper_stored, upper_delivered = energy_to_be_stored, missing_energy
+    next_row = 4*steps
+    if phs_enabled:
+        # battery and PHS share the energy that cannot be netted and the missing energy
+        for battery_column, phs_column, limit in [(columns['stored'], columns['phs stored'], energy_to_be_stored), (columns['delivered'], columns['phs delivered'], missing_energy)]:
+            rows += [next_row + t, next_row + t]
+            cols += [battery_column + t, phs_column + t]
+            values += [np.ones(steps), np.ones(steps)]
+            b_ub.append(limit)
+            next_row += steps
+    # target
+    if target == 'demand':
+        # RES penetration = covered demand + delivered energy >= threshold x demand
+        target_columns = [columns['delivered']] + ([columns['phs delivered']] if phs_enabled else [])
+        b_ub.append([base_penetration.sum() - (target_threshold/100)*total_demand])
+    else:
+        # curtailment = energy that cannot be netted - stored energy <= threshold x RES generation
+        target_columns = [columns['stored']] + ([columns['phs stored']] if phs_enabled else [])
+        b_ub.append([(target_threshold/100)*total_res_generation - energy_to_be_stored.sum()])
+    for first_column in target_columns:
+        rows.append(np.full(steps, next_row))
+        cols.append(first_column + t)
+        values.append(-np.ones(steps))
+    A_ub = sparse.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(next_row + 1, variables)).tocsr()
+
+    lower, upper = np.zeros(variables), np.full(variables, np.inf)
+    upper[columns['stored']:columns['stored'] + steps] = upper_stored
+    upper[columns['delivered']:columns['delivered'] + steps] = upper_delivered
+    if phs_enabled:
+        upper[columns['phs stored']:columns['phs stored'] + steps] = np.minimum(energy_to_be_stored, parameters['phs_pch_max']*time_step_hours)
+        upper[columns['phs delivered']:columns['phs delivered'] + steps] = np.minimum(missing_energy, parameters['phs_pdis_max']*time_step_hours)
+        lower[columns['phs soc']:columns['phs soc'] + steps] = parameters['phs_min_discharge_level']
+        upper[columns['phs soc']:columns['phs soc'] + steps] = parameters['phs_capacity']
+    objective = np.zeros(variables)
+    objective[columns['capacity']] = 1.0
+    return {'c': objective, 'A_ub': A_ub, 'b_ub': np.concatenate([np.ravel(b) for b in b_ub]), 'A_eq': A_eq, 'b_eq': b_eq, 'bounds': np.column_stack([lower, upper])}, columns
+
+
+def solve_lp_storage_capacity(energy_to_be_stored, missing_energy, base_penetration, parameters, target, target_threshold, total_res_generation, total_demand):
+    '''Smallest battery capacity that reaches target_threshold (%) with perfect foresight, and the metrics of its schedule.
+    Returns a dictionary like solve_storage_capacity of sizing_solver, with the schedule and metrics added. Its iterations
+    are those of HiGHS, not dispatch simulations'''
+    scale = max(float(np.mean(base_penetration + missing_energy)), 1e-12)
+    scaled_parameters = dict(parameters)
+    scaled_parameters['phs_capacity'] = parameters['phs_capacity']/scale
+    scaled_parameters['phs_min_discharge_level'] = parameters['phs_min_discharge_level']/scale
+    scaled_parameters['phs_pch_max'] = parameters['phs_pch_max']/scale
+    scaled_parameters['phs_pdis_max'] = parameters['phs_pdis_max']/scale
+    program, columns = build_storage_lp(energy_to_be_stored/scale, missing_energy/scale, base_penetration/scale, scaled_parameters, target, target_threshold, total_res_generation/scale, total_demand/scale)
+    solution = linprog(method='highs', **program)
+    result = {'storage_capacity': np.nan, 'iterations': int(getattr(solution, 'nit', 0) or 0), 'converged': solution.status == 0, 'message': solution.message}
+    if solution.status != 0:
+        return result
+    steps = energy_to_be_stored.shape[0]
+    x = solution.x*scale
+
+    def block(name):
+        if name not in columns:
+            return np.zeros(steps)
+        return np.maximum(x[columns[name]:columns[name] + steps], 0)
+
+    stored, delivered = block('stored'), block('delivered')
+    curtailment = np.maximum(energy_to_be_stored - stored - block('phs stored'), 0)
+    shortage = np.maximum(missing_energy - delivered - block('phs delivered'), 0)
+    res_penetration = base_penetration + delivered + block('phs delivered')
+    result.update({
+        'storage_capacity': max(float(x[columns['capacity']]), 0.0),
+        'schedule': {'stored': stored, 'delivered': delivered, 'soc': block('soc'), 'curtailment': curtailment, 'energy shortage': shortage, 'RES penetration': res_penetration},
+        'battery throughput energy (MWh)': stored.sum() + (delivered/(parameters['bess_rte']*parameters['hv_to_lv_factor'])).sum(),
+        'curtailment': curtailment.sum(),
+        'RES penetration': res_penetration.sum(),
+        'energy shortage': shortage.sum(),
+        'max hourly curtailment': curtailment.max()/parameters['time_step_hours'],
+        'peak missing energy': shortage.max()/parameters['time_step_hours'],
+        })
+    return result
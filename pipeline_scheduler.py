@@ -0,0 +1,86 @@
+'''Dependency-driven scheduler of the per-year pipeline stages.
+
+Every (year, stage) is a task with explicit dependencies on other tasks. A task receives its own arguments
+followed by the results of its dependencies, in the order the dependencies are given. Tasks whose
+dependencies are complete are submitted to a bounded process pool in the order they were added, so
+independent years run concurrently while the stages of one year keep their order. With one worker the
+tasks run in the calling process, one after the other, exactly like a plain loop. Timers and counters that
+tasks collect in a worker process are merged into the instrumentation of the calling process.'''
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from instrumentation import instrumentation
+
+
+def _run_task(function, *args):
+    '''Runs a task in a worker process and returns its result with the instrumentation it collected'''
+    instrumentation.reset()
+    result = function(*args)
+    return result, instrumentation.snapshot()
+
+
+class PipelineScheduler:
+
+    def __init__(self, max_workers=1, initializer=None, initargs=()):
+        self.max_workers = max(int(max_workers), 1)
+        self.initializer = initializer # prepares the state shared by the tasks in every worker process
+        self.initargs = initargs
+        self.tasks = {} # name -> (function, args, dependencies), in insertion order
+        self.results = {}
+        return
+
+    def add_task(self, name, function, *args, dependencies=()):
+        if name in self.tasks:
+            raise ValueError('Task ' + str(name) + ' was already added')
+        self.tasks[name] = (function, args, tuple(dependencies))
+        return name
+
+    def get_execution_order(self):
+        '''Topological order of the tasks, ties broken by insertion order'''
+        for name, (function, args, dependencies) in self.tasks.items():
+            unknown_dependencies = [dependency for dependency in dependencies if dependency not in self.tasks]
+            if len(unknown_dependencies) > 0:
+                raise KeyError('Task ' + str(name) + ' depends on unknown tasks ' + str(unknown_dependencies))
+        execution_order = []
+        completed = set()
+        while len(execution_order) < len(self.tasks):
+            ready = [name for name, (function, args, dependencies) in self.tasks.items() if name not in completed and all(dependency in completed for dependency in dependencies)]
+            if len(ready) == 0:
+                raise ValueError('Circular dependencies between tasks ' + str([name for name in self.tasks if name not in completed]))
+            execution_order.append(ready[0])
+            completed.add(ready[0])
+        return execution_order
+
+    def get_arguments(self, name):
+        function, args, dependencies = self.tasks[name]
+        return args + tuple(self.results[dependency] for dependency in dependencies)
+
+    def run(self):
+        '''Runs all tasks and returns {task name: result}'''
+        execution_order = self.get_execution_order()
+        if self.max_workers == 1:
+            if self.initializer is not None:
+                self.initializer(*self.initargs)
+            for name in execution_order:
+                self.results[name] = self.tasks[name][0](*self.get_arguments(name))
+            return self.results
+
+        instrumentation.log('     Scheduling ' + str(len(self.tasks)) + ' tasks on ' + str(self.max_workers) + ' processes')
+        pending = list(execution_order)
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer, initargs=self.initargs) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                ready = [name for name in pending if all(dependency in self.results for dependency in self.tasks[name][2])]
+                for name in ready:
+                    pending.remove(name)
+                    running[executor.submit(_run_task, self.tasks[name][0], *self.get_arguments(name))] = name
+                done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name], task_instrumentation = future.result()
+                        instrumentation.merge(task_instrumentation)
+                    except Exception:
+                        for other_future in not_done:
+                            other_future.cancel()
+                        instrumentation.log('     Task ' + str(name) + ' failed', 'quiet')
+                        raise
+        return self.results
@@ -0,0 +1,68 @@
+'''In-memory store of normalized RES generation profiles.
+
+Every projected profile is the historical mean shape of a technology scaled by capacity/historical capacity
+and clipped to [0, capacity]. Since capacities are non-negative this equals capacity * clip(shape, 0, 1), so
+one normalized shape per technology is enough to produce the generation of any res combination, and the
+aggregated generation of a whole sample set is a single matrix product.
+Historical statistics are average power (MW), shapes are energy per simulation step (MWh per MW installed), i.e.
+the clipped capacity factor times the step length in hours.'''
+import numpy as np
+import pandas as pd
+from instrumentation import instrumentation
+
+
+class RESProfileStore:
+
+    def __init__(self, time_step_hours=1.0):
+        self.time_step_hours = float(time_step_hours)
+        self.technologies = []
+        self.shapes = {} # technology -> generation per MW of installed capacity, within [0, time_step_hours]
+        self.mean_shapes = {} # technology -> historical mean generation per MW of installed capacity, before clipping
+        self.volatility_shapes = {} # technology -> historical volatility per MW of installed capacity
+        self.generation_labels = {} # technology -> column label of the generation files
+        self.calendar = None # (month, day, hour, minute) of every simulated frame
+        return
+
+    def add_technology(self, technology, historical_statistics_df_non_leap, historical_capacity, generation_label):
+        mean_generation = historical_statistics_df_non_leap.iloc[:,0].to_numpy(dtype=float)
+        volatility = historical_statistics_df_non_leap.iloc[:,1].to_numpy(dtype=float)
+        if historical_capacity > 0:
+            self.mean_shapes[technology] = (mean_generation/historical_capacity)*self.time_step_hours
+            self.volatility_shapes[technology] = (volatility/historical_capacity)*self.time_step_hours
+        else:
+            instrumentation.log('          Historical capacity of ' + technology + ' is zero, its projected generation is set to zero. Please check!', 'quiet')
+            self.mean_shapes[technology] = np.zeros(mean_generation.shape[0])
+            self.volatility_shapes[technology] = np.zeros(mean_generation.shape[0])
+        self.shapes[technology] = np.clip(self.mean_shapes[technology], 0, self.time_step_hours)
+        self.generation_labels[technology] = generation_label
+        if technology not in self.technologies:
+            self.technologies.append(technology)
+        if self.calendar is None:
+            index = pd.DatetimeIndex(historical_statistics_df_non_leap.index)
+            self.calendar = pd.DataFrame({'month': index.month, 'day': index.day, 'hour': index.hour, 'minute': index.minute})
+        return
+
+    def get_index(self, year):
+        '''Frames of the simulated year (Feb-29 excluded), aligned with the stored shapes'''
+        calendar = self.calendar.copy()
+        calendar.insert(0, 'year', year)
+        return pd.DatetimeIndex(pd.to_datetime(calendar))
+
+    def get_shape_matrix(self, technologies):
+        return np.vstack([self.shapes[technology] for technology in technologies])
+
+    def technology_generation(self, technology, capacity):
+        return capacity*self.shapes[technology]
+
+    def res_generation(self, year, res_capacities):
+        '''Per-technology generation of one res combination, in the same format as the generation files of res_data/calculated'''
+        index = self.get_index(year)
+        res_generation = {}
+        for technology in res_capacities.index:
+            res_generation[technology] = pd.DataFrame(self.technology_generation(technology, float(res_capacities[technology])), index=index, columns=[self.generation_labels[technology]])
+        return res_generation
+
+    def aggregated_generation(self, sampled_res_capacities):
+        '''(combinations x frames) aggregated generation of a whole sample set as one matrix product'''
+        technologies = list(sampled_res_capacities.columns)
+        return sampled_res_capacities.to_numpy(dtype=float) @ self.get_shape_matrix(technologies)
@@ -0,0 +1,225 @@
+'''Batch runs of many scenario variants in one process, without interactive steps.
+
+A JSON manifest lists the variants. Settings of "base" apply to every scenario and those of a scenario replace them:
+
+    {"base": {"mode": "res_and_storage_sizing", "years": [2030], "simulation": {"verbosity": "quiet", "run_report": false}},
+     "scenarios": [{"name": "reference"},
+                   {"name": "long battery", "storage": {"battery": {"duration": 8}}, "economics": {"CC-bess (€/MWh)": 90000}},
+                   {"name": "targets", "grid": {"simulation/target_threshold (%)": [60, 70, 80], "storage/battery/duration": [2, 4]}}]}
+
+ - mode: streem_mode of the run, years: its simulation years (simulation_years.xlsx by default)
+ - simulation: rows of simulation_customization.xlsx (a list sets several rows, like storage_technology)
+ - storage: {technology: {row of <technology>_characteristics.xlsx: value}}
+ - economics: rows of technoeconomic_assumptions.xlsx
+ - grid: one variant per combination of the listed values, keyed by "mode", "years", "simulation/<option>",
+   "storage/<technology>/<row>" or "economics/<row>"
+Historical demand and RES statistics are preprocessed once per simulation resolution and shared by all variants, and
+compiled dispatch kernels stay loaded between them. Every variant writes its results to its own folder (data/results/
+scenarios/<name>/ by default) and a summary of all variants is written to scenario summary.xlsx after each of them:
+
+    python scenario_runner.py manifest.json
+    python scenario_runner.py manifest.json --only reference "long battery" --dry-run
+
+The model modules are imported on first use, so listing and checking a manifest starts fast.'''
+import argparse
+import copy
+import itertools
+import json
+import os
+import sys
+import time
+
+SECTIONS = ('simulation', 'storage', 'economics')
+INVALID_NAME_CHARACTERS = '<>:"/\\|?*'
+
+
+def load_manifest(file_path):
+    with open(file_path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def merge_settings(base, scenario):
+    '''Settings of a scenario on top of those of base (storage is merged per technology)'''
+    settings = copy.deepcopy(base)
+    for key, value in scenario.items():
+        if key == 'storage':
+            for technology, specifications in value.items():
+                settings.setdefault('storage', {}).setdefault(technology, {}).update(specifications)
+        elif key in SECTIONS:
+            settings.setdefault(key, {}).update(value)
+        else:
+            settings[key] = copy.deepcopy(value)
+    return settings
+
+
+def set_grid_value(settings, key, value):
+    if key in ('mode', 'years'):
+        settings[key] = value
+        return
+    section = key.split('/', 1)[0]
+    if section == 'storage' and key.count('/') >= 2:
+        _, technology, specification = key.split('/', 2)
+        settings.setdefault('storage', {}).setdefault(technology, {})[specification] = value
+    elif section in ('simulation', 'economics') and '/' in key:
+        settings.setdefault(section, {})[key.split('/', 1)[1]] = value
+    else:
+        raise ValueError('Grid keys must be mode, years, simulation/<option>, storage/<technology>/<row> or economics/<row>, got ' + str(key))
+    return
+
+
+def expand_scenarios(manifest):
+    '''Settings of every variant of the manifest, as dictionaries with name, mode, years, simulation, storage and economics'''
+    base = merge_settings({'mode': 'res_and_storage_sizing', 'years': None, 'simulation': {}, 'storage': {}, 'economics': {}}, manifest.get('base', {}))
+    scenarios = []
+    for number, scenario in enumerate(manifest.get('scenarios', [{}])):
+        scenario = dict(scenario)
+        name = str(scenario.pop('name', 'scenario ' + str(number)))
+        grid = scenario.pop('grid', {})
+        settings = merge_settings(base, scenario)
+        keys = list(grid.keys())
+        for values in itertools.product(*[grid[key] for key in keys]):
+            variant = copy.deepcopy(settings)
+            for key, value in zip(keys, values):
+                set_grid_value(variant, key, value)
+            variant['name'] = name if len(keys) == 0 else name + ' - ' + ', '.join(key.split('/')[-1] + '=' + str(value) for key, value in zip(keys, values))
+            scenarios.append(variant)
+    names = [scenario['name'] for scenario in scenarios]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if len(duplicates) > 0:
+        raise ValueError('Scenario names must be unique, repeated: ' + ', '.join(duplicates))
+    return scenarios
+
+
+def get_folder_name(name):
+    return ''.join('_' if character in INVALID_NAME_CHARACTERS else character for character in name).strip(' .')
+
+
+class ScenarioRunner:
+
+    def __init__(self, manifest, results_path=None):
+        self.manifest = manifest
+        self.scenarios = expand_scenarios(manifest)
+        if results_path is None:
+            results_path = manifest.get('results_path', os.path.join(os.getcwd(), 'data', 'results', 'scenarios'))
+        self.results_path = os.path.join(os.path.abspath(results_path), '')
+        self.projections = {} # simulation resolution -> (Demand_Projections, RES_Generation_Projections)
+        self.summary = []
+        return
+
+    def get_projections(self, main):
+        '''Preprocessed demand and RES projections of the simulation resolution of main, computed on first use'''
+        from streem import preprocess
+        resolution = main.get_simulation_resolution()
+        if resolution not in self.projections:
+            self.projections[resolution] = preprocess(main)
+        return self.projections[resolution]
+
+    def create_main(self, scenario):
+        from streem import Main
+        return Main(scenario['mode'], scenario['years'], scenario['simulation'], results_path=self.results_path + get_folder_name(scenario['name']) + '/')
+
+    def apply_specifications(self, specifications, overrides, description):
+        for name, value in overrides.items():
+            if name not in specifications.index:
+                raise ValueError(str(name) + ' is not a row of ' + description)
+            specifications.loc[name, 'value'] = value
+        return
+
+    def run_scenario(self, scenario):
+        '''Runs one variant on the shared preprocessing. Returns {year: output_df} like streem.run'''
+        from streem import run
+        from storage_v02 import StorageSimulations
+        from technoeconomic_calculations import TechnoeconomicCalculations
+        from instrumentation import instrumentation
+        main = self.create_main(scenario)
+        os.makedirs(main.results_path, exist_ok=True)
+        instrumentation.configure_from_main(main)
+        demand_projections, res_generation_projections = self.get_projections(main)
+        instrumentation.reset() # the run report of the variant covers its own run only
+        storage = StorageSimulations(main, res_generation_projections.profile_store)
+        technoeconomic_calculations = TechnoeconomicCalculations(main)
+        for technology, overrides in scenario['storage'].items():
+            if technology not in storage.storage_specifications:
+                raise ValueError(str(technology) + ' is not a storage_technology of the scenario')
+            self.apply_specifications(storage.storage_specifications[technology], overrides, technology + '_characteristics.xlsx')
+            self.apply_specifications(technoeconomic_calculations.storage_specifications[technology], overrides, technology + '_characteristics.xlsx')
+        self.apply_specifications(technoeconomic_calculations.technoeconomic_assumptions, scenario['economics'], technoeconomic_calculations.technoeconomic_assumptions_file)
+        with open(main.results_path + 'scenario.json', 'w', encoding='utf-8') as file:
+            json.dump(scenario, file, indent=2, ensure_ascii=False, default=str)
+        return run(main, demand_projections, res_generation_projections, storage, technoeconomic_calculations)
+
+    def summarize(self, scenario, year, output_df, run_time):
+        '''One summary row of a simulated year of a variant'''
+        row = {'scenario': scenario['name'], 'mode': scenario['mode'], 'year': year, 'status': 'completed', 'run time (s)': run_time, 'res combinations': len(output_df.index)}
+        if 'battery_capacity (MWh)' in output_df.columns:
+            sized = output_df[output_df['battery_capacity (MWh)'].notna()]
+            row['sized res combinations'] = len(sized.index)
+            row['median battery_capacity (MWh)'] = sized['battery_capacity (MWh)'].median()
+        if scenario['mode'] == 'res_and_storage_dispatch':
+            row['mean degraded_battery_capacity (MWh)'] = output_df['degraded_battery_capacity (MWh)'].mean()
+        if 'EAC/MWh (€/MWh)' in output_df.columns and output_df['EAC/MWh (€/MWh)'].notna().any():
+            best = output_df.loc[output_df['EAC/MWh (€/MWh)'].astype(float).idxmin()]
+            row['min EAC/MWh (€/MWh)'] = best['EAC/MWh (€/MWh)']
+            for column in ['pv capacity (MW)', 'wind capacity (MW)', 'hydro capacity (MW)', 'battery_capacity (MWh)', 'RES penetration (%)', 'curtailment (%)']:
+                row['least-cost ' + column] = best[column]
+        return row
+
+    def write_summary(self):
+        import pandas as pd
+        summary_df = pd.DataFrame(self.summary)
+        os.makedirs(self.results_path, exist_ok=True)
+        summary_df.to_excel(self.results_path + 'scenario summary.xlsx', index=False)
+        return summary_df
+
+    def run(self, names=None, stop_on_error=False):
+        '''Runs the variants (all, or those in names) one after the other. A failed variant is recorded in the summary and
+        the next one starts, unless stop_on_error. Returns the summary as a DataFrame'''
+        from instrumentation import instrumentation
+        scenarios = self.scenarios if names is None else [scenario for scenario in self.scenarios if scenario['name'] in names]
+        self.summary = []
+        for number, scenario in enumerate(scenarios):
+            instrumentation.log('Scenario ' + str(number + 1) + ' of ' + str(len(scenarios)) + ': ' + scenario['name'], 'quiet')
+            start_time = time.perf_counter()
+            try:
+                outputs = self.run_scenario(scenario)
+            except Exception as error:
+                if stop_on_error:
+                    raise
+                instrumentation.log('     Scenario ' + scenario['name'] + ' failed: ' + repr(error), 'quiet')
+                self.summary.append({'scenario': scenario['name'], 'mode': scenario['mode'], 'status': 'failed', 'run time (s)': time.perf_counter() - start_time, 'error': repr(error)})
+            else:
+                run_time = time.perf_counter() - start_time
+                self.summary += [self.summarize(scenario, year, output_df, run_time) for year, output_df in outputs.items()]
+            self.write_summary()
+        return self.write_summary()
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Runs the scenario variants of a JSON manifest on one shared preprocessing of the historical data')
+    parser.add_argument('manifest', help='JSON manifest of the scenario variants')
+    parser.add_argument('--only', nargs='*', default=None, help='names of the variants to run')
+    parser.add_argument('--results', default=None, help='folder of the variant results (data/results/scenarios by default)')
+    parser.add_argument('--dry-run', action='store_true', help='list the variants without running them')
+    parser.add_argument('--stop-on-error', action='store_true', help='stop at the first failed variant')
+    args = parser.parse_args(arguments)
+
+    runner = ScenarioRunner(load_manifest(args.manifest), args.results)
+    names = [scenario['name'] for scenario in runner.scenarios]
+    if args.only is not None:
+        unknown = [name for name in args.only if name not in names]
+        if len(unknown) > 0:
+            print ('Unknown scenarios: ' + ', '.join(unknown))
+            return 1
+    if args.dry_run:
+        for scenario in runner.scenarios:
+            if args.only is None or scenario['name'] in args.only:
+                print (scenario['name'] + ': ' + json.dumps({key: scenario[key] for key in ('mode', 'years') + SECTIONS if scenario[key]}, ensure_ascii=False, default=str))
+        return 0
+    summary_df = runner.run(args.only, args.stop_on_error)
+    failed = int((summary_df['status'] == 'failed').sum()) if 'status' in summary_df.columns else 0
+    print (str(len(summary_df.index) - failed) + ' scenario years completed, ' + str(failed) + ' scenarios failed. Summary written to ' + runner.results_path + 'scenario summary.xlsx')
+    return 1 if failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
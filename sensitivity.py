@@ -0,0 +1,169 @@
+'''Sensitivity of EAC/MWh to the technoeconomic assumptions, on the sizing results of a year (no dispatch is re-run).
+
+Every assumption of technoeconomic_assumptions.xlsx is perturbed by a relative variation (sensitivity_variation (%)):
+ - one at a time, to its low (1 - variation) and high (1 + variation) value with all others at their base value. The
+   tornado table gives, for every assumption, the EAC/MWh of the least-cost scenario of the base assumptions, the mean
+   and largest swing over all scenarios and whether the least-cost scenario changes
+ - all together, with sensitivity_samples Monte Carlo draws of independent uniform factors within the same range. The
+   rank stability table gives the base rank of every scenario by EAC/MWh, the mean, spread and range of its rank over
+   the draws and how often it is the least-cost one or among the sensitivity_top_k least-cost ones
+Assumptions with a base value of 0 cannot be varied relatively and keep a zero swing. EAC/MWh is evaluated with
+evaluate_eac of TechnoeconomicCalculations on (perturbations x scenarios) arrays, in chunks of at most
+CHUNK_ELEMENTS elements, so the rank statistics of thousands of draws and scenarios are accumulated in seconds.'''
+import numpy as np
+import pandas as pd
+from instrumentation import instrumentation
+
+CHUNK_ELEMENTS = 2000000 # (perturbations x scenarios) elements evaluated at once
+
+
+def rank_scenarios(eac_per_mwh):
+    '''Rank (1 = least cost) of every scenario in every row'''
+    ranks = np.empty(eac_per_mwh.shape, dtype=np.int64)
+    rows = np.arange(eac_per_mwh.shape[0])[:, None]
+    ranks[rows, np.argsort(eac_per_mwh, axis=1, kind='stable')] = np.arange(1, eac_per_mwh.shape[1] + 1)
+    return ranks
+
+
+def spearman_correlation(ranks, base_ranks):
+    '''Spearman correlation of every row of ranks with base_ranks (ranks without ties)'''
+    scenarios = ranks.shape[1]
+    if scenarios < 2:
+        return np.ones(ranks.shape[0])
+    return 1 - 6*((ranks - base_ranks)**2).sum(axis=1)/(scenarios*(scenarios**2 - 1))
+
+
+class SensitivityAnalysis:
+
+    def __init__(self, main, technoeconomic_calculations):
+        self.technoeconomic_calculations = technoeconomic_calculations
+        self.variation = float(main.get_simulation_option('sensitivity_variation (%)', 10))/100
+        self.samples = int(main.get_simulation_option('sensitivity_samples', 1000))
+        self.top_k = int(main.get_simulation_option('sensitivity_top_k', 5))
+        self.get_year_seed = main.get_year_seed
+        return
+
+    def get_base_values(self):
+        return self.technoeconomic_calculations.technoeconomic_assumptions['value'].astype(float)
+
+    def get_valid_scenarios(self, output_df):
+        '''Scenarios with a finite EAC/MWh under the base assumptions (sized, with RES penetration)'''
+        base_eac_per_mwh = self.technoeconomic_calculations.evaluate_eac(output_df)['EAC/MWh (€/MWh)'][0]
+        return output_df[np.isfinite(base_eac_per_mwh)]
+
+    def evaluate(self, output_df, assumption_sets):
+        '''EAC/MWh as an (assumption sets x scenarios) array, evaluated in chunks of assumption sets'''
+        chunk_size = max(CHUNK_ELEMENTS//max(len(output_df.index), 1), 1)
+        return np.vstack([self.technoeconomic_calculations.evaluate_eac(output_df, assumption_sets.iloc[start:start + chunk_size])['EAC/MWh (€/MWh)']
+                          for start in range(0, len(assumption_sets.index), chunk_size)])
+
+    def get_one_at_a_time_sets(self):
+        '''Low and high assumption set of every assumption, the others at their base value'''
+        base_values = self.get_base_values()
+        assumption_sets = pd.DataFrame(np.tile(base_values.to_numpy(), (2*len(base_values.index), 1)), columns=base_values.index)
+        for number, assumption in enumerate(base_values.index):
+            assumption_sets.loc[2*number, assumption] = base_values[assumption]*(1 - self.variation)
+            assumption_sets.loc[2*number + 1, assumption] = base_values[assumption]*(1 + self.variation)
+        assumption_sets.index = pd.MultiIndex.from_product([base_values.index, ['low', 'high']], names=['assumption', 'case'])
+        return assumption_sets
+
+    def get_monte_carlo_sets(self, seed=None):
+        '''sensitivity_samples assumption sets with every assumption scaled by an independent uniform factor within 1 ± variation'''
+        base_values = self.get_base_values()
+        factors = np.random.default_rng(seed).uniform(1 - self.variation, 1 + self.variation, size=(self.samples, len(base_values.index)))
+        assumption_sets = pd.DataFrame(factors*base_values.to_numpy(), columns=base_values.index)
+        assumption_sets.index.name = 'sample'
+        return assumption_sets
+
+    def calculate_tornado(self, output_df):
+        '''Tornado table of EAC/MWh, one row per assumption sorted by the swing of the base least-cost scenario'''
+        output_df = self.get_valid_scenarios(output_df)
+        base_values = self.get_base_values()
+        base_eac_per_mwh = self.technoeconomic_calculations.evaluate_eac(output_df)['EAC/MWh (€/MWh)'][0]
+        least_cost = int(np.argmin(base_eac_per_mwh))
+        assumption_sets = self.get_one_at_a_time_sets()
+        eac_per_mwh = self.evaluate(output_df, assumption_sets).reshape(len(base_values.index), 2, -1)
+        low, high = eac_per_mwh[:, 0, :], eac_per_mwh[:, 1, :]
+        swing = np.abs(high - low)
+        tornado_df = pd.DataFrame({
+            'base value': base_values.to_numpy(),
+            'low value': base_values.to_numpy()*(1 - self.variation),
+            'high value': base_values.to_numpy()*(1 + self.variation),
+            'least-cost scenario': output_df.index[least_cost],
+            'base EAC/MWh (€/MWh)': base_eac_per_mwh[least_cost],
+            'low EAC/MWh (€/MWh)': low[:, least_cost],
+            'high EAC/MWh (€/MWh)': high[:, least_cost],
+            'swing (€/MWh)': swing[:, least_cost],
+            'swing (%)': 100*swing[:, least_cost]/base_eac_per_mwh[least_cost],
+            'mean swing over scenarios (€/MWh)': swing.mean(axis=1),
+            'max swing over scenarios (€/MWh)': swing.max(axis=1),
+            'least-cost scenario at low value': output_df.index[np.argmin(low, axis=1)],
+            'least-cost scenario at high value': output_df.index[np.argmin(high, axis=1)],
+            }, index=base_values.index)
+        tornado_df['least-cost scenario changes'] = (tornado_df['least-cost scenario at low value'] != tornado_df['least-cost scenario']) | (tornado_df['least-cost scenario at high value'] != tornado_df['least-cost scenario'])
+        tornado_df.index.name = 'assumption'
+        return tornado_df.sort_values('swing (€/MWh)', ascending=False)
+
+    def calculate_rank_stability(self, output_df, seed=None):
+        '''Rank stability of every scenario over the Monte Carlo draws, and the Spearman correlation of every draw with the base ranking'''
+        output_df = self.get_valid_scenarios(output_df)
+        scenarios = len(output_df.index)
+        base_eac_per_mwh = self.technoeconomic_calculations.evaluate_eac(output_df)['EAC/MWh (€/MWh)']
+        base_ranks = rank_scenarios(base_eac_per_mwh)
+        assumption_sets = self.get_monte_carlo_sets(seed)
+        top_k = min(self.top_k, scenarios)
+        rank_sum, rank_square_sum = np.zeros(scenarios), np.zeros(scenarios)
+        rank_min, rank_max = np.full(scenarios, scenarios), np.ones(scenarios, dtype=np.int64)
+        least_cost_count, top_k_count = np.zeros(scenarios), np.zeros(scenarios)
+        eac_sum, eac_square_sum = np.zeros(scenarios), np.zeros(scenarios)
+        correlations, least_cost_scenarios, least_cost_eac = [], [], []
+        chunk_size = max(CHUNK_ELEMENTS//max(scenarios, 1), 1)
+        for start in range(0, len(assumption_sets.index), chunk_size):
+            eac_per_mwh = self.technoeconomic_calculations.evaluate_eac(output_df, assumption_sets.iloc[start:start + chunk_size])['EAC/MWh (€/MWh)']
+            ranks = rank_scenarios(eac_per_mwh)
+            rank_sum += ranks.sum(axis=0)
+            rank_square_sum += (ranks.astype(float)**2).sum(axis=0)
+            rank_min = np.minimum(rank_min, ranks.min(axis=0))
+            rank_max = np.maximum(rank_max, ranks.max(axis=0))
+            least_cost_count += (ranks == 1).sum(axis=0)
+            top_k_count += (ranks <= top_k).sum(axis=0)
+            eac_sum += eac_per_mwh.sum(axis=0)
+            eac_square_sum += (eac_per_mwh**2).sum(axis=0)
+            correlations.append(spearman_correlation(ranks, base_ranks))
+            least_cost_scenarios.append(output_df.index[np.argmin(eac_per_mwh, axis=1)])
+            least_cost_eac.append(eac_per_mwh.min(axis=1))
+        samples = len(assumption_sets.index)
+        mean_rank = rank_sum/samples
+        mean_eac = eac_sum/samples
+        rank_stability_df = pd.DataFrame({
+            'pv capacity (MW)': output_df['pv capacity (MW)'].to_numpy(),
+            'wind capacity (MW)': output_df['wind capacity (MW)'].to_numpy(),
+            'hydro capacity (MW)': output_df['hydro capacity (MW)'].to_numpy(),
+            'battery_capacity (MWh)': output_df['battery_capacity (MWh)'].to_numpy(),
+            'base EAC/MWh (€/MWh)': base_eac_per_mwh[0],
+            'mean EAC/MWh (€/MWh)': mean_eac,
+            'std EAC/MWh (€/MWh)': np.sqrt(np.maximum(eac_square_sum/samples - mean_eac**2, 0)),
+            'base rank': base_ranks[0],
+            'mean rank': mean_rank,
+            'std rank': np.sqrt(np.maximum(rank_square_sum/samples - mean_rank**2, 0)),
+            'best rank': rank_min,
+            'worst rank': rank_max,
+            'least-cost probability (%)': 100*least_cost_count/samples,
+            'top ' + str(top_k) + ' probability (%)': 100*top_k_count/samples,
+            }, index=output_df.index)
+        rank_stability_df.index.name = 'scenario'
+        samples_df = assumption_sets.copy()
+        samples_df['least-cost scenario'] = np.concatenate(least_cost_scenarios)
+        samples_df['least-cost EAC/MWh (€/MWh)'] = np.concatenate(least_cost_eac)
+        samples_df['rank correlation with base'] = np.concatenate(correlations)
+        return rank_stability_df.sort_values('base rank'), samples_df
+
+    def run(self, year, output_df):
+        '''Tornado, rank stability and Monte Carlo sample tables of the sizing results of a year'''
+        if len(self.get_valid_scenarios(output_df).index) == 0:
+            instrumentation.log('     No scenario of ' + str(year) + ' has a finite EAC/MWh, the sensitivity analysis is skipped')
+            return None
+        instrumentation.log('     Evaluating EAC/MWh sensitivity of ' + str(len(output_df.index)) + ' scenarios to ' + str(len(self.get_base_values().index)) + ' assumptions (±' + str(100*self.variation) + '%, ' + str(self.samples) + ' Monte Carlo samples)')
+        tornado_df = self.calculate_tornado(output_df)
+        rank_stability_df, samples_df = self.calculate_rank_stability(output_df, seed=self.get_year_seed(year))
+        return {'tornado': tornado_df, 'rank stability': rank_stability_df, 'samples': samples_df}
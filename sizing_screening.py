@@ -0,0 +1,60 @@
+'''Screening of res combinations before storage sizing.
+
+Without a battery (and without PHS) the dispatch has no state: curtailment is all the energy that cannot be
+netted, shortage is the missing energy of the deficit steps and RES penetration is the directly covered demand,
+so the zero-storage metrics of every combination follow from the vectorized pre-pass of the dispatch kernel.
+With unbounded capacity and power, storage can at most deliver, by every step, the energy stored before it times
+the best round-trip efficiency and HV to LV factor, and never more than the missing energy. The minimum over all
+steps of (deliverable until the step + missing energy after it) bounds the extra RES penetration any capacity can
+reach, while curtailment can at best fall to zero.
+A combination that meets the target without storage is sized at 0 MWh and one whose bound stays below the target
+(within target_offset (%)) is marked unreachable, so that no sizing iterations are spent on either.'''
+import numpy as np
+from dispatch_kernel import prepare_dispatch_inputs
+
+SIZED = 'sized'
+MET_WITHOUT_STORAGE = 'target met without storage'
+UNREACHABLE = 'target unreachable'
+BOUND_TOLERANCE = 1e-9 # relative slack of the ideal-storage bound, so that rounding never marks a reachable target unreachable
+
+
+def prepare_screening_inputs(res_generation, demand, hydro_generation, net_billing_cap, parameters):
+    '''Storage-independent dispatch quantities of every combination as (combinations x steps) arrays'''
+    res_generation = np.atleast_2d(np.asarray(res_generation, dtype=np.float64))
+    combinations, frames = res_generation.shape
+    demand = np.broadcast_to(np.asarray(demand, dtype=np.float64), (combinations, frames))
+    hydro_generation = np.broadcast_to(np.asarray(hydro_generation, dtype=np.float64), (combinations, frames))
+    net_billing_cap = np.asarray(net_billing_cap, dtype=np.float64).reshape(combinations, 1)
+    demand, surplus, energy_to_be_stored, missing_energy, base_penetration = prepare_dispatch_inputs(
+        res_generation, demand, hydro_generation, net_billing_cap*parameters['time_step_hours'], parameters['hv_to_lv_factor'])
+    return energy_to_be_stored, missing_energy, np.broadcast_to(base_penetration, (combinations, frames))
+
+
+def zero_storage_dispatch(energy_to_be_stored, missing_energy, base_penetration, time_step_hours):
+    '''Per-combination summaries of the dispatch without battery and PHS, named like those of simulate_batched_dispatch'''
+    combinations = energy_to_be_stored.shape[0]
+    return {
+        'curtailment': energy_to_be_stored.sum(axis=1),
+        'RES penetration': base_penetration.sum(axis=1),
+        'energy shortage': missing_energy.sum(axis=1),
+        'max hourly curtailment': energy_to_be_stored.max(axis=1)/time_step_hours,
+        'peak missing energy': missing_energy.max(axis=1)/time_step_hours,
+        'max periods since battery state change': np.ones(combinations), # nothing is stored or discharged, so every step changes state
+        }
+
+
+def ideal_storage_penetration(energy_to_be_stored, missing_energy, base_penetration, efficiency):
+    '''Upper bound of the RES penetration (MWh) of every combination with any storage capacity'''
+    deliverable = efficiency*np.cumsum(energy_to_be_stored, axis=1)
+    missing_until = np.cumsum(missing_energy, axis=1)
+    missing_total = missing_until[:, -1:]
+    recoverable = np.minimum(np.minimum(missing_until, deliverable) + (missing_total - missing_until), missing_total).min(axis=1)
+    return (base_penetration.sum(axis=1) + recoverable)*(1 + BOUND_TOLERANCE)
+
+
+def classify(zero_storage_value, ideal_storage_value, target, tolerance, increasing):
+    '''Screening result of every combination, with the convergence test of sizing_solver'''
+    sign = 1.0 if increasing else -1.0
+    met = sign*(zero_storage_value - target) >= -tolerance
+    unreachable = sign*(ideal_storage_value - target) < -tolerance
+    return np.where(met, MET_WITHOUT_STORAGE, np.where(unreachable, UNREACHABLE, SIZED))
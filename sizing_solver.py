@@ -0,0 +1,68 @@
+'''Bracketing solver used to size storage capacity against a monotone target.
+
+RES penetration grows and curtailment shrinks with storage capacity, so the required capacity is
+bracketed by geometric growth from zero and then refined with Illinois-style regula falsi, falling
+back to bisection whenever the interpolated step leaves the bracket.'''
+
+
+def solve_storage_capacity(evaluate, target, tolerance, increasing=True, initial_capacity=1.0, growth_factor=2.0, max_iterations=40, capacity_tolerance=1e-6):
+    '''Finds the storage capacity at which evaluate(capacity) reaches the target within tolerance.
+
+    evaluate runs a full-year simulation and returns the tracked metric (in %). It must be non-decreasing
+    in capacity when increasing=True (RES penetration) and non-increasing otherwise (curtailment).
+    Every call to evaluate counts as one iteration, so max_iterations bounds the number of simulations.'''
+    sign = 1.0 if increasing else -1.0
+    history = []
+
+    def residual(capacity):
+        value = evaluate(capacity)
+        history.append((capacity, value))
+        return sign*(value - target), value
+
+    def result(capacity, value, converged, message):
+        return {'storage_capacity': capacity, 'value': value, 'iterations': len(history), 'converged': converged, 'message': message, 'history': history}
+
+    # the target may already be met without storage
+    low = 0.0
+    f_low, value_low = residual(low)
+    if f_low >= -tolerance:
+        return result(low, value_low, True, 'Target reached without storage')
+
+    # geometric growth until the target is bracketed
+    high = initial_capacity
+    while True:
+        if len(history) >= max_iterations:
+            return result(low, value_low, False, 'Iteration limit reached before the target was bracketed')
+        f_high, value_high = residual(high)
+        if abs(f_high) <= tolerance:
+            return result(high, value_high, True, 'Simulations reached required target accuracy')
+        if f_high > 0:
+            break
+        if f_high <= f_low:
+            return result(low, value_low, False, 'Target metric did not change with capacity change')
+        low, f_low, value_low = high, f_high, value_high
+        high *= growth_factor
+
+    # Illinois regula falsi inside the bracket, safeguarded by bisection
+    side = 0
+    while len(history) < max_iterations and (high - low) > capacity_tolerance*high:
+        capacity = (low*f_high - high*f_low)/(f_high - f_low)
+        if not (low < capacity < high):
+            capacity = 0.5*(low + high)
+        f_capacity, value = residual(capacity)
+        if abs(f_capacity) <= tolerance:
+            return result(capacity, value, True, 'Simulations reached required target accuracy')
+        if f_capacity > 0:
+            high, f_high, value_high = capacity, f_capacity, value
+            if side == 1:
+                f_low *= 0.5
+            side = 1
+        else:
+            low, f_low, value_low = capacity, f_capacity, value
+            if side == -1:
+                f_high *= 0.5
+            side = -1
+    # the upper end of the bracket always satisfies the target
+    if (high - low) <= capacity_tolerance*high:
+        return result(high, value_high, True, 'Storage capacity bracket collapsed')
+    return result(high, value_high, False, 'Iteration limit reached, returning the smallest capacity that meets the target')
@@ -0,0 +1,85 @@
+'''Content-addressed on-disk cache of the preprocessed historical statistics.
+
+The key is a sha256 of the input files and of the settings that shape the statistics (columns of interest,
+data years, technologies...). A changed input file or setting gives a new key, so stale entries are never
+loaded. Each entry is a numpy .npz archive with the shared calendar index and one (frames x statistics)
+table per series; saving an entry removes older entries of the same name.
+Set statistics_cache to False in simulation_customization.xlsx to bypass the cache and
+clear_statistics_cache to True to delete all entries at start-up.'''
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from instrumentation import instrumentation
+
+CACHE_VERSION = 1 # increase when the preprocessing changes in a way the inputs do not capture
+
+
+class StatisticsCache:
+
+    def __init__(self, cache_path, enabled=True, clear=False):
+        self.cache_path = cache_path
+        self.enabled = enabled
+        if clear:
+            self.clear()
+        return
+
+    def get_key(self, file_paths, settings):
+        digest = hashlib.sha256()
+        digest.update(json.dumps({'version': CACHE_VERSION, 'settings': settings}, sort_keys=True, default=str).encode())
+        for file_path in file_paths:
+            with open(file_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def get_file_path(self, name, key):
+        return os.path.join(self.cache_path, name + '_' + key[:20] + '.npz')
+
+    def load(self, name, key):
+        '''Returns {series: statistics DataFrame} of a cached entry, or None on a cache miss'''
+        file_path = self.get_file_path(name, key)
+        if not self.enabled or not os.path.exists(file_path):
+            return None
+        try:
+            with np.load(file_path, allow_pickle=False) as archive:
+                if str(archive['key']) != key:
+                    return None
+                index = pd.DatetimeIndex(archive['index'].astype('datetime64[ns]'))
+                columns = archive['columns'].tolist()
+                return {series: pd.DataFrame(archive['table_' + series], index=index, columns=columns) for series in archive['series'].tolist()}
+        except (OSError, KeyError, ValueError):
+            instrumentation.log('          Ignoring unreadable cache entry ' + file_path, 'quiet')
+            return None
+
+    def save(self, name, key, tables):
+        '''Stores {series: statistics DataFrame}, all tables sharing the same index and columns'''
+        if not self.enabled:
+            return
+        os.makedirs(self.cache_path, exist_ok=True)
+        for file_name in os.listdir(self.cache_path):
+            if file_name.startswith(name + '_') and file_name.endswith('.npz'):
+                os.remove(os.path.join(self.cache_path, file_name))
+        first_table = next(iter(tables.values()))
+        arrays = {'key': np.array(key),
+                  'index': pd.DatetimeIndex(first_table.index).to_numpy(dtype='datetime64[ns]').astype(np.int64),
+                  'columns': np.array([str(column) for column in first_table.columns]),
+                  'series': np.array(list(tables.keys()))}
+        for series, table in tables.items():
+            arrays['table_' + series] = table.to_numpy(dtype=float)
+        file_path = self.get_file_path(name, key)
+        temporary_file_path = file_path + '.tmp'
+        with open(temporary_file_path, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temporary_file_path, file_path)
+        return
+
+    def clear(self):
+        if not os.path.isdir(self.cache_path):
+            return
+        instrumentation.log('     Clearing statistics cache...')
+        for file_name in os.listdir(self.cache_path):
+            if file_name.endswith('.npz') or file_name.endswith('.tmp'):
+                os.remove(os.path.join(self.cache_path, file_name))
+        return
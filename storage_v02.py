@@ -3,26 +3,77 @@ import os
 import pandas as pd
 import datetime
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dispatch_kernel import simulate_dispatch, simulate_batched_dispatch, CHARGE_STATE_LABELS
+from sizing_solver import solve_storage_capacity
+from lp_sizing import solve_lp_storage_capacity
+from time_series_aggregation import RepresentativeDays
+from trace_output import TraceWriter
+from ensemble import StochasticEnsemble, summarize_ensemble
+from battery_degradation import RainflowDegradation
+from checkpoint import CheckpointJournal, restore_output
+from dispatch_cache import DispatchCache, restore_simulations_df
+from sizing_screening import prepare_screening_inputs, zero_storage_dispatch, ideal_storage_penetration, classify, SIZED, MET_WITHOUT_STORAGE, UNREACHABLE
+from instrumentation import instrumentation
 
 class StorageSimulations:
 
-    def __init__(self, main):
+    def __init__(self, main, profile_store=None):
         self.cwd = os.getcwd()
+        self.profile_store = profile_store # RES generation is read from files in res_data/calculated when no profile store is given
         self.general_input_data_path = self.cwd + "/data/"
         self.generation_input_data_path = self.general_input_data_path + "res_data/calculated/"
         self.demand_input_data_path = self.general_input_data_path + "demand/calculated/"
-        self.output_path = self.general_input_data_path + 'results/'
+        self.output_path = main.results_path
         self.simulation_details = main.simulation_details
+        self.dispatch_engine = main.get_simulation_option('dispatch_engine', 'dataframe')
+        self.sizing_method = main.get_simulation_option('sizing_method', 'iterative')
+        self.capacity_sweep_points = int(main.get_simulation_option('capacity_sweep_points', 50))
+        self.capacity_sweep_max = main.get_simulation_option('capacity_sweep_max (MWh)', None)
+        self.sizing_initial_capacity = main.get_simulation_option('sizing_initial_capacity (MWh)', None)
+        self.sizing_growth_factor = float(main.get_simulation_option('sizing_growth_factor', 2.0))
+        self.sizing_max_iterations = int(main.get_simulation_option('sizing_max_iterations', 40))
+        self.sizing_screening = bool(main.get_simulation_option('sizing_screening', False))
+        self.screening = None # zero-storage metrics and screening result of the res combinations being sized
+        self.time_series_aggregation = bool(main.get_simulation_option('time_series_aggregation', False))
+        self.representative_days = int(main.get_simulation_option('representative_days', 48))
+        self.aggregation_method = main.get_simulation_option('aggregation_method', 'hierarchical')
+        self.aggregation_soc_levels = int(main.get_simulation_option('aggregation_soc_levels', 5))
+        self.aggregation_validation_samples = int(main.get_simulation_option('aggregation_validation_samples', 3))
+        self.aggregation = None # representative days of the year being sized (see time_series_aggregation.py)
+        self.aggregation_validation_df = None
+        self.parallel_workers = int(main.get_simulation_option('parallel_workers', 1))
+        self.ensemble_realizations = int(main.get_simulation_option('ensemble_realizations', 0))
+        self.ensemble_chunk_size = int(main.get_simulation_option('ensemble_chunk_size', 16))
+        self.simulation_resolution = main.get_simulation_resolution()
+        self.time_step_hours = self.simulation_resolution/pd.Timedelta(hours=1) # converts power (MW) to energy per simulation step (MWh)
+        self.dispatch_precision = main.get_simulation_option('dispatch_precision', 'float64')
+        if self.dispatch_precision not in ('float64', 'float32'):
+            raise ValueError('dispatch_precision must be float64 or float32, got ' + str(self.dispatch_precision))
+        self.degradation_model = main.get_simulation_option('degradation_model', 'throughput')
+        if self.degradation_model not in ('throughput', 'rainflow'):
+            raise ValueError('degradation_model must be throughput or rainflow, got ' + str(self.degradation_model))
+        self.degradation_dod_exponent = float(main.get_simulation_option('degradation_dod_exponent', 1.0))
+        self.degradation_reference_dod = float(main.get_simulation_option('degradation_reference_dod (%)', 100))
+        self.degradation_update_interval = float(main.get_simulation_option('degradation_update_interval (days)', 0))
+        if self.degradation_update_interval > 0 and (self.dispatch_engine != 'array' or self.degradation_model != 'rainflow'):
+            raise ValueError('degradation_update_interval (days) needs dispatch_engine array and degradation_model rainflow, got ' + str(self.dispatch_engine) + ' and ' + str(self.degradation_model))
+        self.checkpoint = CheckpointJournal(self.output_path + 'checkpoints/', enabled=bool(main.get_simulation_option('checkpointing', False)), resume=bool(main.get_simulation_option('checkpoint_resume', False)))
+        self.dispatch_cache = DispatchCache(self.output_path + 'dispatch_cache/', enabled=bool(main.get_simulation_option('dispatch_cache', False)), max_entries=main.get_simulation_option('dispatch_cache_size', 1024),
+                                            store_traces=bool(main.get_simulation_option('dispatch_cache_traces', False)), persist=bool(main.get_simulation_option('dispatch_cache_persist', False)),
+                                            max_disk_size=main.get_simulation_option('dispatch_cache_disk_size (MB)', 512))
+        self.traced_storage_capacity = None # storage capacity of the evaluation held in simulations_df (None when it came from the dispatch cache without its trace)
+        self.trace_writer = TraceWriter(self.output_path, level=main.get_simulation_option('trace_level', 'none'), export_excel=bool(main.get_simulation_option('trace_excel_export', True)), chunk_size=main.get_simulation_option('trace_chunk_size', 64))
         
         self.storage_specifications = {}
-        self.storage_technologies = main.simulation_details.loc['storage_technology']['value'].values
+        self.storage_technologies = main.simulation_details.loc[['storage_technology'], 'value'].values
         for storage_technology in self.storage_technologies:
             self.storage_specifications[storage_technology] = pd.read_excel(self.general_input_data_path + storage_technology + '_characteristics.xlsx', index_col=0, header=0)
         
         # Prepare "simulation" and "output dataframes"
-        self.simulation_frames = 8760 #hours in a year
+        self.simulation_frames = int(pd.Timedelta(days=365)/self.simulation_resolution) #steps in a year (Feb-29 is not simulated)
         self.simulation_columns = ['battery_p_ch', 'battery_p_dis', 'battery_soc', 'battery_stored_energy', 'battery throughput energy (MWh)', 'battery_charge_state', 'phs_p_ch', 'phs_p_dis', 'phs_soc', 'phs_stored_energy', 'phs_charge_state', 'RES penetration', 'curtailment', 'energy shortage', 'modified demand', 'periods since battery state change']
-        self.output_columns = ['maximization criterion', 'pv capacity (MW)', 'wind capacity (MW)', 'hydro capacity (MW)', 'battery_capacity (MWh)', 'phs_capacity (MWh)', 'battery_power (MW)', 'battery throughput energy (MWh)', 'degraded_battery_capacity (MWh)', 'Total Potential RES generation (TWh)', 'Total Demand (TWh)','curtailment (%)', 'curtailment (TWh)', 'curtailment with zero storage (%)', 'curtailment with zero storage (TWh)', 'max hourly curtailment (MWh)', 'RES penetration (%)', 'RES penetration (MWh)', 'RES penetration without storage (%)', 'annual missing energy (TWh)', 'annual missing energy without storage (TWh)', 'peak missing energy (MW)', 'peak missing energy without storage (MW)','max periods until state change']
+        self.output_columns = ['maximization criterion', 'pv capacity (MW)', 'wind capacity (MW)', 'hydro capacity (MW)', 'battery_capacity (MWh)', 'phs_capacity (MWh)', 'battery_power (MW)', 'battery throughput energy (MWh)', 'degraded_battery_capacity (MWh)', 'Total Potential RES generation (TWh)', 'Total Demand (TWh)','curtailment (%)', 'curtailment (TWh)', 'curtailment with zero storage (%)', 'curtailment with zero storage (TWh)', 'max hourly curtailment (MWh)', 'RES penetration (%)', 'RES penetration (MWh)', 'RES penetration without storage (%)', 'annual missing energy (TWh)', 'annual missing energy without storage (TWh)', 'peak missing energy (MW)', 'peak missing energy without storage (MW)','max periods until state change', 'sizing iterations', 'lp iterations', 'sizing converged', 'screening result']
         self.simulations_df = pd.DataFrame(np.nan, index=range(self.simulation_frames), columns=self.simulation_columns)
         return
     
@@ -32,8 +83,19 @@ class StorageSimulations:
         variable.index = pd.to_datetime(variable.index, format='%Y-%m-%d %H:%M:%S')
         return variable
     
+    def load_res_generation(self, year, res_combination, sampled_res_capacities):
+        if self.profile_store is not None:
+            return self.profile_store.res_generation(year, sampled_res_capacities.loc[res_combination])
+        res_generation = {}
+        for technology in sampled_res_capacities.columns:    
+            input_file_name = technology +' '+ str(round(sampled_res_capacities.loc[res_combination][technology],5))+'MW_generation_' + str(year) + '.csv'
+            res_generation[technology] = pd.read_csv(self.generation_input_data_path + input_file_name, index_col=0, header = 0)
+            res_generation[technology] = self.convert_to_datetime(res_generation[technology])
+        return res_generation
+    
     def reset_simulations_df(self, res_generation, demand):
         self.simulations_df.iloc[:,:] = 0
+        self.simulations_df[['battery_charge_state', 'phs_charge_state']] = self.simulations_df[['battery_charge_state', 'phs_charge_state']].astype(object) # they hold the 'Charging!'/'Discharging!' labels
         self.simulations_df.loc[:,'modified demand'] = demand.iloc[:,0]
         if 'hydro' in res_generation.keys():
             self.simulations_df.loc[:,'RES penetration'] = res_generation['hydro'].iloc[:,0]
@@ -52,11 +114,90 @@ class StorageSimulations:
         phs_min_discharge_level = storage_capacity*((100-self.storage_specifications["phs"].loc['depth_of_discharge (%)']['value'])/100)
         return phs_pmax_dis, phs_min_discharge_level
     
+    def energy_simulations(self, sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level):
+        with instrumentation.dispatch(1, len(demand.index)*self.time_step_hours):
+            if self.dispatch_engine == 'array':
+                self.array_energy_simulations(sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+            else:
+                self.hourly_energy_simulations(sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+        return
+    
+    def resolve_dispatch_parameters(self, sampled_res_capacities, res_combination, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level):
+        '''Looks up every specification used in the hourly loop once, so that the dispatch kernel only sees plain floats'''
+        parameters = {
+            'time_step_hours': self.time_step_hours,
+            'net_billing_cap': (self.simulation_details.loc['net_billing_percentage (%)']['value']/100) * sampled_res_capacities.loc[res_combination].sum(),
+            'hv_to_lv_factor': 1-self.simulation_details.loc['hv_to_lv_losses (%)']['value']/100,
+            'storage_capacity': storage_capacity,
+            'bess_pch_max': bess_pch_max,
+            'bess_pdis_max': bess_pdis_max,
+            'bess_min_discharge_level': bess_min_discharge_level,
+            'bess_rte': self.storage_specifications["battery"].loc['round_trip_efficiency']['value']/100,
+            'phs_capacity': self.storage_specifications["phs"].loc['capacity (MWh)']['value'],
+            'phs_pch_max': self.storage_specifications["phs"].loc['pmax_charge (MW)']['value'],
+            'phs_pdis_max': phs_pmax_dis,
+            'phs_min_discharge_level': phs_min_discharge_level,
+            'phs_rte': self.storage_specifications["phs"].loc['round_trip_efficiency (%)']['value']/100,
+            'phs_enabled': "phs" in self.storage_technologies,
+            }
+        parameters = {key: (value if key == 'phs_enabled' else float(value)) for key, value in parameters.items()}
+        parameters['dispatch_precision'] = self.dispatch_precision
+        return parameters
+    
+    def array_energy_simulations(self, sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level):
+        # same priority rules as hourly_energy_simulations, executed by the array kernel
+        parameters = self.resolve_dispatch_parameters(sampled_res_capacities, res_combination, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+        if 'hydro' in res_generation.keys():
+            hydro_generation = res_generation['hydro'].iloc[:,0].to_numpy(dtype=float)
+        else:
+            hydro_generation = 0.0
+        results = simulate_dispatch(aggregated_res_generation_df.iloc[:,0].to_numpy(dtype=float), demand.iloc[:,0].to_numpy(dtype=float), hydro_generation, parameters)
+        self.set_simulations_df(results, demand.index)
+        return
+    
+    def set_simulations_df(self, results, index):
+        results['battery_charge_state'] = CHARGE_STATE_LABELS[results['battery_charge_state']]
+        results['phs_charge_state'] = np.zeros(len(index))
+        self.simulations_df = pd.DataFrame(results, index=index, columns=self.simulation_columns)
+        return
+    
+    def degrading_energy_simulations(self, sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, degradation):
+        '''Array dispatch in blocks of degradation_update_interval days. After every block the usable capacity is reduced by the
+        fade of the cycles counted so far, power limits stay at their nameplate values'''
+        bess_pch_max, bess_pdis_max, bess_min_discharge_level = self.update_bess_specifications(storage_capacity)
+        phs_pmax_dis, phs_min_discharge_level = self.update_phs_specifications(self.storage_specifications["phs"].loc['capacity (MWh)']['value'])
+        parameters = self.resolve_dispatch_parameters(sampled_res_capacities, res_combination, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+        res_generation_array = aggregated_res_generation_df.iloc[:,0].to_numpy(dtype=float)
+        demand_array = demand.iloc[:,0].to_numpy(dtype=float)
+        hydro_generation = np.zeros(demand_array.shape[0])
+        if 'hydro' in res_generation.keys():
+            hydro_generation = res_generation['hydro'].iloc[:,0].to_numpy(dtype=float)
+        block_steps = max(int(round(self.degradation_update_interval*24/self.time_step_hours)), 1)
+        
+        degradation.update([[bess_min_discharge_level]])
+        blocks = []
+        initial_state = None
+        for start in range(0, demand_array.shape[0], block_steps):
+            block = slice(start, start + block_steps)
+            usable_capacity = degradation.get_capacities()[0]
+            parameters['storage_capacity'] = usable_capacity
+            parameters['bess_min_discharge_level'] = usable_capacity*((100-self.storage_specifications["battery"].loc['depth_of_discharge']['value'])/100)
+            if initial_state is not None:
+                initial_state['battery_soc'] = min(initial_state['battery_soc'], usable_capacity)
+            results = simulate_dispatch(res_generation_array[block], demand_array[block], hydro_generation[block], parameters, initial_state)
+            degradation.update(results['battery_soc'][None, :])
+            initial_state = {key: results[key][-1] for key in ['battery_soc', 'phs_soc', 'battery_charge_state', 'periods since battery state change']}
+            blocks.append(results)
+        self.set_simulations_df({key: np.concatenate([results[key] for results in blocks]) for key in blocks[0]}, demand.index)
+        return
+    
     def hourly_energy_simulations(self, sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level):
-        # calendar year simulations
+        # calendar year simulations, one simulation step at a time
         date = aggregated_res_generation_df.index[0]
         end = aggregated_res_generation_df.index[-1]
-        hour_delta = datetime.timedelta(hours=1)
+        hour_delta = self.simulation_resolution.to_pytimedelta()
+        # power limits (MW) as energy per simulation step (MWh)
+        bess_pch_max, bess_pdis_max, phs_pmax_dis = bess_pch_max*self.time_step_hours, bess_pdis_max*self.time_step_hours, phs_pmax_dis*self.time_step_hours
         while date <= end:
             if date.month==2 and date.day==29:
                 self.simulations_df.loc[date, 'RES penetration'] = self.simulations_df.loc[date - datetime.timedelta(hours=24), 'RES penetration']
@@ -78,8 +219,8 @@ class StorageSimulations:
                 date += hour_delta
                 continue
             ''' Εάν υπάρχει περιορισμός ταυτοχρονισμού όπως στο ΑΠΟΛΛΩΝ'''
-            if aggregated_res_generation_df.loc[date]['res_generation'] > (self.simulation_details.loc['net_billing_percentage (%)']['value']/100) * sampled_res_capacities.loc[res_combination].sum():
-                eligible_res_generation = ((self.simulation_details.loc['net_billing_percentage (%)']['value']/100) * sampled_res_capacities.loc[res_combination].sum())*(1-self.simulation_details.loc['hv_to_lv_losses (%)']['value']/100)
+            if aggregated_res_generation_df.loc[date]['res_generation'] > (self.simulation_details.loc['net_billing_percentage (%)']['value']/100) * sampled_res_capacities.loc[res_combination].sum()*self.time_step_hours:
+                eligible_res_generation = ((self.simulation_details.loc['net_billing_percentage (%)']['value']/100) * sampled_res_capacities.loc[res_combination].sum()*self.time_step_hours)*(1-self.simulation_details.loc['hv_to_lv_losses (%)']['value']/100)
                 energy_to_be_stored = aggregated_res_generation_df.loc[date]['res_generation'] - eligible_res_generation/(1-self.simulation_details.loc['hv_to_lv_losses (%)']['value']/100)
             else:
                 eligible_res_generation = aggregated_res_generation_df.loc[date]['res_generation']*(1-self.simulation_details.loc['hv_to_lv_losses (%)']['value']/100)
@@ -123,7 +264,7 @@ class StorageSimulations:
                 else:
                     phs_remaining_capacity = self.storage_specifications["phs"].loc['capacity (MWh)']['value'] - self.simulations_df.loc[date - hour_delta]['phs_soc']
                     phs_remaining_stored_energy = self.simulations_df.loc[date - hour_delta]['phs_soc'] - phs_min_discharge_level
-                self.simulations_df.loc[date, 'phs_p_ch'] = min(self.storage_specifications["phs"].loc['pmax_charge (MW)']['value'], phs_remaining_capacity)
+                self.simulations_df.loc[date, 'phs_p_ch'] = min(self.storage_specifications["phs"].loc['pmax_charge (MW)']['value']*self.time_step_hours, phs_remaining_capacity)
                 self.simulations_df.loc[date, 'phs_p_dis'] = min(phs_pmax_dis, phs_remaining_stored_energy*(self.storage_specifications["phs"].loc['round_trip_efficiency (%)']['value']/100)*(1-self.simulation_details.loc['hv_to_lv_losses (%)']['value']/100))
                 if self.simulations_df.loc[date, 'curtailment'] > 0 and "phs" in self.storage_technologies:
                     self.simulations_df.loc[date, 'phs_stored_energy'] = min(self.simulations_df.loc[date, 'curtailment'], phs_remaining_capacity, self.simulations_df.loc[date, 'phs_p_ch'])
@@ -182,7 +323,7 @@ class StorageSimulations:
                 else:
                     phs_remaining_capacity = self.storage_specifications["phs"].loc['capacity (MWh)']['value'] - self.simulations_df.loc[date - hour_delta]['phs_soc']
                     phs_remaining_stored_energy = self.simulations_df.loc[date - hour_delta]['phs_soc'] - phs_min_discharge_level
-                self.simulations_df.loc[date, 'phs_p_ch'] = min(self.storage_specifications["phs"].loc['pmax_charge (MW)']['value'], phs_remaining_capacity)
+                self.simulations_df.loc[date, 'phs_p_ch'] = min(self.storage_specifications["phs"].loc['pmax_charge (MW)']['value']*self.time_step_hours, phs_remaining_capacity)
                 self.simulations_df.loc[date, 'phs_p_dis'] = min(phs_pmax_dis, phs_remaining_stored_energy*(self.storage_specifications["phs"].loc['round_trip_efficiency (%)']['value']/100)*(1-self.simulation_details.loc['hv_to_lv_losses (%)']['value']/100))
                 if self.simulations_df.loc[date, 'energy shortage'] > 0 and "phs" in self.storage_technologies:
                     self.simulations_df.loc[date, 'phs_stored_energy'] = -min(self.simulations_df.loc[date, 'energy shortage'], phs_remaining_stored_energy*(self.storage_specifications["phs"].loc['round_trip_efficiency (%)']['value']/100)*(1-self.simulation_details.loc['hv_to_lv_losses (%)']['value']/100), self.simulations_df.loc[date, 'phs_p_dis'])
@@ -200,84 +341,106 @@ class StorageSimulations:
         self.simulations_df = self.simulations_df[~((self.simulations_df.index.month == 2) & (self.simulations_df.index.day == 29))]
         return
     
-    def update_bess_capacity_for_self_consumption_maximization (self, storage_capacity, variable_tracking):
-        print ('          Updating storage capacity with criterion being RES self-consumption maximization')
-        storage_capacity += ((variable_tracking.loc[len(variable_tracking)-1, 'storage_capacity'] - variable_tracking.loc[len(variable_tracking)-2, 'storage_capacity'])/(variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)'] - variable_tracking.loc[len(variable_tracking)-2, 'res_penetration (%)']))*(self.simulation_details.loc['target_threshold (%)']['value'] - variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)'])
-        if storage_capacity < 0:
-            import ipdb; ipdb.set_trace()
-        return storage_capacity
-    
-    def update_bess_capacity_for_curtailment_minimization (self, storage_capacity, variable_tracking):
-        print ('          Updating storage capacity with criterion being curtailment minimization')
-        storage_capacity += ((variable_tracking.loc[len(variable_tracking)-1, 'storage_capacity'] - variable_tracking.loc[len(variable_tracking)-2, 'storage_capacity'])/(variable_tracking.loc[len(variable_tracking)-2, 'curtailment (%)'] - variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']))*(variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)'] - self.simulation_details.loc['target_threshold (%)']['value'])
-        if storage_capacity < 0:
-            import ipdb; ipdb.set_trace()
-        return storage_capacity
-
+    def get_dispatch_cache_key(self, sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level):
+        parameters = self.resolve_dispatch_parameters(sampled_res_capacities, res_combination, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+        parameters['dispatch_engine'] = self.dispatch_engine
+        arrays = [aggregated_res_generation_df.iloc[:,0].to_numpy(dtype=float), demand.iloc[:,0].to_numpy(dtype=float)]
+        arrays.append(res_generation['hydro'].iloc[:,0].to_numpy(dtype=float) if 'hydro' in res_generation.keys() else 0.0)
+        return self.dispatch_cache.get_key(arrays, parameters)
     
-    def maximize_self_consumption(self, res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities):
-        # initialization of simulation values...
-        storage_capacity = 0.0 #in MWh
-        curtailment = 100.0 # initialization at maximum % value
-        RES_penetration = 0.0 # initialization at minimum penetration
-
-        # tracking variables which are used to end iterations and save the right results
+    def track_storage_capacity(self, res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities, storage_capacity, variable_tracking, need_trace=False):
+        '''Simulates the year with the given storage capacity and appends its results to variable_tracking.
+        Evaluations found in the dispatch cache are not simulated again, and simulations_df is only refreshed for them when their trace was cached'''
+        # update BESS characteristics
+        instrumentation.log("     Trying with storage capacity: " + str(storage_capacity) + "MWh", 'verbose')
+        bess_pch_max, bess_pdis_max, bess_min_discharge_level = self.update_bess_specifications(storage_capacity)
+        phs_pmax_dis, phs_min_discharge_level = self.update_phs_specifications(self.storage_specifications["phs"].loc['capacity (MWh)']['value'])
+        cache_key = None
+        cached = None
+        if not need_trace:
+            cached = self.get_aggregated_evaluation(res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities, storage_capacity)
+            if cached is None:
+                cached = self.get_screened_evaluation(res_combination, storage_capacity)
+        if cached is None and self.dispatch_cache.enabled:
+            cache_key = self.get_dispatch_cache_key(sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+            cached = self.dispatch_cache.get(cache_key, need_trace)
+        if cached is None:
+            self.reset_simulations_df(res_generation, demand)
+            self.energy_simulations(sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+            metrics = {
+                'power_capacity': bess_pdis_max,
+                'curtailment (%)': (self.simulations_df.loc[:,'curtailment'].sum()/aggregated_res_generation_df.loc[:,'res_generation'].sum())*100,
+                'curtailment_TWh': self.simulations_df.loc[:,'curtailment'].sum()/1000000,
+                'max_hourly_curtailment': self.simulations_df.loc[:,'curtailment'].max()/self.time_step_hours,
+                'res_penetration (%)': (self.simulations_df.loc[:,'RES penetration'].sum()/demand.loc[:]['demand'].sum().values[0])*100,
+                'res_penetration (MWh)': self.simulations_df.loc[:,'RES penetration'].sum(),
+                'annual_missing_energy': self.simulations_df.loc[:,'energy shortage'].sum()/1000000, #in TWh
+                'peak_missing_energy': self.simulations_df.loc[:,'energy shortage'].max()/self.time_step_hours,
+                'max_periods_until_state_change': self.simulations_df.loc[:,'periods since battery state change'].max(),
+                }
+            if cache_key is not None:
+                self.dispatch_cache.put(cache_key, metrics, self.simulations_df)
+            self.traced_storage_capacity = storage_capacity
+        else:
+            instrumentation.log('          Taken from the ' + ('dispatch cache' if cache_key is not None else 'representative days' if self.aggregation is not None else 'screening'), 'verbose')
+            metrics, trace = cached
+            self.traced_storage_capacity = None
+            if trace is not None:
+                self.simulations_df = restore_simulations_df(trace, demand.index, self.simulation_columns)
+                self.traced_storage_capacity = storage_capacity
+        
+        # update tracking variables with the results of the current storage capacity
+        variable_tracking.loc[len(variable_tracking), 'storage_capacity'] = storage_capacity
+        for metric, value in metrics.items():
+            variable_tracking.loc[len(variable_tracking)-1, metric] = value
+        
+        instrumentation.log('          Power capacity: ' + str(variable_tracking.loc[len(variable_tracking)-1, 'power_capacity']) + str(' MW'), 'verbose')
+        instrumentation.log('          Curtailment: ' + str(variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']) + str('%'), 'verbose')
+        instrumentation.log('          RES penetration: ' + str(variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)']) + str('%'), 'verbose')
+        return
+    
+    def size_storage_capacity(self, res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities, tracked_metric, increasing):
+        '''Finds the storage capacity at which tracked_metric reaches target_threshold (%) within target_offset (%)'''
+        # tracking variables which are used to save the right results
         variable_tracking = pd.DataFrame(columns=['storage_capacity', 'power_capacity', 'curtailment (%)', 'curtailment_TWh', 'max_hourly_curtailment', 'res_penetration (%)', \
                                                   'res_penetration (MWh)', 'annual_missing_energy', 'peak_missing_energy', 'max_periods_until_state_change'])
+        screening = self.get_screening(res_combination)
+        if screening is not None and screening['screening result'] != SIZED:
+            self.set_screened_output(res_combination, screening)
+            if self.trace_writer.is_recording():
+                # the trace of a screened res combination is its year without storage
+                self.track_storage_capacity(res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities, 0.0, variable_tracking, need_trace=True)
+            return
+        
+        def evaluate(storage_capacity):
+            self.track_storage_capacity(res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities, storage_capacity, variable_tracking)
+            return variable_tracking.loc[len(variable_tracking)-1, tracked_metric]
+        
+        if self.sizing_initial_capacity is None or pd.isna(self.sizing_initial_capacity):
+            initial_capacity = demand.iloc[:,0].mean()/self.time_step_hours # an hour of average demand
+        else:
+            initial_capacity = float(self.sizing_initial_capacity)
+        solution = solve_storage_capacity(evaluate, self.simulation_details.loc['target_threshold (%)']['value'], self.simulation_details.loc['target_offset (%)']['value'], \
+                                          increasing=increasing, initial_capacity=initial_capacity, growth_factor=self.sizing_growth_factor, max_iterations=self.sizing_max_iterations)
+        instrumentation.log('          ' + solution['message'] + ' after ' + str(solution['iterations']) + ' simulations', 'verbose')
+        instrumentation.count('sizing iterations', solution['iterations'])
+        instrumentation.count('sized res combinations')
+        
+        # output values without storage
+        self.output_df.loc[res_combination, 'annual missing energy without storage (TWh)'] = variable_tracking.loc[0, 'annual_missing_energy']
+        self.output_df.loc[res_combination, 'peak missing energy without storage (MW)'] = variable_tracking.loc[0, 'peak_missing_energy']
+        self.output_df.loc[res_combination, 'curtailment with zero storage (%)'] = variable_tracking.loc[0, 'curtailment (%)']
+        self.output_df.loc[res_combination, 'curtailment with zero storage (TWh)'] = variable_tracking.loc[0, 'curtailment_TWh']
+        self.output_df.loc[res_combination, 'RES penetration without storage (%)'] = variable_tracking.loc[0, 'res_penetration (%)']
+        
+        # the solver may settle on an earlier capacity (or the last evaluation may come from the dispatch cache without its trace),
+        # in which case simulations_df is refreshed for it
+        need_trace = self.trace_writer.is_recording()
+        if variable_tracking.loc[len(variable_tracking)-1, 'storage_capacity'] != solution['storage_capacity'] or (need_trace and self.traced_storage_capacity != solution['storage_capacity']):
+            self.track_storage_capacity(res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities, solution['storage_capacity'], variable_tracking, need_trace)
         
-        # Iterations to find required storage capacity in each year
-        while RES_penetration < self.simulation_details.loc['target_threshold (%)']['value'] and curtailment > 0:
-            self.reset_simulations_df(res_generation, demand)
-            # update BESS characteristics
-            print("     Trying with storage capacity: " + str(storage_capacity) + "MWh")
-            bess_pch_max, bess_pdis_max, bess_min_discharge_level = self.update_bess_specifications(storage_capacity)
-            phs_pmax_dis, phs_min_discharge_level = self.update_phs_specifications(self.storage_specifications["phs"].loc['capacity (MWh)']['value'])
-            self.hourly_energy_simulations(sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
-            # update tracking variables with the results of the current storage capacity
-            variable_tracking.loc[len(variable_tracking), 'storage_capacity'] = storage_capacity
-            variable_tracking.loc[len(variable_tracking)-1, 'power_capacity'] = bess_pdis_max
-            variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)'] = (self.simulations_df.loc[:,'curtailment'].sum()/aggregated_res_generation_df.loc[:,'res_generation'].sum())*100
-            variable_tracking.loc[len(variable_tracking)-1, 'curtailment_TWh'] = self.simulations_df.loc[:,'curtailment'].sum()/1000000
-            variable_tracking.loc[len(variable_tracking)-1, 'max_hourly_curtailment'] = self.simulations_df.loc[:,'curtailment'].max()
-            variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)'] = (self.simulations_df.loc[:,'RES penetration'].sum()/demand.loc[:]['demand'].sum().values[0])*100
-            variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (MWh)'] = self.simulations_df.loc[:,'RES penetration'].sum()
-            variable_tracking.loc[len(variable_tracking)-1, 'annual_missing_energy'] = self.simulations_df.loc[:,'energy shortage'].sum()/1000000 #in TWh
-            variable_tracking.loc[len(variable_tracking)-1, 'peak_missing_energy'] = self.simulations_df.loc[:,'energy shortage'].max()
-            variable_tracking.loc[len(variable_tracking)-1, 'max_periods_until_state_change'] = self.simulations_df.loc[:,'periods since battery state change'].max()
-            
-            print ('          Power capacity: ' + str(variable_tracking.loc[len(variable_tracking)-1, 'power_capacity']) + str(' MW'))
-            print ('          Curtailment: ' + str(variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']) + str('%'))
-            print ('          RES penetration: ' + str(variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)']) + str('%'))
-            
-            curtailment = variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']
-            RES_penetration = variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)']
-            
-            # output values without storage
-            if storage_capacity == 0.0:  
-                self.output_df.loc[res_combination, 'annual missing energy without storage (TWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'annual_missing_energy']
-                self.output_df.loc[res_combination, 'peak missing energy without storage (MW)'] = variable_tracking.loc[len(variable_tracking)-1, 'peak_missing_energy']
-                self.output_df.loc[res_combination, 'curtailment with zero storage (%)'] = variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']
-                self.output_df.loc[res_combination, 'curtailment with zero storage (TWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'curtailment_TWh']
-                self.output_df.loc[res_combination, 'RES penetration without storage (%)'] = variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)']
-            
-            
-            if variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)'] < self.simulation_details.loc['target_threshold (%)']['value'] and \
-                abs(self.simulation_details.loc['target_threshold (%)']['value'] - variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)']) > self.simulation_details.loc['target_offset (%)']['value']:
-                    if len(variable_tracking)>1:
-                        if (variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)'] - variable_tracking.loc[len(variable_tracking)-2, 'res_penetration (%)']) != 0.0:
-                            storage_capacity = self.update_bess_capacity_for_self_consumption_maximization (storage_capacity, variable_tracking)
-                        else:
-                            variable_tracking = variable_tracking.drop(variable_tracking.index[-1])
-                            print ('          RES penetration did not change with capacity change. Exiting loop...')
-                            break
-                    else:
-                        storage_capacity += 0.001
-            else:
-                print ('          Simulations reached required target accuracy. Exiting loop...')
-                break
-            
         # output values with storage
-        print ("     Found required capacity for res combination " +str(res_combination) + ": " + str(variable_tracking.loc[len(variable_tracking)-1, 'storage_capacity']) + "MWh\n")
+        instrumentation.log("     Found required capacity for res combination " +str(res_combination) + ": " + str(variable_tracking.loc[len(variable_tracking)-1, 'storage_capacity']) + "MWh\n", 'verbose')
         self.output_df.loc[res_combination, 'battery_capacity (MWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'storage_capacity']
         self.output_df.loc[res_combination, 'battery_power (MW)'] = variable_tracking.loc[len(variable_tracking)-1, 'power_capacity']
         if 'phs' in self.storage_technologies:
@@ -290,210 +453,787 @@ class StorageSimulations:
         self.output_df.loc[res_combination, 'annual missing energy (TWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'annual_missing_energy']
         self.output_df.loc[res_combination, 'peak missing energy (MW)'] = variable_tracking.loc[len(variable_tracking)-1, 'peak_missing_energy']
         self.output_df.loc[res_combination, 'max periods until state change'] = variable_tracking.loc[len(variable_tracking)-1, 'max_periods_until_state_change']
+        self.output_df.loc[res_combination, 'sizing iterations'] = solution['iterations']
+        self.output_df.loc[res_combination, 'sizing converged'] = solution['converged']
+        if screening is not None:
+            self.output_df.loc[res_combination, 'screening result'] = SIZED
+        return
+    
+    def aggregate_time_series(self, demand, sampled_res_capacities):
+        '''Representative days of the year, clustered on demand and on the shapes of the sampled RES technologies'''
+        if self.profile_store is None:
+            raise ValueError('The time series aggregation needs the RES profile store of RES_Generation_Projections')
+        technologies = [technology for technology in sampled_res_capacities.columns if technology != 'year']
+        aggregation = RepresentativeDays(demand.iloc[:,0].to_numpy(dtype=float), {technology: self.profile_store.shapes[technology] for technology in technologies},
+                                         int(round(24/self.time_step_hours)), self.representative_days, self.aggregation_method, self.aggregation_soc_levels)
+        instrumentation.log('     Clustered ' + str(aggregation.days) + ' days into ' + str(aggregation.medoids.shape[0]) + ' representative days (' + self.aggregation_method + '), demand rebuilt within ' + \
+                            str(round(aggregation.get_profile_error(demand.iloc[:,0].to_numpy(dtype=float)), 2)) + '% root mean square difference')
+        return aggregation
+    
+    def get_aggregated_evaluation(self, res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities, storage_capacity):
+        '''(metrics, None) of an evaluation on the representative days, None without time_series_aggregation'''
+        if self.aggregation is None:
+            return None
+        parameters = self.resolve_batched_dispatch_parameters()
+        res_generation_array = aggregated_res_generation_df.iloc[:,0].to_numpy(dtype=float)
+        demand_array = demand.iloc[:,0].to_numpy(dtype=float)
+        hydro_generation = res_generation['hydro'].iloc[:,0].to_numpy(dtype=float) if 'hydro' in res_generation.keys() else 0.0
+        net_billing_cap = (self.simulation_details.loc['net_billing_percentage (%)']['value']/100) * sampled_res_capacities.loc[res_combination].sum()
+        with instrumentation.dispatch(1, self.aggregation.get_dispatched_days(parameters)*24):
+            summaries = self.aggregation.simulate_dispatch(res_generation_array, demand_array, hydro_generation, [net_billing_cap], [[storage_capacity]], parameters)
+        summaries = {key: value[0, 0] for key, value in summaries.items()}
+        return {
+            'power_capacity': summaries['bess_pdis_max'],
+            'curtailment (%)': (summaries['curtailment']/self.aggregation.get_totals(res_generation_array))*100,
+            'curtailment_TWh': summaries['curtailment']/1000000,
+            'max_hourly_curtailment': summaries['max hourly curtailment'],
+            'res_penetration (%)': (summaries['RES penetration']/self.aggregation.get_totals(demand_array))*100,
+            'res_penetration (MWh)': summaries['RES penetration'],
+            'annual_missing_energy': summaries['energy shortage']/1000000, #in TWh
+            'peak_missing_energy': summaries['peak missing energy'],
+            'max_periods_until_state_change': summaries['max periods since battery state change'],
+            }, None
+    
+    def validate_aggregation(self, year, demand, sampled_res_capacities):
+        '''Sizes up to aggregation_validation_samples res combinations, evenly spread over the sized ones, again at full resolution and
+        simulates the full year at the capacities found on the representative days. Returns the errors of the representative days'''
+        if 'year' in sampled_res_capacities.columns:
+            sampled_res_capacities = sampled_res_capacities.drop('year', axis=1)
+        capacities = pd.to_numeric(self.output_df['battery_capacity (MWh)'], errors='coerce')
+        sized = capacities.index[capacities > 0]
+        if self.aggregation_validation_samples <= 0 or len(sized) == 0:
+            return None
+        validation = sized[np.unique(np.linspace(0, len(sized)-1, min(self.aggregation_validation_samples, len(sized))).round().astype(int))]
+        instrumentation.log('     Validating the representative days against full-resolution sizing of ' + str(len(validation)) + ' res combinations')
+        aggregated_output_df, aggregation, trace_writer, screening = self.output_df, self.aggregation, self.trace_writer, self.screening
+        self.aggregation = None
+        self.trace_writer = TraceWriter(self.output_path, level='none')
+        self.output_df = pd.DataFrame(None, columns=self.output_columns)
+        try:
+            if self.sizing_method == 'capacity_sweep':
+                self.sweep_battery_capacity(year, demand, sampled_res_capacities.loc[validation])
+            else:
+                for res_combination in validation:
+                    self.size_res_combination(year, res_combination, demand, sampled_res_capacities)
+            full_output_df = self.output_df
+            batched_inputs = self.build_batched_inputs(year, demand, sampled_res_capacities.loc[validation], aggregate_by_technology=True)
+            full_year = self.batched_energy_simulations(batched_inputs, capacities.loc[validation].to_numpy(dtype=float)[:, None])
+        finally:
+            self.output_df, self.aggregation, self.trace_writer, self.screening = aggregated_output_df, aggregation, trace_writer, screening
         
-        self.simulations_df.to_excel(self.output_path + 'simulations - res combination ' + str(res_combination) + '.xlsx')
-        
+        validation_df = pd.DataFrame({'battery_capacity (MWh)': capacities.loc[validation]}, index=validation)
+        validation_df['full resolution battery_capacity (MWh)'] = pd.to_numeric(full_output_df['battery_capacity (MWh)'], errors='coerce').reindex(validation)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            validation_df['battery_capacity error (%)'] = (validation_df['battery_capacity (MWh)']/validation_df['full resolution battery_capacity (MWh)'] - 1)*100
+        for metric, summary in [('RES penetration (%)', 'res_penetration (%)'), ('curtailment (%)', 'curtailment (%)')]:
+            validation_df[metric] = pd.to_numeric(aggregated_output_df.loc[validation, metric], errors='coerce')
+            validation_df['full year ' + metric + ' at the same capacity'] = full_year[summary][:, 0]
+            validation_df[metric.replace('(%)', 'error (percentage points)')] = validation_df[metric] - validation_df['full year ' + metric + ' at the same capacity']
+        instrumentation.log('     Representative days: mean absolute battery capacity error ' + str(round(validation_df['battery_capacity error (%)'].abs().mean(), 2)) + '%, RES penetration error ' + \
+                            str(round(validation_df['RES penetration error (percentage points)'].abs().mean(), 3)) + ' and curtailment error ' + \
+                            str(round(validation_df['curtailment error (percentage points)'].abs().mean(), 3)) + ' percentage points')
+        return validation_df
+    
+    def get_screening(self, res_combination):
+        if self.screening is None or res_combination not in self.screening.index:
+            return None
+        return self.screening.loc[res_combination]
+    
+    def get_screened_evaluation(self, res_combination, storage_capacity):
+        '''(metrics, None) of a zero-storage evaluation taken from the screening, None otherwise. The screening adds up the same steps as the
+        dispatch engines in another order, so its metrics differ from theirs by rounding only (around 1e-8 MWh over a year in float64, well
+        below target_offset (%)), whatever the dispatch_engine'''
+        screening = self.get_screening(res_combination)
+        if storage_capacity != 0 or screening is None:
+            return None
+        return {metric: screening[metric] for metric in ['power_capacity', 'curtailment (%)', 'curtailment_TWh', 'max_hourly_curtailment', 'res_penetration (%)', 'res_penetration (MWh)',
+                                                         'annual_missing_energy', 'peak_missing_energy', 'max_periods_until_state_change']}, None
+    
+    def screen_res_combinations(self, year, demand, sampled_res_capacities, batched_inputs=None, tolerance=None):
+        '''Zero-storage metrics (named like the columns of variable_tracking), ideal-storage bound and screening result of every res combination,
+        calculated across all combinations at once. Without batched_inputs the generation is aggregated like size_res_combination does.
+        tolerance defaults to target_offset (%), the convergence tolerance of the iterative sizing'''
+        if batched_inputs is None:
+            batched_inputs = self.build_batched_inputs(year, demand, sampled_res_capacities, aggregate_by_technology=True)
+        if tolerance is None:
+            tolerance = float(self.simulation_details.loc['target_offset (%)']['value'])
+        parameters = self.resolve_batched_dispatch_parameters()
+        energy_to_be_stored, missing_energy, base_penetration = prepare_screening_inputs(batched_inputs['res_generation'], batched_inputs['demand'], batched_inputs['hydro_generation'],
+                                                                                         batched_inputs['net_billing_cap'], parameters)
+        screening = self.calculate_zero_storage_metrics(batched_inputs, parameters, energy_to_be_stored, missing_energy, base_penetration, sampled_res_capacities.index)
+        if parameters['phs_enabled'] and parameters['phs_capacity'] > 0:
+            efficiency = max(parameters['bess_rte'], parameters['phs_rte'])*parameters['hv_to_lv_factor']
+        else:
+            efficiency = parameters['bess_rte']*parameters['hv_to_lv_factor']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            screening['ideal res_penetration (%)'] = (ideal_storage_penetration(energy_to_be_stored, missing_energy, base_penetration, efficiency)/batched_inputs['demand'].sum(axis=1))*100
+        screening['ideal curtailment (%)'] = 0.0 # unbounded storage takes all the energy that cannot be netted
+        tracked_metric = 'res_penetration (%)' if self.simulation_details.loc['target']['value'] == 'demand' else 'curtailment (%)'
+        screening['screening result'] = classify(screening[tracked_metric].to_numpy(), screening['ideal ' + tracked_metric].to_numpy(), float(self.simulation_details.loc['target_threshold (%)']['value']),
+                                                 tolerance, increasing=tracked_metric == 'res_penetration (%)')
+        return screening
+    
+    def calculate_zero_storage_metrics(self, batched_inputs, parameters, energy_to_be_stored, missing_energy, base_penetration, index):
+        '''Zero-storage metrics of every res combination (named like the columns of variable_tracking), calculated across all combinations at once'''
+        if parameters['phs_enabled'] and parameters['phs_capacity'] > 0:
+            # PHS keeps a state without a battery too, so the zero-storage metrics take a dispatch of all combinations
+            zero_storage = self.zero_storage_energy_simulations(batched_inputs, parameters)
+        else:
+            zero_storage = zero_storage_dispatch(energy_to_be_stored, missing_energy, base_penetration, self.time_step_hours)
+        total_res_generation = batched_inputs['res_generation'].sum(axis=1)
+        total_demand = batched_inputs['demand'].sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return pd.DataFrame({
+                'power_capacity': 0.0,
+                'curtailment (%)': (zero_storage['curtailment']/total_res_generation)*100,
+                'curtailment_TWh': zero_storage['curtailment']/1000000,
+                'max_hourly_curtailment': zero_storage['max hourly curtailment'],
+                'res_penetration (%)': (zero_storage['RES penetration']/total_demand)*100,
+                'res_penetration (MWh)': zero_storage['RES penetration'],
+                'annual_missing_energy': zero_storage['energy shortage']/1000000, #in TWh
+                'peak_missing_energy': zero_storage['peak missing energy'],
+                'max_periods_until_state_change': zero_storage['max periods since battery state change'],
+                }, index=index)
+    
+    def zero_storage_energy_simulations(self, batched_inputs, parameters):
+        '''Batched dispatch of every res combination with a single 0 MWh battery candidate, as (combinations,) summaries of simulate_batched_dispatch'''
+        combinations, frames = batched_inputs['res_generation'].shape
+        with instrumentation.dispatch(combinations, combinations*frames*self.time_step_hours):
+            summaries = simulate_batched_dispatch(batched_inputs['res_generation'], batched_inputs['demand'], batched_inputs['hydro_generation'],
+                                                  batched_inputs['net_billing_cap'], np.zeros((combinations, 1)), parameters)
+        return {key: value[:, 0] for key, value in summaries.items()}
+    
+    def set_screened_output(self, res_combination, screening):
+        '''Outputs of a res combination that the screening took out of the sizing: its zero-storage metrics and, when the target is met without storage,
+        a 0 MWh battery. Unreachable targets leave the battery capacity empty'''
+        instrumentation.log('     Res combination ' + str(res_combination) + ': ' + screening['screening result'] + ' (screening, no sizing simulations)', 'verbose')
+        self.output_df.loc[res_combination, 'annual missing energy without storage (TWh)'] = screening['annual_missing_energy']
+        self.output_df.loc[res_combination, 'peak missing energy without storage (MW)'] = screening['peak_missing_energy']
+        self.output_df.loc[res_combination, 'curtailment with zero storage (%)'] = screening['curtailment (%)']
+        self.output_df.loc[res_combination, 'curtailment with zero storage (TWh)'] = screening['curtailment_TWh']
+        self.output_df.loc[res_combination, 'RES penetration without storage (%)'] = screening['res_penetration (%)']
+        if screening['screening result'] == MET_WITHOUT_STORAGE:
+            instrumentation.count('res combinations met without storage')
+            self.output_df.loc[res_combination, 'battery_capacity (MWh)'] = 0.0
+            self.output_df.loc[res_combination, 'battery_power (MW)'] = screening['power_capacity']
+            if 'phs' in self.storage_technologies:
+                self.output_df.loc[res_combination, 'phs_capacity (MWh)'] = self.storage_specifications['phs'].loc['capacity (MWh)']['value']
+            self.output_df.loc[res_combination, 'battery throughput energy (MWh)'] = 0.0
+            self.output_df.loc[res_combination, 'curtailment (%)'] = screening['curtailment (%)']
+            self.output_df.loc[res_combination, 'curtailment (TWh)'] = screening['curtailment_TWh']
+            self.output_df.loc[res_combination, 'max hourly curtailment (MWh)'] = screening['max_hourly_curtailment']
+            self.output_df.loc[res_combination, 'RES penetration (%)'] = screening['res_penetration (%)']
+            self.output_df.loc[res_combination, 'RES penetration (MWh)'] = screening['res_penetration (MWh)']
+            self.output_df.loc[res_combination, 'annual missing energy (TWh)'] = screening['annual_missing_energy']
+            self.output_df.loc[res_combination, 'peak missing energy (MW)'] = screening['peak_missing_energy']
+            self.output_df.loc[res_combination, 'max periods until state change'] = screening['max_periods_until_state_change']
+        else:
+            instrumentation.count('unreachable res combinations')
+        self.output_df.loc[res_combination, 'sizing iterations'] = 0
+        self.output_df.loc[res_combination, 'sizing converged'] = screening['screening result'] == MET_WITHOUT_STORAGE
+        self.output_df.loc[res_combination, 'screening result'] = screening['screening result']
+        return
+    
+    def maximize_self_consumption(self, res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities):
+        self.size_storage_capacity(res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities, 'res_penetration (%)', increasing=True)
+        self.trace_writer.record(res_combination, self.simulations_df)
         return
     
     def minimize_curtailment (self, res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities):
-        # initialization of simulation values...
-        storage_capacity = 0.0 #in MWh
-        curtailment = 100.0 # initialization at maximum % value
-        RES_penetration = 0.0 # initialization at minimum penetration
-
-        # tracking variables which are used to end iterations and save the right results
-        variable_tracking = pd.DataFrame(columns=['storage_capacity', 'power_capacity', 'curtailment (%)', 'curtailment_TWh', 'max_hourly_curtailment', 'res_penetration (%)', \
-                                                  'res_penetration (MWh)', 'annual_missing_energy', 'peak_missing_energy', 'max_periods_until_state_change'])
+        self.size_storage_capacity(res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities, 'curtailment (%)', increasing=False)
+        self.trace_writer.record(res_combination, self.simulations_df)
+        return
+    
+    def resolve_batched_dispatch_parameters(self):
+        '''Storage specifications shared by all members of a batched dispatch. Power limits are kept as ratios because every member has its own capacity'''
+        phs_pmax_dis, phs_min_discharge_level = self.update_phs_specifications(self.storage_specifications["phs"].loc['capacity (MWh)']['value'])
+        parameters = {
+            'time_step_hours': self.time_step_hours,
+            'hv_to_lv_factor': 1-self.simulation_details.loc['hv_to_lv_losses (%)']['value']/100,
+            'bess_duration': self.storage_specifications["battery"].loc['duration']['value'],
+            'bess_charging_rate': self.storage_specifications["battery"].loc['charging rate (%)']['value'],
+            'bess_depth_of_discharge': self.storage_specifications["battery"].loc['depth_of_discharge']['value'],
+            'bess_rte': self.storage_specifications["battery"].loc['round_trip_efficiency']['value']/100,
+            'phs_capacity': self.storage_specifications["phs"].loc['capacity (MWh)']['value'],
+            'phs_pch_max': self.storage_specifications["phs"].loc['pmax_charge (MW)']['value'],
+            'phs_pdis_max': phs_pmax_dis,
+            'phs_min_discharge_level': phs_min_discharge_level,
+            'phs_rte': self.storage_specifications["phs"].loc['round_trip_efficiency (%)']['value']/100,
+            'phs_enabled': "phs" in self.storage_technologies,
+            }
+        parameters = {key: (value if key == 'phs_enabled' else float(value)) for key, value in parameters.items()}
+        parameters['dispatch_precision'] = self.dispatch_precision
+        return parameters
+    
+    def build_batched_inputs(self, year, demand, sampled_res_capacities, aggregate_by_technology=False):
+        '''Stacks the generation of every res combination in (combinations x steps) arrays. Hydro is subtracted from a per-combination copy of demand.
+        With aggregate_by_technology the generation of the profile store is added technology by technology like size_res_combination does, instead of a matrix product'''
+        if 'year' in sampled_res_capacities.columns:
+            sampled_res_capacities = sampled_res_capacities.drop('year', axis=1)
+        hydro_generation_matrix = np.zeros((len(sampled_res_capacities.index), len(demand.index)))
+        if self.profile_store is not None:
+            if aggregate_by_technology:
+                res_generation_matrix = np.zeros((len(sampled_res_capacities.index), len(demand.index)))
+                for technology in sampled_res_capacities.columns:
+                    res_generation_matrix += np.outer(sampled_res_capacities[technology].to_numpy(dtype=float), self.profile_store.shapes[technology])
+            else:
+                res_generation_matrix = self.profile_store.aggregated_generation(sampled_res_capacities)
+            if 'hydro' in sampled_res_capacities.columns:
+                hydro_generation_matrix = np.outer(sampled_res_capacities['hydro'].to_numpy(dtype=float), self.profile_store.shapes['hydro'])
+        else:
+            res_generation_matrix = np.zeros((len(sampled_res_capacities.index), len(demand.index)))
+            for i, res_combination in enumerate(sampled_res_capacities.index):
+                res_generation = self.load_res_generation(year, res_combination, sampled_res_capacities)
+                for technology in res_generation.keys():
+                    res_generation_matrix[i] += res_generation[technology].iloc[:,0].to_numpy(dtype=float)
+                if 'hydro' in res_generation.keys():
+                    hydro_generation_matrix[i] = res_generation['hydro'].iloc[:,0].to_numpy(dtype=float)
+        batched_inputs = {
+            'res_generation': res_generation_matrix,
+            'hydro_generation': hydro_generation_matrix,
+            'demand': demand.iloc[:,0].to_numpy(dtype=float) - hydro_generation_matrix,
+            'net_billing_cap': (self.simulation_details.loc['net_billing_percentage (%)']['value']/100) * sampled_res_capacities.sum(axis=1).to_numpy(dtype=float),
+            }
+        return batched_inputs
+    
+    def batched_energy_simulations(self, batched_inputs, storage_capacities):
+        '''Dispatches every res combination for every candidate storage capacity in a single pass over the year (over the representative days with time_series_aggregation)'''
+        combinations, frames = batched_inputs['res_generation'].shape
+        simulations = combinations*np.shape(storage_capacities)[-1]
+        parameters = self.resolve_batched_dispatch_parameters()
+        if self.aggregation is not None:
+            with instrumentation.dispatch(simulations, simulations*self.aggregation.get_dispatched_days(parameters)*24):
+                summaries = self.aggregation.simulate_dispatch(batched_inputs['res_generation'], batched_inputs['demand'], batched_inputs['hydro_generation'],
+                                                               batched_inputs['net_billing_cap'], storage_capacities, parameters)
+            total_res_generation = self.aggregation.get_totals(batched_inputs['res_generation'])[:, None]
+            total_demand = self.aggregation.get_totals(batched_inputs['demand'])[:, None]
+        else:
+            with instrumentation.dispatch(simulations, simulations*frames*self.time_step_hours):
+                summaries = simulate_batched_dispatch(batched_inputs['res_generation'], batched_inputs['demand'], batched_inputs['hydro_generation'],
+                                                      batched_inputs['net_billing_cap'], storage_capacities, parameters)
+            total_res_generation = batched_inputs['res_generation'].sum(axis=1)[:, None]
+            total_demand = batched_inputs['demand'].sum(axis=1)[:, None]
+        summaries['curtailment (%)'] = (summaries['curtailment']/total_res_generation)*100
+        summaries['res_penetration (%)'] = (summaries['RES penetration']/total_demand)*100
+        return summaries
+    
+    def simulate_ensemble(self, year, demand_mean, demand_volatility, sampled_res_capacities, storage_capacities, seed=None):
+        '''Dispatches every res combination with its storage capacities (combinations or combinations x candidates) across
+        ensemble_realizations stochastic realizations of demand and RES generation, streamed in chunks of ensemble_chunk_size.
+        Returns the mean and P10/P50/P90 of curtailment, RES penetration and energy shortage of every combination and capacity'''
+        if self.profile_store is None:
+            raise ValueError('The ensemble needs the RES profile store of RES_Generation_Projections')
+        if 'year' in sampled_res_capacities.columns:
+            sampled_res_capacities = sampled_res_capacities.drop('year', axis=1)
+        technologies = list(sampled_res_capacities.columns)
+        res_capacities = sampled_res_capacities.to_numpy(dtype=float)
+        storage_capacities = np.asarray(storage_capacities, dtype=float).reshape(len(sampled_res_capacities.index), -1)
+        combinations, candidates = storage_capacities.shape
+        net_billing_cap = (self.simulation_details.loc['net_billing_percentage (%)']['value']/100) * res_capacities.sum(axis=1)
+        parameters = self.resolve_batched_dispatch_parameters()
+        ensemble = StochasticEnsemble(demand_mean, demand_volatility, self.profile_store, technologies, seed)
         
-        # Iterations to find required storage capacity in each year
-        while curtailment > self.simulation_details.loc['target_threshold (%)']['value'] and RES_penetration < 100:
-            self.reset_simulations_df(res_generation, demand)
-            # update BESS characteristics
-            print("     Trying with storage capacity: " + str(storage_capacity) + "MWh")
-            bess_pch_max, bess_pdis_max, bess_min_discharge_level = self.update_bess_specifications(storage_capacity)
-            phs_pmax_dis, phs_min_discharge_level = self.update_phs_specifications(self.storage_specifications["phs"].loc['capacity (MWh)']['value'])
-            self.hourly_energy_simulations(sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+        instrumentation.log('     Dispatching ' + str(combinations*candidates) + ' storage configurations across ' + str(self.ensemble_realizations) + ' realizations of demand and RES generation')
+        metrics = {metric: np.zeros((self.ensemble_realizations, combinations, candidates)) for metric in ['curtailment (%)', 'RES penetration (%)', 'annual missing energy (TWh)']}
+        progress = instrumentation.progress(self.ensemble_realizations, 'Ensemble ' + str(year), unit='realization')
+        for first_realization, demand_realizations, shape_realizations in ensemble.chunks(self.ensemble_realizations, self.ensemble_chunk_size):
+            realizations = demand_realizations.shape[0]
+            res_generation = np.einsum('ct,rtf->rcf', res_capacities, shape_realizations)
+            hydro_generation = np.zeros_like(res_generation)
+            if 'hydro' in technologies:
+                hydro_generation = res_capacities[:, technologies.index('hydro')][None, :, None]*shape_realizations[:, technologies.index('hydro')][:, None, :]
+            member_demand = demand_realizations[:, None, :] - hydro_generation
+            frames = res_generation.shape[2]
+            with instrumentation.dispatch(realizations*combinations*candidates, realizations*combinations*candidates*frames*self.time_step_hours):
+                summaries = simulate_batched_dispatch(res_generation.reshape(-1, frames), member_demand.reshape(-1, frames), hydro_generation.reshape(-1, frames),
+                                                      np.tile(net_billing_cap, realizations), np.tile(storage_capacities, (realizations, 1)), parameters)
+            total_res_generation = res_generation.sum(axis=2).reshape(-1, 1)
+            total_demand = member_demand.sum(axis=2).reshape(-1, 1)
+            chunk = slice(first_realization, first_realization + realizations)
+            metrics['curtailment (%)'][chunk] = ((summaries['curtailment']/total_res_generation)*100).reshape(realizations, combinations, candidates)
+            metrics['RES penetration (%)'][chunk] = ((summaries['RES penetration']/total_demand)*100).reshape(realizations, combinations, candidates)
+            metrics['annual missing energy (TWh)'][chunk] = (summaries['energy shortage']/1000000).reshape(realizations, combinations, candidates)
+            instrumentation.advance(progress, realizations)
+        progress.close()
         
-            # update tracking variables with the results of the current storage capacity
-            variable_tracking.loc[len(variable_tracking), 'storage_capacity'] = storage_capacity
-            variable_tracking.loc[len(variable_tracking)-1, 'power_capacity'] = bess_pdis_max
-            variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)'] = (self.simulations_df.loc[:,'curtailment'].sum()/aggregated_res_generation_df.loc[:,'res_generation'].sum())*100
-            variable_tracking.loc[len(variable_tracking)-1, 'curtailment_TWh'] = self.simulations_df.loc[:,'curtailment'].sum()/1000000
-            variable_tracking.loc[len(variable_tracking)-1, 'max_hourly_curtailment'] = self.simulations_df.loc[:,'curtailment'].max()
-            variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)'] = (self.simulations_df.loc[:,'RES penetration'].sum()/demand.loc[:]['demand'].sum().values[0])*100
-            variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (MWh)'] = self.simulations_df.loc[:,'RES penetration'].sum()
-            variable_tracking.loc[len(variable_tracking)-1, 'annual_missing_energy'] = self.simulations_df.loc[:,'energy shortage'].sum()/1000000 #in TWh
-            variable_tracking.loc[len(variable_tracking)-1, 'peak_missing_energy'] = self.simulations_df.loc[:,'energy shortage'].max()
-            variable_tracking.loc[len(variable_tracking)-1, 'max_periods_until_state_change'] = self.simulations_df.loc[:,'periods since battery state change'].max()
-            
-            print ('          Power capacity: ' + str(variable_tracking.loc[len(variable_tracking)-1, 'power_capacity']) + str(' MW'))
-            print ('          Curtailment: ' + str(variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']) + str('%'))
-            print ('          RES penetration: ' + str(variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)']) + str('%'))
-            
-            curtailment = variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']
-            RES_penetration = variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)']
-            
-            # output values without storage
-            if storage_capacity == 0.0:  
-                self.output_df.loc[res_combination, 'annual missing energy without storage (TWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'annual_missing_energy']
-                self.output_df.loc[res_combination, 'peak missing energy without storage (MW)'] = variable_tracking.loc[len(variable_tracking)-1, 'peak_missing_energy']
-                self.output_df.loc[res_combination, 'curtailment with zero storage (%)'] = variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']
-                self.output_df.loc[res_combination, 'curtailment with zero storage (TWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'curtailment_TWh']
-                self.output_df.loc[res_combination, 'RES penetration without storage (%)'] = variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)']
-            
-            
-            if variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)'] > self.simulation_details.loc['target_threshold (%)']['value'] and \
-                abs(self.simulation_details.loc['target_threshold (%)']['value'] - variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']) > self.simulation_details.loc['target_offset (%)']['value']:
-                    if len(variable_tracking)>1:
-                        if (variable_tracking.loc[len(variable_tracking)-2, 'curtailment (%)'] - variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']) != 0.0:
-                            storage_capacity = self.update_bess_capacity_for_curtailment_minimization (storage_capacity, variable_tracking)
-                        else:
-                            variable_tracking = variable_tracking.drop(variable_tracking.index[-1])
-                            print ('          Curtailment did not change with capacity change. Exiting loop...')
-                            break
-                    else:
-                        storage_capacity += 0.001
+        index = pd.MultiIndex.from_product([sampled_res_capacities.index, range(candidates)], names=['res combination', 'storage candidate'])
+        ensemble_df = pd.DataFrame({'battery_capacity (MWh)': storage_capacities.reshape(-1)}, index=index)
+        for metric, values in metrics.items():
+            for statistic, value in summarize_ensemble(values).items():
+                ensemble_df[metric + ' ' + statistic] = value.reshape(-1)
+        if candidates == 1:
+            ensemble_df = ensemble_df.droplevel('storage candidate')
+        return ensemble_df
+    
+    def sweep_battery_capacity(self, year, demand, sampled_res_capacities):
+        '''Sizes all res combinations at once: a batched dispatch over a grid of candidate capacities, linear interpolation
+        of the target between the bracketing grid points and one more batched dispatch at the interpolated capacities.
+        Only feasible res combinations that the screening (if enabled) leaves to the sizing are dispatched'''
+        target = self.simulation_details.loc['target']['value']
+        target_threshold = self.simulation_details.loc['target_threshold (%)']['value']
+        batched_inputs = self.build_batched_inputs(year, demand, sampled_res_capacities)
+        total_res_generation = batched_inputs['res_generation'].sum(axis=1)
+        total_demand = batched_inputs['demand'].sum(axis=1)
+        if self.capacity_sweep_max is None or pd.isna(self.capacity_sweep_max):
+            capacity_sweep_max = demand.iloc[:,0].sum()/365 # a day of average demand
+        else:
+            capacity_sweep_max = float(self.capacity_sweep_max)
+        storage_capacities = np.linspace(0, capacity_sweep_max, self.capacity_sweep_points)
+        if target == 'demand':
+            feasible = total_res_generation >= total_demand*(target_threshold/100)
+        else:
+            feasible = ((total_res_generation - total_demand)/total_res_generation)*100 <= target_threshold
+        swept = feasible.copy()
+        if self.sizing_screening:
+            with instrumentation.stage('screening'):
+                self.screening = self.screen_res_combinations(year, demand, sampled_res_capacities, batched_inputs, tolerance=0.0) # the sweep sizes to the threshold itself
+            swept &= (self.screening['screening result'] == SIZED).to_numpy()
+        swept = np.flatnonzero(swept)
+        swept_inputs = {key: value[swept] for key, value in batched_inputs.items()}
+        
+        sized_capacities = np.zeros(len(swept))
+        if len(swept) > 0:
+            instrumentation.log('     Sweeping ' + str(self.capacity_sweep_points) + ' storage capacities up to ' + str(capacity_sweep_max) + 'MWh for ' + str(len(swept)) + ' res combinations')
+            sweep = self.batched_energy_simulations(swept_inputs, storage_capacities)
+            metric = sweep['res_penetration (%)'] if target == 'demand' else sweep['curtailment (%)']
+            reached = metric >= target_threshold if target == 'demand' else metric <= target_threshold
+            for j, res_combination in enumerate(sampled_res_capacities.index[swept]):
+                if not reached[j].any():
+                    instrumentation.log('     Target was not reached within the capacity sweep for res combination ' + str(res_combination) + '. Using the largest swept capacity', 'verbose')
+                    sized_capacities[j] = storage_capacities[-1]
+                    continue
+                k = np.argmax(reached[j])
+                if k == 0 or metric[j, k] == metric[j, k-1]:
+                    sized_capacities[j] = storage_capacities[k]
+                else:
+                    sized_capacities[j] = storage_capacities[k-1] + (storage_capacities[k] - storage_capacities[k-1])*(target_threshold - metric[j, k-1])/(metric[j, k] - metric[j, k-1])
+            sized = self.batched_energy_simulations(swept_inputs, sized_capacities[:, None])
+        instrumentation.count('sized res combinations', len(swept))
+        swept_position = {i: j for j, i in enumerate(swept)}
+        
+        for i, res_combination in enumerate(sampled_res_capacities.index):
+            if not feasible[i]:
+                if target == 'demand':
+                    instrumentation.log('RES capacity of scenario ' + str(res_combination) + ' in year ' + str(year) +' is not enough to cover the required demand.', 'verbose')
+                else:
+                    instrumentation.log('RES capacity of scenario ' + str(res_combination) + ' in year ' + str(year) +' is too high to reach the required curtailment levels.', 'verbose')
+                continue
+            self.output_df.loc[res_combination, 'maximization criterion'] =  target
+            self.output_df.loc[res_combination, 'Total Potential RES generation (TWh)'] =  total_res_generation[i]/1000000
+            self.output_df.loc[res_combination, 'Total Demand (TWh)'] = total_demand[i]/1000000
+            if 'solar' in sampled_res_capacities.columns:
+                self.output_df.loc[res_combination, 'pv capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['solar']
+            if 'wind' in sampled_res_capacities.columns:
+                self.output_df.loc[res_combination, 'wind capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['wind']
+            if 'hydro' in sampled_res_capacities.columns:
+                self.output_df.loc[res_combination, 'hydro capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['hydro']
+            if i not in swept_position:
+                self.set_screened_output(res_combination, self.screening.loc[res_combination])
+                continue
+            j = swept_position[i]
+            # output values without storage (first point of the sweep)
+            self.output_df.loc[res_combination, 'annual missing energy without storage (TWh)'] = sweep['energy shortage'][j, 0]/1000000
+            self.output_df.loc[res_combination, 'peak missing energy without storage (MW)'] = sweep['peak missing energy'][j, 0]
+            self.output_df.loc[res_combination, 'curtailment with zero storage (%)'] = sweep['curtailment (%)'][j, 0]
+            self.output_df.loc[res_combination, 'curtailment with zero storage (TWh)'] = sweep['curtailment'][j, 0]/1000000
+            self.output_df.loc[res_combination, 'RES penetration without storage (%)'] = sweep['res_penetration (%)'][j, 0]
+            # output values with storage
+            instrumentation.log("     Found required capacity for res combination " +str(res_combination) + ": " + str(sized_capacities[j]) + "MWh", 'verbose')
+            self.output_df.loc[res_combination, 'battery_capacity (MWh)'] = sized_capacities[j]
+            self.output_df.loc[res_combination, 'battery_power (MW)'] = sized['bess_pdis_max'][j, 0]
+            if 'phs' in self.storage_technologies:
+                self.output_df.loc[res_combination, 'phs_capacity (MWh)'] = self.storage_specifications['phs'].loc['capacity (MWh)']['value']
+            self.output_df.loc[res_combination, 'battery throughput energy (MWh)'] = sized['battery throughput energy (MWh)'][j, 0]
+            self.output_df.loc[res_combination, 'curtailment (%)'] = sized['curtailment (%)'][j, 0]
+            self.output_df.loc[res_combination, 'curtailment (TWh)'] = sized['curtailment'][j, 0]/1000000
+            self.output_df.loc[res_combination, 'max hourly curtailment (MWh)'] = sized['max hourly curtailment'][j, 0]
+            self.output_df.loc[res_combination, 'RES penetration (%)'] = sized['res_penetration (%)'][j, 0]
+            self.output_df.loc[res_combination, 'RES penetration (MWh)'] = sized['RES penetration'][j, 0]
+            self.output_df.loc[res_combination, 'annual missing energy (TWh)'] = sized['energy shortage'][j, 0]/1000000
+            self.output_df.loc[res_combination, 'peak missing energy (MW)'] = sized['peak missing energy'][j, 0]
+            self.output_df.loc[res_combination, 'max periods until state change'] = sized['max periods since battery state change'][j, 0]
+            if self.screening is not None:
+                self.output_df.loc[res_combination, 'screening result'] = SIZED
+        return
+    
+    def size_with_linear_program(self, year, demand, sampled_res_capacities):
+        '''Sizes every feasible res combination with one perfect-foresight linear program (see lp_sizing.py). The linear program schedules
+        storage with knowledge of the whole year, so its capacity is a lower bound of what the dispatch rules of the other methods need.
+        Res combinations that are finished in the open checkpoint journal are taken from it, the others are journaled one by one'''
+        target = self.simulation_details.loc['target']['value']
+        target_threshold = float(self.simulation_details.loc['target_threshold (%)']['value'])
+        batched_inputs = self.build_batched_inputs(year, demand, sampled_res_capacities, aggregate_by_technology=True)
+        total_res_generation = batched_inputs['res_generation'].sum(axis=1)
+        total_demand = batched_inputs['demand'].sum(axis=1)
+        if target == 'demand':
+            feasible = total_res_generation >= total_demand*(target_threshold/100)
+        else:
+            feasible = ((total_res_generation - total_demand)/total_res_generation)*100 <= target_threshold
+        parameters = self.resolve_batched_dispatch_parameters()
+        energy_to_be_stored, missing_energy, base_penetration = prepare_screening_inputs(batched_inputs['res_generation'], batched_inputs['demand'], batched_inputs['hydro_generation'],
+                                                                                         batched_inputs['net_billing_cap'], parameters)
+        if self.sizing_screening:
+            with instrumentation.stage('screening'):
+                self.screening = self.screen_res_combinations(year, demand, sampled_res_capacities, batched_inputs, tolerance=0.0) # the linear program meets the threshold itself
+            zero_storage = self.screening
+        else:
+            zero_storage = self.calculate_zero_storage_metrics(batched_inputs, parameters, energy_to_be_stored, missing_energy, base_penetration, sampled_res_capacities.index)
+        
+        progress = instrumentation.progress(len(sampled_res_capacities.index), 'Sizing ' + str(year))
+        for i, res_combination in enumerate(sampled_res_capacities.index):
+            finished, output = self.checkpoint.get(res_combination, sampled_res_capacities.loc[res_combination])
+            if finished:
+                restore_output(self.output_df, res_combination, output)
+                instrumentation.advance(progress)
+                continue
+            if not feasible[i]:
+                if target == 'demand':
+                    instrumentation.log('RES capacity of scenario ' + str(res_combination) + ' in year ' + str(year) +' is not enough to cover the required demand.', 'verbose')
+                else:
+                    instrumentation.log('RES capacity of scenario ' + str(res_combination) + ' in year ' + str(year) +' is too high to reach the required curtailment levels.', 'verbose')
             else:
-                print ('          Simulations reached required target accuracy. Exiting loop...')
-                break
-            
-        # output values with storage
-        print ("     Found required capacity for res combination " +str(res_combination) + ": " + str(variable_tracking.loc[len(variable_tracking)-1, 'storage_capacity']) + "MWh\n")
-        self.output_df.loc[res_combination, 'battery_capacity (MWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'storage_capacity']
-        self.output_df.loc[res_combination, 'battery_power (MW)'] = variable_tracking.loc[len(variable_tracking)-1, 'power_capacity']
+                self.output_df.loc[res_combination, 'maximization criterion'] =  target
+                self.output_df.loc[res_combination, 'Total Potential RES generation (TWh)'] =  total_res_generation[i]/1000000
+                self.output_df.loc[res_combination, 'Total Demand (TWh)'] = total_demand[i]/1000000
+                if 'solar' in sampled_res_capacities.columns:
+                    self.output_df.loc[res_combination, 'pv capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['solar']
+                if 'wind' in sampled_res_capacities.columns:
+                    self.output_df.loc[res_combination, 'wind capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['wind']
+                if 'hydro' in sampled_res_capacities.columns:
+                    self.output_df.loc[res_combination, 'hydro capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['hydro']
+                if self.sizing_screening and zero_storage.loc[res_combination]['screening result'] != SIZED:
+                    self.set_screened_output(res_combination, zero_storage.loc[res_combination])
+                else:
+                    with instrumentation.stage('linear program'):
+                        solution = solve_lp_storage_capacity(energy_to_be_stored[i], missing_energy[i], base_penetration[i], parameters, target, target_threshold, total_res_generation[i], total_demand[i])
+                    self.set_linear_program_output(res_combination, zero_storage.loc[res_combination], solution, total_res_generation[i], total_demand[i])
+            self.checkpoint.record(res_combination, sampled_res_capacities.loc[res_combination], self.output_df)
+            instrumentation.advance(progress)
+        progress.close()
+        return
+    
+    def set_linear_program_output(self, res_combination, zero_storage, solution, total_res_generation, total_demand):
+        '''Outputs of a res combination sized by the linear program. An infeasible program (the target cannot be reached with any battery) leaves the battery capacity empty
+        and, with sizing_screening, marks the combination unreachable'''
+        self.output_df.loc[res_combination, 'annual missing energy without storage (TWh)'] = zero_storage['annual_missing_energy']
+        self.output_df.loc[res_combination, 'peak missing energy without storage (MW)'] = zero_storage['peak_missing_energy']
+        self.output_df.loc[res_combination, 'curtailment with zero storage (%)'] = zero_storage['curtailment (%)']
+        self.output_df.loc[res_combination, 'curtailment with zero storage (TWh)'] = zero_storage['curtailment_TWh']
+        self.output_df.loc[res_combination, 'RES penetration without storage (%)'] = zero_storage['res_penetration (%)']
+        self.output_df.loc[res_combination, 'lp iterations'] = solution['iterations'] # HiGHS iterations, 'sizing iterations' counts dispatch simulations and stays empty
+        self.output_df.loc[res_combination, 'sizing converged'] = solution['converged']
+        if self.screening is not None:
+            self.output_df.loc[res_combination, 'screening result'] = SIZED if solution['converged'] else UNREACHABLE
+        if not solution['converged']:
+            instrumentation.log('     No battery capacity reaches the target for res combination ' + str(res_combination) + ' (' + str(solution['message']) + ')', 'verbose')
+            instrumentation.count('unreachable res combinations')
+            return
+        instrumentation.count('sized res combinations')
+        storage_capacity = solution['storage_capacity']
+        instrumentation.log("     Found required capacity for res combination " +str(res_combination) + ": " + str(storage_capacity) + "MWh (linear program lower bound)", 'verbose')
+        self.output_df.loc[res_combination, 'battery_capacity (MWh)'] = storage_capacity
+        self.output_df.loc[res_combination, 'battery_power (MW)'] = self.update_bess_specifications(storage_capacity)[1]
         if 'phs' in self.storage_technologies:
             self.output_df.loc[res_combination, 'phs_capacity (MWh)'] = self.storage_specifications['phs'].loc['capacity (MWh)']['value']
-        self.output_df.loc[res_combination, 'curtailment (%)'] = variable_tracking.loc[len(variable_tracking)-1, 'curtailment (%)']
-        self.output_df.loc[res_combination, 'curtailment (TWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'curtailment_TWh']
-        self.output_df.loc[res_combination, 'max hourly curtailment (MWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'max_hourly_curtailment']
-        self.output_df.loc[res_combination, 'RES penetration (%)'] = variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (%)']
-        self.output_df.loc[res_combination, 'RES penetration (MWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'res_penetration (MWh)']
-        self.output_df.loc[res_combination, 'annual missing energy (TWh)'] = variable_tracking.loc[len(variable_tracking)-1, 'annual_missing_energy']
-        self.output_df.loc[res_combination, 'peak missing energy (MW)'] = variable_tracking.loc[len(variable_tracking)-1, 'peak_missing_energy']
-        self.output_df.loc[res_combination, 'max periods until state change'] = variable_tracking.loc[len(variable_tracking)-1, 'max_periods_until_state_change']
+        self.output_df.loc[res_combination, 'battery throughput energy (MWh)'] = solution['battery throughput energy (MWh)']
+        self.output_df.loc[res_combination, 'curtailment (%)'] = (solution['curtailment']/total_res_generation)*100
+        self.output_df.loc[res_combination, 'curtailment (TWh)'] = solution['curtailment']/1000000
+        self.output_df.loc[res_combination, 'max hourly curtailment (MWh)'] = solution['max hourly curtailment']
+        self.output_df.loc[res_combination, 'RES penetration (%)'] = (solution['RES penetration']/total_demand)*100
+        self.output_df.loc[res_combination, 'RES penetration (MWh)'] = solution['RES penetration']
+        self.output_df.loc[res_combination, 'annual missing energy (TWh)'] = solution['energy shortage']/1000000
+        self.output_df.loc[res_combination, 'peak missing energy (MW)'] = solution['peak missing energy']
+        self.output_df.loc[res_combination, 'max periods until state change'] = np.nan # the schedule of the linear program has no dispatch states
         return
     
-    def calculate_battery_capacity(self, year, demand, sampled_res_capacities):
-        self.simulations_df.index = demand.index
-        self.output_df = pd.DataFrame(None, columns=self.output_columns)
-        for res_combination in sampled_res_capacities.index:
-            res_generation = {}
-            for technology in sampled_res_capacities.columns:    
-                input_file_name = technology +' '+ str(round(sampled_res_capacities.loc[res_combination][technology],5))+'MW_generation_' + str(year) + '.csv'
-                res_generation[technology] = pd.read_csv(self.generation_input_data_path + input_file_name, index_col=0, header = 0)
-                res_generation[technology] = self.convert_to_datetime(res_generation[technology])
-            if 'hydro' in res_generation.keys():
-                demand.iloc[:,0] -= res_generation['hydro'].iloc[:,0]
-            '''Still need to develop:
-                    1. Arbitrage
-            '''
-            aggregated_res_generation_df = pd.DataFrame(0, index=demand.index, columns=['res_generation'])
-            for technology in res_generation.keys():    
-                aggregated_res_generation_df.iloc[:,0] += res_generation[technology].iloc[:,0]
-            if self.simulation_details.loc['target']['value'] == 'demand':
-                # import ipdb;ipdb.set_trace()
-                if aggregated_res_generation_df.loc[:]['res_generation'].sum() >= (demand.loc[:]['demand'].sum().values[0]*(self.simulation_details.loc['target_threshold (%)']['value']/100)):
-                    '''!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'''
-                    '''Εδ΄ώ  πρώτα  ελέγχω αν η παραγωγή επαρκεί για να καλυψει την ζήτηση'''
-                    '''!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'''
-                    print ('Finding required storage capacity to maximize RES consumption for res capacity scenario ' + str(res_combination) + ' in year ' + str(year))
-                    self.output_df.loc[res_combination, 'maximization criterion'] =  self.simulation_details.loc['target']['value']
-                    self.output_df.loc[res_combination, 'Total Potential RES generation (TWh)'] =  aggregated_res_generation_df.iloc[:,0].sum()/1000000
-                    self.output_df.loc[res_combination, 'Total Demand (TWh)'] = demand.loc[:]['demand'].sum().values[0]/1000000
-                    if 'solar' in sampled_res_capacities.columns:
-                        self.output_df.loc[res_combination, 'pv capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['solar']
-                    if 'wind' in sampled_res_capacities.columns:
-                        self.output_df.loc[res_combination, 'wind capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['wind']
-                    if 'hydro' in sampled_res_capacities.columns:
-                        self.output_df.loc[res_combination, 'hydro capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['hydro']
+    def size_res_combination(self, year, res_combination, demand, sampled_res_capacities):
+        '''Sizes storage for one res combination. Hydro is subtracted from a copy of demand, so the caller's demand is left untouched'''
+        res_generation = self.load_res_generation(year, res_combination, sampled_res_capacities)
+        demand = demand.copy()
+        if 'hydro' in res_generation.keys():
+            demand.iloc[:,0] -= res_generation['hydro'].iloc[:,0]
+        '''Still need to develop:
+                1. Arbitrage
+        '''
+        aggregated_res_generation_df = pd.DataFrame(0.0, index=demand.index, columns=['res_generation'])
+        for technology in res_generation.keys():    
+            aggregated_res_generation_df.iloc[:,0] += res_generation[technology].iloc[:,0]
+        if self.simulation_details.loc['target']['value'] == 'demand':
+            # import ipdb;ipdb.set_trace()
+            if aggregated_res_generation_df.loc[:]['res_generation'].sum() >= (demand.loc[:]['demand'].sum().values[0]*(self.simulation_details.loc['target_threshold (%)']['value']/100)):
+                '''!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'''
+                '''Εδ΄ώ  πρώτα  ελέγχω αν η παραγωγή επαρκεί για να καλυψει την ζήτηση'''
+                '''!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'''
+                instrumentation.log('Finding required storage capacity to maximize RES consumption for res capacity scenario ' + str(res_combination) + ' in year ' + str(year), 'verbose')
+                self.output_df.loc[res_combination, 'maximization criterion'] =  self.simulation_details.loc['target']['value']
+                self.output_df.loc[res_combination, 'Total Potential RES generation (TWh)'] =  aggregated_res_generation_df.iloc[:,0].sum()/1000000
+                self.output_df.loc[res_combination, 'Total Demand (TWh)'] = demand.loc[:]['demand'].sum().values[0]/1000000
+                if 'solar' in sampled_res_capacities.columns:
+                    self.output_df.loc[res_combination, 'pv capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['solar']
+                if 'wind' in sampled_res_capacities.columns:
+                    self.output_df.loc[res_combination, 'wind capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['wind']
+                if 'hydro' in sampled_res_capacities.columns:
+                    self.output_df.loc[res_combination, 'hydro capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['hydro']
                     
-                    self.maximize_self_consumption(res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities)
-                else:
-                    print('RES capacity of scenario ' + str(res_combination) + ' in year ' + str(year) +' is not enough to cover the required demand.')
+                self.maximize_self_consumption(res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities)
+            else:
+                instrumentation.log('RES capacity of scenario ' + str(res_combination) + ' in year ' + str(year) +' is not enough to cover the required demand.', 'verbose')
             
-            elif self.simulation_details.loc['target']['value'] == 'curtailment':
-                if ((aggregated_res_generation_df.loc[:]['res_generation'].sum()-demand.loc[:]['demand'].sum().values[0])/aggregated_res_generation_df.loc[:]['res_generation'].sum())*100 <= self.simulation_details.loc['target_threshold (%)']['value']:
-                    '''!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'''
-                    '''Εδ΄ώ  πρώτα  ελέγχω αν η παραγωγή είναι υπερβολική για να φτάσουμε τα επιθυμητά επίπεδα curtailment ακόμη και αν καλυφθεί όλη η ζήτηση'''
-                    '''!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'''
-                    print ('Finding required storage capacity to minimize curtailment for res capacity scenario ' + str(res_combination) + ' in year ' + str(year))
-                    self.output_df.loc[res_combination, 'maximization criterion'] =  self.simulation_details.loc['target']['value']
-                    self.output_df.loc[res_combination, 'Total Potential RES generation (TWh)'] =  aggregated_res_generation_df.iloc[:,0].sum()/1000000
-                    self.output_df.loc[res_combination, 'Total Demand (TWh)'] = demand.loc[:]['demand'].sum().values[0]/1000000
-                    if 'solar' in sampled_res_capacities.columns:
-                        self.output_df.loc[res_combination, 'pv capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['solar']
-                    if 'wind' in sampled_res_capacities.columns:
-                        self.output_df.loc[res_combination, 'wind capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['wind']
-                    if 'hydro' in sampled_res_capacities.columns:
-                        self.output_df.loc[res_combination, 'hydro capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['hydro']
+        elif self.simulation_details.loc['target']['value'] == 'curtailment':
+            if ((aggregated_res_generation_df.loc[:]['res_generation'].sum()-demand.loc[:]['demand'].sum().values[0])/aggregated_res_generation_df.loc[:]['res_generation'].sum())*100 <= self.simulation_details.loc['target_threshold (%)']['value']:
+                '''!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'''
+                '''Εδ΄ώ  πρώτα  ελέγχω αν η παραγωγή είναι υπερβολική για να φτάσουμε τα επιθυμητά επίπεδα curtailment ακόμη και αν καλυφθεί όλη η ζήτηση'''
+                '''!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'''
+                instrumentation.log('Finding required storage capacity to minimize curtailment for res capacity scenario ' + str(res_combination) + ' in year ' + str(year), 'verbose')
+                self.output_df.loc[res_combination, 'maximization criterion'] =  self.simulation_details.loc['target']['value']
+                self.output_df.loc[res_combination, 'Total Potential RES generation (TWh)'] =  aggregated_res_generation_df.iloc[:,0].sum()/1000000
+                self.output_df.loc[res_combination, 'Total Demand (TWh)'] = demand.loc[:]['demand'].sum().values[0]/1000000
+                if 'solar' in sampled_res_capacities.columns:
+                    self.output_df.loc[res_combination, 'pv capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['solar']
+                if 'wind' in sampled_res_capacities.columns:
+                    self.output_df.loc[res_combination, 'wind capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['wind']
+                if 'hydro' in sampled_res_capacities.columns:
+                    self.output_df.loc[res_combination, 'hydro capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['hydro']
                     
-                    self.minimize_curtailment(res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities)
-                else:
-                    print('RES capacity of scenario ' + str(res_combination) + ' in year ' + str(year) +' is too high to reach the required curtailment levels.')
-             
-        self.output_df.to_excel(self.output_path + 'res and storage sizing - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '.xlsx')
+                self.minimize_curtailment(res_combination, res_generation, aggregated_res_generation_df, demand, sampled_res_capacities)
+            else:
+                instrumentation.log('RES capacity of scenario ' + str(res_combination) + ' in year ' + str(year) +' is too high to reach the required curtailment levels.', 'verbose')
         return
+    
+    def get_checkpoint_signature(self, stage, year, demand, storage_capacities=None):
+        '''Signature of everything the results of a checkpointed year depend on: settings, storage specifications, demand, RES shapes and,
+        in dispatch mode, the storage capacities the year starts from'''
+        inputs = {'stage': stage, 'year': year, 'storage specifications': {technology: specifications.astype(str).to_dict() for technology, specifications in self.storage_specifications.items()}}
+        arrays = [demand.iloc[:,0].to_numpy(dtype=float)]
+        if self.profile_store is not None:
+            arrays += [self.profile_store.shapes[technology] for technology in sorted(self.profile_store.shapes)]
+        if storage_capacities is not None:
+            arrays.append(storage_capacities['battery_capacity (MWh)'].to_numpy(dtype=float))
+        return self.checkpoint.get_signature(self.simulation_details, inputs, arrays)
+    
+    def calculate_battery_capacity(self, year, demand, sampled_res_capacities):
+        self.simulations_df.index = demand.index
+        resumed_combinations = self.checkpoint.open('sizing', year, self.get_checkpoint_signature('sizing', year, demand))
+        self.trace_writer.open(year, 'sizing', resume=resumed_combinations > 0)
+        self.size_res_combinations(year, demand, sampled_res_capacities)
+        self.checkpoint.complete()
+        self.checkpoint.close()
+        self.aggregation_validation_df = None
+        if self.aggregation is not None:
+            with instrumentation.stage('aggregation validation'):
+                self.aggregation_validation_df = self.validate_aggregation(year, demand, sampled_res_capacities)
+        with instrumentation.stage('output I/O'):
+            self.trace_writer.close()
+            self.output_df.to_excel(self.output_path + 'res and storage sizing - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '.xlsx')
+            if self.aggregation_validation_df is not None:
+                self.aggregation_validation_df.to_excel(self.output_path + 'time series aggregation validation - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '.xlsx')
+        return
+    
+    def size_res_combinations(self, year, demand, sampled_res_capacities):
+        '''Sizes storage for a set of res combinations with the configured sizing method and returns their outputs.
+        Res combinations that are finished in the open checkpoint journal are taken from it instead of being sized again.
+        With sizing_screening, res combinations that meet the target without storage or cannot reach it are not sized (see sizing_screening.py).
+        With time_series_aggregation, the iterative and capacity sweep methods evaluate storage capacities on representative days of the year.
+        Hourly traces (and the outputs of traced res combinations) are still simulated at full resolution at the capacity found'''
+        self.output_df = pd.DataFrame(None, columns=self.output_columns)
+        self.screening = None
+        self.aggregation = None
+        if self.time_series_aggregation and self.sizing_method != 'linear_program':
+            with instrumentation.stage('time series aggregation'):
+                self.aggregation = self.aggregate_time_series(demand, sampled_res_capacities)
+        if self.sizing_method == 'capacity_sweep':
+            checkpointed = [self.checkpoint.get(res_combination, sampled_res_capacities.loc[res_combination]) for res_combination in sampled_res_capacities.index]
+            if all(finished for finished, output in checkpointed):
+                for res_combination, (finished, output) in zip(sampled_res_capacities.index, checkpointed):
+                    restore_output(self.output_df, res_combination, output)
+            else:
+                with instrumentation.stage('capacity sweep'):
+                    self.sweep_battery_capacity(year, demand, sampled_res_capacities) # the sweep keeps no hourly traces
+                for res_combination in sampled_res_capacities.index:
+                    self.checkpoint.record(res_combination, sampled_res_capacities.loc[res_combination], self.output_df, sync=False)
+                self.checkpoint.sync()
+        elif self.sizing_method == 'linear_program':
+            self.size_with_linear_program(year, demand, sampled_res_capacities) # sequential and without hourly traces
+        else:
+            if self.sizing_screening:
+                with instrumentation.stage('screening'):
+                    self.screening = self.screen_res_combinations(year, demand, sampled_res_capacities)
+            if self.parallel_workers > 1:
+                self.output_df = self.run_in_process_pool(_size_res_combination_in_worker, year, demand, sampled_res_capacities, description='Sizing ' + str(year))
+            else:
+                progress = instrumentation.progress(len(sampled_res_capacities.index), 'Sizing ' + str(year))
+                for res_combination in sampled_res_capacities.index:
+                    finished, output = self.checkpoint.get(res_combination, sampled_res_capacities.loc[res_combination])
+                    if finished:
+                        restore_output(self.output_df, res_combination, output)
+                    else:
+                        with instrumentation.stage('sizing solve'):
+                            self.size_res_combination(year, res_combination, demand, sampled_res_capacities)
+                        self.checkpoint.record(res_combination, sampled_res_capacities.loc[res_combination], self.output_df)
+                    instrumentation.advance(progress)
+                progress.close()
+        return self.output_df
 
+    def run_in_process_pool(self, worker, year, demand, sampled_res_capacities, storage_capacities=None, description=''):
+        '''Sends res combinations to a pool of processes. Each worker gets its own copy of this instance, demand and res capacities,
+        and the per-combination outputs, traces, timers and counters are merged back in the order of sampled_res_capacities.
+        Res combinations that are finished in the open checkpoint journal are taken from it, the others are journaled as their results arrive'''
+        combination_results = {}
+        remaining_combinations = []
+        for res_combination in sampled_res_capacities.index:
+            finished, output = self.checkpoint.get(res_combination, sampled_res_capacities.loc[res_combination])
+            if finished:
+                combination_results[res_combination] = (pd.DataFrame(None, columns=self.output_columns), [])
+                restore_output(combination_results[res_combination][0], res_combination, output)
+            else:
+                remaining_combinations.append(res_combination)
+        progress = instrumentation.progress(len(sampled_res_capacities.index), description)
+        instrumentation.advance(progress, len(combination_results))
+        if len(remaining_combinations) > 0:
+            instrumentation.log('     Distributing ' + str(len(remaining_combinations)) + ' res combinations to ' + str(self.parallel_workers) + ' processes')
+            with ProcessPoolExecutor(max_workers=self.parallel_workers, initializer=_initialize_worker, initargs=(self, year, demand, sampled_res_capacities, storage_capacities, instrumentation.settings)) as executor:
+                for res_combination, (combination_output, combination_traces, combination_instrumentation) in zip(remaining_combinations, executor.map(worker, remaining_combinations)):
+                    instrumentation.merge(combination_instrumentation)
+                    self.checkpoint.record(res_combination, sampled_res_capacities.loc[res_combination], combination_output)
+                    instrumentation.advance(progress)
+                    combination_results[res_combination] = (combination_output, combination_traces)
+        progress.close()
+        combination_results = [combination_results[res_combination] for res_combination in sampled_res_capacities.index]
+        for combination_output, combination_traces in combination_results:
+            self.trace_writer.extend(combination_traces)
+        combination_outputs = [combination_output for combination_output, combination_traces in combination_results if not combination_output.empty]
+        if len(combination_outputs) == 0:
+            return pd.DataFrame(None, columns=self.output_columns)
+        return pd.concat(combination_outputs)
+    
     def get_battery_capacity(self):
         storage_capacities = pd.read_excel(self.general_input_data_path + "(dispatch) storage capacity" +".xlsx", header=0, index_col=0)
         return storage_capacities
     
-    def simulate_res_and_storage_dispatch(self, year, demand, sampled_res_capacities, storage_capacities):
-        self.simulations_df.index = demand.index
-        self.output_df = pd.DataFrame(None, columns=self.output_columns)
-        if 'year' in sampled_res_capacities.columns:
-            sampled_res_capacities = sampled_res_capacities.drop('year', axis=1)
-        for res_combination in sampled_res_capacities.index:
-            res_generation = {}
-            for technology in sampled_res_capacities.columns:    
-                input_file_name = technology +' '+ str(round(sampled_res_capacities.loc[res_combination][technology],5))+'MW_generation_' + str(year) + '.csv'
-                res_generation[technology] = pd.read_csv(self.generation_input_data_path + input_file_name, index_col=0, header = 0)
-                res_generation[technology] = self.convert_to_datetime(res_generation[technology])
-            if 'hydro' in res_generation.keys():
-                demand.iloc[:,0] -= res_generation['hydro'].iloc[:,0]
-            aggregated_res_generation_df = pd.DataFrame(0, index=demand.index, columns=['res_generation'])
-            for technology in res_generation.keys():    
-                aggregated_res_generation_df.iloc[:,0] += res_generation[technology].iloc[:,0]
+    def dispatch_res_combination(self, year, res_combination, demand, sampled_res_capacities, storage_capacities):
+        '''Simulates RES and storage dispatch of one res combination with its given storage capacity'''
+        res_generation = self.load_res_generation(year, res_combination, sampled_res_capacities)
+        demand = demand.copy()
+        if 'hydro' in res_generation.keys():
+            demand.iloc[:,0] -= res_generation['hydro'].iloc[:,0]
+        aggregated_res_generation_df = pd.DataFrame(0.0, index=demand.index, columns=['res_generation'])
+        for technology in res_generation.keys():    
+            aggregated_res_generation_df.iloc[:,0] += res_generation[technology].iloc[:,0]
             
-            storage_capacity = storage_capacities.loc[res_combination, "battery_capacity (MWh)"]
-            bess_pch_max, bess_pdis_max, bess_min_discharge_level = self.update_bess_specifications(storage_capacity)
-            phs_pmax_dis, phs_min_discharge_level = self.update_phs_specifications(self.storage_specifications["phs"].loc['capacity (MWh)']['value'])
+        storage_capacity = storage_capacities.loc[res_combination, "battery_capacity (MWh)"]
+        bess_pch_max, bess_pdis_max, bess_min_discharge_level = self.update_bess_specifications(storage_capacity)
+        phs_pmax_dis, phs_min_discharge_level = self.update_phs_specifications(self.storage_specifications["phs"].loc['capacity (MWh)']['value'])
             
-            print ('Simulating RES and storage dispatch for res capacity scenario ' + str(res_combination) + ' in year ' + str(year))
-            self.reset_simulations_df(res_generation, demand)
-            self.hourly_energy_simulations(sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+        instrumentation.log('Simulating RES and storage dispatch for res capacity scenario ' + str(res_combination) + ' in year ' + str(year), 'verbose')
+        self.reset_simulations_df(res_generation, demand)
+        degradation = None
+        if self.degradation_model == 'rainflow':
+            degradation = RainflowDegradation(storage_capacity, self.storage_specifications["battery"].loc['degradation_rate_per_cycle (%)']['value'], self.degradation_dod_exponent, self.degradation_reference_dod)
+        if degradation is not None and self.degradation_update_interval > 0:
+            with instrumentation.dispatch(1, len(demand.index)*self.time_step_hours):
+                self.degrading_energy_simulations(sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, degradation)
+        else:
+            self.energy_simulations(sampled_res_capacities, res_combination, res_generation, aggregated_res_generation_df, demand, storage_capacity, bess_pch_max, bess_pdis_max, bess_min_discharge_level, phs_pmax_dis, phs_min_discharge_level)
+            if degradation is not None:
+                degradation.update(np.concatenate([[bess_min_discharge_level], self.simulations_df.loc[:, 'battery_soc'].to_numpy(dtype=float)])[None, :])
             
             
-            self.output_df.loc[res_combination, 'maximization criterion'] =  None
-            self.output_df.loc[res_combination, 'Total Potential RES generation (TWh)'] =  aggregated_res_generation_df.iloc[:,0].sum()/1000000
-            self.output_df.loc[res_combination, 'Total Demand (TWh)'] = demand.loc[:]['demand'].sum().values[0]/1000000
-            if 'solar' in sampled_res_capacities.columns:
-                self.output_df.loc[res_combination, 'pv capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['solar']
-            if 'wind' in sampled_res_capacities.columns:
-                self.output_df.loc[res_combination, 'wind capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['wind']
-            if 'hydro' in sampled_res_capacities.columns:
-                self.output_df.loc[res_combination, 'hydro capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['hydro']
+        self.output_df.loc[res_combination, 'maximization criterion'] =  None
+        self.output_df.loc[res_combination, 'Total Potential RES generation (TWh)'] =  aggregated_res_generation_df.iloc[:,0].sum()/1000000
+        self.output_df.loc[res_combination, 'Total Demand (TWh)'] = demand.loc[:]['demand'].sum().values[0]/1000000
+        if 'solar' in sampled_res_capacities.columns:
+            self.output_df.loc[res_combination, 'pv capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['solar']
+        if 'wind' in sampled_res_capacities.columns:
+            self.output_df.loc[res_combination, 'wind capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['wind']
+        if 'hydro' in sampled_res_capacities.columns:
+            self.output_df.loc[res_combination, 'hydro capacity (MW)'] =  sampled_res_capacities.loc[res_combination]['hydro']
             
-            self.output_df.loc[res_combination, 'annual missing energy without storage (TWh)'] = None
-            self.output_df.loc[res_combination, 'peak missing energy without storage (MW)'] = None
-            self.output_df.loc[res_combination, 'curtailment with zero storage (%)'] = None
-            self.output_df.loc[res_combination, 'curtailment with zero storage (TWh)'] = None
-            self.output_df.loc[res_combination, 'RES penetration without storage (%)'] = None
+        self.output_df.loc[res_combination, 'annual missing energy without storage (TWh)'] = None
+        self.output_df.loc[res_combination, 'peak missing energy without storage (MW)'] = None
+        self.output_df.loc[res_combination, 'curtailment with zero storage (%)'] = None
+        self.output_df.loc[res_combination, 'curtailment with zero storage (TWh)'] = None
+        self.output_df.loc[res_combination, 'RES penetration without storage (%)'] = None
         
-            self.output_df.loc[res_combination, 'battery_capacity (MWh)'] = storage_capacity
-            self.output_df.loc[res_combination, 'battery_power (MW)'] = bess_pdis_max
-            self.output_df.loc[res_combination, 'battery throughput energy (MWh)'] = self.simulations_df.loc[:, 'battery throughput energy (MWh)'].sum()
-            self.output_df.loc[res_combination, 'battery_cycles'] = self.output_df.loc[res_combination, 'battery throughput energy (MWh)']/(self.output_df.loc[res_combination, 'battery_capacity (MWh)']*2) # pollaplasiazw me 2 epeidh enas kuklos antistoixei se fortish kai ekfortish. Ara 2 fores to battery capacity mou kanoyn enan kuklo
-            self.output_df.loc[res_combination, 'degraded_battery_capacity (MWh)'] = self.output_df.loc[res_combination, 'battery_capacity (MWh)'] * ((100 - self.output_df.loc[res_combination, 'battery_cycles']*self.storage_specifications["battery"].loc['degradation_rate_per_cycle (%)']['value'])/100)
-            if 'phs' in self.storage_technologies:
-                self.output_df.loc[res_combination, 'phs_capacity (MWh)'] = self.storage_specifications['phs'].loc['capacity (MWh)']['value']
-            self.output_df.loc[res_combination, 'curtailment (%)'] = (self.simulations_df.loc[:,'curtailment'].sum()/aggregated_res_generation_df.loc[:,'res_generation'].sum())*100
-            self.output_df.loc[res_combination, 'curtailment (TWh)'] = self.simulations_df.loc[:,'curtailment'].sum()/1000000
-            self.output_df.loc[res_combination, 'max hourly curtailment (MWh)'] = self.simulations_df.loc[:,'curtailment'].max()
-            self.output_df.loc[res_combination, 'RES penetration (%)'] = (self.simulations_df.loc[:,'RES penetration'].sum()/demand.loc[:]['demand'].sum().values[0])*100
-            self.output_df.loc[res_combination, 'annual missing energy (TWh)'] = self.simulations_df.loc[:,'energy shortage'].sum()/1000000 #in TWh
-            self.output_df.loc[res_combination, 'peak missing energy (MW)'] = self.simulations_df.loc[:,'energy shortage'].max()
-            self.output_df.loc[res_combination, 'max periods until state change'] = self.simulations_df.loc[:,'periods since battery state change'].max()
-            
-        self.output_df.to_excel(self.output_path + 'res and storage dispatch - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '.xlsx')
-        return self.output_df.loc[res_combination, 'degraded_battery_capacity (MWh)']
\ No newline at end of file
+        self.output_df.loc[res_combination, 'battery_capacity (MWh)'] = storage_capacity
+        self.output_df.loc[res_combination, 'battery_power (MW)'] = bess_pdis_max
+        self.output_df.loc[res_combination, 'battery throughput energy (MWh)'] = self.simulations_df.loc[:, 'battery throughput energy (MWh)'].sum()
+        if degradation is not None:
+            # rainflow cycles of the state of charge, with depth-of-discharge dependent fade
+            degradation.finalize()
+            self.output_df.loc[res_combination, 'battery_cycles'] = degradation.get_equivalent_cycles()[0]
+            self.output_df.loc[res_combination, 'degraded_battery_capacity (MWh)'] = degradation.get_capacities()[0]
+        else:
+            self.record_throughput_degradation(res_combination)
+        if 'phs' in self.storage_technologies:
+            self.output_df.loc[res_combination, 'phs_capacity (MWh)'] = self.storage_specifications['phs'].loc['capacity (MWh)']['value']
+        self.output_df.loc[res_combination, 'curtailment (%)'] = (self.simulations_df.loc[:,'curtailment'].sum()/aggregated_res_generation_df.loc[:,'res_generation'].sum())*100
+        self.output_df.loc[res_combination, 'curtailment (TWh)'] = self.simulations_df.loc[:,'curtailment'].sum()/1000000
+        self.output_df.loc[res_combination, 'max hourly curtailment (MWh)'] = self.simulations_df.loc[:,'curtailment'].max()/self.time_step_hours
+        self.output_df.loc[res_combination, 'RES penetration (%)'] = (self.simulations_df.loc[:,'RES penetration'].sum()/demand.loc[:]['demand'].sum().values[0])*100
+        self.output_df.loc[res_combination, 'annual missing energy (TWh)'] = self.simulations_df.loc[:,'energy shortage'].sum()/1000000 #in TWh
+        self.output_df.loc[res_combination, 'peak missing energy (MW)'] = self.simulations_df.loc[:,'energy shortage'].max()/self.time_step_hours
+        self.output_df.loc[res_combination, 'max periods until state change'] = self.simulations_df.loc[:,'periods since battery state change'].max()
+        self.trace_writer.record(res_combination, self.simulations_df)
+        return
+    
+    def record_throughput_degradation(self, res_combination):
+        '''Original degradation rule: throughput/(2 x capacity) cycles at degradation_rate_per_cycle (%) each'''
+        self.output_df.loc[res_combination, 'battery_cycles'] = self.output_df.loc[res_combination, 'battery throughput energy (MWh)']/(self.output_df.loc[res_combination, 'battery_capacity (MWh)']*2) # pollaplasiazw me 2 epeidh enas kuklos antistoixei se fortish kai ekfortish. Ara 2 fores to battery capacity mou kanoyn enan kuklo
+        self.output_df.loc[res_combination, 'degraded_battery_capacity (MWh)'] = self.output_df.loc[res_combination, 'battery_capacity (MWh)'] * ((100 - self.output_df.loc[res_combination, 'battery_cycles']*self.storage_specifications["battery"].loc['degradation_rate_per_cycle (%)']['value'])/100)
+        return
+    
+    def simulate_res_and_storage_dispatch(self, year, demand, sampled_res_capacities, storage_capacities):
+        self.simulations_df.index = demand.index
+        self.output_df = pd.DataFrame(None, columns=self.output_columns)
+        if 'year' in sampled_res_capacities.columns:
+            sampled_res_capacities = sampled_res_capacities.drop('year', axis=1)
+        # the storage capacities are part of the signature, so a year is only resumed if the years before it degraded the battery the same way
+        resumed_combinations = self.checkpoint.open('dispatch', year, self.get_checkpoint_signature('dispatch', year, demand, storage_capacities))
+        self.trace_writer.open(year, 'dispatch', resume=resumed_combinations > 0)
+        if self.parallel_workers > 1:
+            self.output_df = self.run_in_process_pool(_dispatch_res_combination_in_worker, year, demand, sampled_res_capacities, storage_capacities, description='Dispatch ' + str(year))
+        else:
+            progress = instrumentation.progress(len(sampled_res_capacities.index), 'Dispatch ' + str(year))
+            for res_combination in sampled_res_capacities.index:
+                finished, output = self.checkpoint.get(res_combination, sampled_res_capacities.loc[res_combination])
+                if finished:
+                    restore_output(self.output_df, res_combination, output)
+                else:
+                    self.dispatch_res_combination(year, res_combination, demand, sampled_res_capacities, storage_capacities)
+                    self.checkpoint.record(res_combination, sampled_res_capacities.loc[res_combination], self.output_df)
+                instrumentation.advance(progress)
+            progress.close()
+        self.checkpoint.complete()
+        self.checkpoint.close()
+        with instrumentation.stage('output I/O'):
+            self.trace_writer.close()
+            self.output_df.to_excel(self.output_path + 'res and storage dispatch - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '.xlsx')
+        return self.output_df.loc[sampled_res_capacities.index[-1], 'degraded_battery_capacity (MWh)']
+
+
+# Process pool workers. Every process keeps its own StorageSimulations instance, so simulations_df and output_df are never shared
+_worker_state = {}
+
+def _initialize_worker(storage, year, demand, sampled_res_capacities, storage_capacities, instrumentation_settings):
+    instrumentation.configure(**{**instrumentation_settings, 'progress_bar': False}) # the main process shows the progress of the pool
+    _worker_state['storage'] = storage
+    storage.trace_writer.file_path = None # traces are handed back to the main process, which owns the archive
+    _worker_state['year'] = year
+    _worker_state['demand'] = demand
+    _worker_state['sampled_res_capacities'] = sampled_res_capacities
+    _worker_state['storage_capacities'] = storage_capacities
+
+def _size_res_combination_in_worker(res_combination):
+    storage = _worker_state['storage']
+    storage.output_df = pd.DataFrame(None, columns=storage.output_columns)
+    instrumentation.reset()
+    with instrumentation.stage('sizing solve'):
+        storage.size_res_combination(_worker_state['year'], res_combination, _worker_state['demand'], _worker_state['sampled_res_capacities'])
+    return storage.output_df, storage.trace_writer.take_pending(), instrumentation.snapshot()
+
+def _dispatch_res_combination_in_worker(res_combination):
+    storage = _worker_state['storage']
+    storage.output_df = pd.DataFrame(None, columns=storage.output_columns)
+    instrumentation.reset()
+    storage.dispatch_res_combination(_worker_state['year'], res_combination, _worker_state['demand'], _worker_state['sampled_res_capacities'], _worker_state['storage_capacities'])
+    return storage.output_df, storage.trace_writer.take_pending(), instrumentation.snapshot()
@@ -1,68 +1,226 @@
 import pandas as pd
+import numpy as np
 import os
 import datetime
-from tqdm import tqdm
 from demand_projections import Demand_Projections
 from res_generation_projections import RES_Generation_Projections
 from storage_v02 import StorageSimulations
 from technoeconomic_calculations import TechnoeconomicCalculations
+from pipeline_scheduler import PipelineScheduler
+from adaptive_sampling import AdaptiveSampler
+from statistics_cache import StatisticsCache
+from instrumentation import instrumentation
 
 class Main:
     
-    def __init__(self):
-        '''Define in what mode should the model run'''
+    def __init__(self, streem_mode="res_and_storage_sizing", simulation_years=None, simulation_overrides=None, results_path=None):
+        '''Define in what mode should the model run. simulation_years and simulation_overrides ({option: value}) replace
+        simulation_years.xlsx and rows of simulation_customization.xlsx, results_path the data/results folder'''
         # Options:
         #   1. res_and_storage_dispatch - DONE
         #   2. res_and_storage_sizing - DONE
-        self.streem_mode = "res_and_storage_sizing"
+        self.streem_mode = streem_mode
 
         self.cwd = os.getcwd()
         self.input_data_path = self.cwd+'/data/'
         self.output_data_path = "/data/res_data/calculated/"
+        self.results_path = self.input_data_path + 'results/' if results_path is None else results_path
         self.simulation_years_file_name = 'simulation_years.xlsx'
         self.simulation_customization_file_name = 'simulation_customization.xlsx'
         
-        self.simulation_years = pd.read_excel(self.input_data_path + self.simulation_years_file_name, header=0, index_col=None).loc[:]['simulation years'].tolist()
+        if simulation_years is None:
+            simulation_years = pd.read_excel(self.input_data_path + self.simulation_years_file_name, header=0, index_col=None).loc[:]['simulation years'].tolist()
+        self.simulation_years = [int(year) for year in simulation_years]
         self.simulation_details = self.get_simulation_details()
+        for option, value in (simulation_overrides or {}).items():
+            self.set_simulation_option(option, value)
         return
 
     def get_simulation_details(self):
         simulation_details = pd.read_excel(self.input_data_path + self.simulation_customization_file_name, header=0, index_col=0)
         return simulation_details
     
-    def get_capacity_samples(self, year):
-        sampled_res_capacities = res_generation_projections.get_sampled_res_capacities(year)
-        sampled_res_capacities.to_excel(self.input_data_path + "res_data/calculated/" + "sampled res capacities " + str(year) +".xlsx")
+    def get_simulation_option(self, option, default):
+        '''Returns an optional setting of simulation_customization.xlsx, falling back to the default for files that do not define it'''
+        if option in self.simulation_details.index:
+            return self.simulation_details.loc[option]['value']
+        return default
+    
+    def set_simulation_option(self, option, value):
+        '''Replaces a setting of simulation_customization.xlsx (in memory). A list sets one row per value, like storage_technology'''
+        values = list(value) if isinstance(value, (list, tuple)) else [value]
+        if len(values) == 1 and (self.simulation_details.index == option).sum() == 1:
+            self.simulation_details.loc[option, 'value'] = values[0]
+            return
+        rows = pd.DataFrame({'value': values}, index=pd.Index([option]*len(values), name=self.simulation_details.index.name))
+        self.simulation_details = pd.concat([self.simulation_details[self.simulation_details.index != option], rows])
+        return
+    
+    def get_simulation_resolution(self):
+        '''Length of a simulation step, set by simulation_resolution (minutes) (one hour by default). Steps must divide an hour'''
+        minutes = self.get_simulation_option('simulation_resolution (minutes)', 60)
+        minutes = 60 if pd.isna(minutes) else int(minutes)
+        if minutes <= 0 or 60 % minutes != 0:
+            raise ValueError('simulation_resolution (minutes) must divide an hour (e.g. 15, 30 or 60), got ' + str(minutes))
+        return pd.Timedelta(minutes=minutes)
+    
+    def get_year_seed(self, year):
+        '''Seed of the random draws of a simulated year, derived from random_seed so that every year is reproducible whatever the order years run in'''
+        random_seed = self.get_simulation_option('random_seed', 0)
+        random_seed = 0 if pd.isna(random_seed) else int(random_seed)
+        return int(np.random.SeedSequence([random_seed, int(year)]).generate_state(1)[0])
+    
+    def get_capacity_samples(self, year, res_generation_projections):
+        sampled_res_capacities = res_generation_projections.get_sampled_res_capacities(year, seed=self.get_year_seed(year))
+        with instrumentation.stage('output I/O'):
+            sampled_res_capacities.to_excel(self.input_data_path + "res_data/calculated/" + "sampled res capacities " + str(year) +".xlsx")
         return sampled_res_capacities
+
+
+# Stages of the res_and_storage_sizing pipeline. They run in the main process or in the worker processes of the
+# pipeline scheduler, and find the instances they use in _pipeline_state
+_pipeline_state = {}
+
+def initialize_pipeline(main, demand_projections, res_generation_projections, storage, technoeconomic_calculations):
+    instrumentation.configure_from_main(main)
+    _pipeline_state['main'] = main
+    _pipeline_state['demand_projections'] = demand_projections
+    _pipeline_state['res_generation_projections'] = res_generation_projections
+    _pipeline_state['storage'] = storage
+    _pipeline_state['technoeconomic_calculations'] = technoeconomic_calculations
+
+def project_demand(year):
+    with instrumentation.stage('demand projection'):
+        demand = _pipeline_state['demand_projections'].calculate_demand(year) # projects demand timeseries for current simulated year
+    return demand[~((demand.index.month == 2) & (demand.index.day == 29))]
+
+def sample_res_capacities(year):
+    with instrumentation.stage('res capacity sampling'):
+        return _pipeline_state['main'].get_capacity_samples(year, _pipeline_state['res_generation_projections']) # uses LHS to sample RES capacities for current simulated year
+
+def generate_res_profiles(year, sampled_res_capacities):
+    with instrumentation.stage('res profile generation'):
+        _pipeline_state['res_generation_projections'].calculate_res_generation_profile(year, sampled_res_capacities) # projects generation timeseries for each sampled RES capacity for the current simulated year
+
+def size_storage(year, demand, sampled_res_capacities, res_profiles):
+    instrumentation.log("Starting storage sizing for year " + str(year))
+    with instrumentation.stage('storage sizing'):
+        _pipeline_state['storage'].calculate_battery_capacity(year, demand, sampled_res_capacities)
+    return _pipeline_state['storage'].output_df
+
+def adaptive_size_storage(year, demand):
+    '''Samples res capacities adaptively: each batch is sized, and surrogates of the sized results choose the next batch'''
+    main = _pipeline_state['main']
+    storage = _pipeline_state['storage']
+    res_generation_projections = _pipeline_state['res_generation_projections']
+    instrumentation.log("Starting adaptive sampling and storage sizing for year " + str(year))
     
+    def evaluate(sampled_res_capacities):
+        res_generation_projections.calculate_res_generation_profile(year, sampled_res_capacities)
+        output_df = storage.size_res_combinations(year, demand, sampled_res_capacities).copy()
+        eac_results = _pipeline_state['technoeconomic_calculations'].evaluate_eac(output_df)
+        output_df['EAC/MWh (€/MWh)'] = eac_results['EAC/MWh (€/MWh)'][0]
+        return output_df
+    
+    sampler = AdaptiveSampler(res_generation_projections.lhs, main.get_simulation_option('adaptive_initial_samples', 10), main.get_simulation_option('adaptive_batch_size', 5),
+                              res_generation_projections.number_of_res_capacity_samples, main.get_simulation_option('adaptive_tolerance', 0.05))
+    storage.simulations_df.index = demand.index
+    resumed_combinations = storage.checkpoint.open('sizing', year, storage.get_checkpoint_signature('sizing', year, demand)) # the seeded sampler proposes the same batches again, so finished ones are reused
+    storage.trace_writer.open(year, 'sizing', resume=resumed_combinations > 0)
+    with instrumentation.stage('storage sizing'):
+        sampled_res_capacities, output_df = sampler.run(res_generation_projections.get_sampling_ranges(year), evaluate, seed=main.get_year_seed(year))
+    storage.checkpoint.complete()
+    storage.checkpoint.close()
+    storage.output_df = output_df.drop(columns='EAC/MWh (€/MWh)')
+    with instrumentation.stage('output I/O'):
+        storage.trace_writer.close()
+        sampled_res_capacities.to_excel(main.input_data_path + "res_data/calculated/" + "sampled res capacities " + str(year) +".xlsx")
+        pd.DataFrame(sampler.history).to_excel(storage.output_path + 'adaptive sampling convergence - ' + str(year) + '.xlsx')
+        storage.output_df.to_excel(storage.output_path + 'res and storage sizing - objective ' + storage.simulation_details.loc['target']['value'] +' - '+ str(year) + '.xlsx')
+    return storage.output_df
 
-if __name__ == "__main__":
-    main = Main()
-    demand_projections = Demand_Projections() # On instance initiation calculates the statistics of historical demand
-    res_generation_projections = RES_Generation_Projections(main) # On instance initiation calculates the statistics of historical generation per technology (solar, wind and hydro)
-    storage = StorageSimulations(main) # On instance initiation creates the "simulations" and "output" dataframes
-    technoeconomic_calculations = TechnoeconomicCalculations(main)
-    print ('\nPre-processing completed succesfully!\n\n')
+def calculate_eac(year, output_df):
+    with instrumentation.stage('EAC'):
+        return _pipeline_state['technoeconomic_calculations'].calculate_eac(year, output_df)
+
+def simulate_ensemble(year, output_df):
+    storage = _pipeline_state['storage']
+    sized_output_df = output_df[output_df['battery_capacity (MWh)'].notna()]
+    if storage.ensemble_realizations == 0 or sized_output_df.empty:
+        return None
+    instrumentation.log("Starting ensemble simulations for year " + str(year))
+    sampled_res_capacities = pd.DataFrame({'solar': sized_output_df['pv capacity (MW)'], 'wind': sized_output_df['wind capacity (MW)'], 'hydro': sized_output_df['hydro capacity (MW)']})
+    sampled_res_capacities = sampled_res_capacities[[technology for technology in _pipeline_state['res_generation_projections'].assessed_technologies]].astype(float)
+    demand_mean, demand_volatility = _pipeline_state['demand_projections'].get_projected_statistics(year)
+    with instrumentation.stage('ensemble'):
+        ensemble_df = storage.simulate_ensemble(year, demand_mean, demand_volatility, sampled_res_capacities, sized_output_df['battery_capacity (MWh)'].to_numpy(dtype=float), seed=_pipeline_state['main'].get_year_seed(year))
+    with instrumentation.stage('output I/O'):
+        ensemble_df.to_excel(storage.output_path + 'res and storage ensemble - objective ' + storage.simulation_details.loc['target']['value'] + ' - ' + str(year) + '.xlsx')
+    return ensemble_df
+
+
+def preprocess(main):
+    '''Historical statistics of demand and RES generation. They only depend on the data files and the simulation resolution,
+    so one preprocessing can serve every run of the same resolution (see scenario_runner.py)'''
+    if main.get_simulation_option('clear_statistics_cache', False):
+        StatisticsCache(main.input_data_path + 'cache/').clear() # once per run, before any entry of this run is saved
+    with instrumentation.stage('preprocessing'):
+        demand_projections = Demand_Projections(main) # On instance initiation calculates the statistics of historical demand
+        res_generation_projections = RES_Generation_Projections(main) # On instance initiation calculates the statistics of historical generation per technology (solar, wind and hydro)
+    return demand_projections, res_generation_projections
+
+def run(main, demand_projections, res_generation_projections, storage=None, technoeconomic_calculations=None):
+    '''Runs the streem_mode of main on preprocessed projections. Returns {year: output_df} (with EAC in res_and_storage_sizing mode)'''
+    with instrumentation.stage('preprocessing'):
+        res_generation_projections.set_sampling_options(main)
+        if storage is None:
+            storage = StorageSimulations(main, res_generation_projections.profile_store) # On instance initiation creates the "simulations" and "output" dataframes
+        if technoeconomic_calculations is None:
+            technoeconomic_calculations = TechnoeconomicCalculations(main)
+    instrumentation.log('\nPre-processing completed succesfully!\n\n')
+    outputs = {}
     if main.streem_mode == "res_and_storage_sizing":
+        # Sizing years are independent, so their stages are scheduled as tasks and up to pipeline_workers years run concurrently
+        scheduler = PipelineScheduler(main.get_simulation_option('pipeline_workers', 1), initializer=initialize_pipeline, initargs=(main, demand_projections, res_generation_projections, storage, technoeconomic_calculations))
         for year in main.simulation_years:
-            print ("Starting simulations for year " + str(year))
-            demand = demand_projections.calculate_demand(year) # projects demand timeseries for current simulated year
-            demand = demand[~((demand.index.month == 2) & (demand.index.day == 29))]
-            sampled_res_capacities = main.get_capacity_samples(year) # uses LHS to sample RES capacities for current simulated year
-            res_generation_projections.calculate_res_generation_profile(year, sampled_res_capacities) # projects generation timeseries for each sampled RES capacity for the current simulated year
-            storage.calculate_battery_capacity(year, demand, sampled_res_capacities)
-            technoeconomic_calculations.calculate_eac(year)
+            scheduler.add_task(('demand', year), project_demand, year)
+            if main.get_simulation_option('sampling_strategy', 'fixed') == 'adaptive':
+                scheduler.add_task(('sizing', year), adaptive_size_storage, year, dependencies=[('demand', year)])
+            else:
+                scheduler.add_task(('sampling', year), sample_res_capacities, year)
+                scheduler.add_task(('profiles', year), generate_res_profiles, year, dependencies=[('sampling', year)])
+                scheduler.add_task(('sizing', year), size_storage, year, dependencies=[('demand', year), ('sampling', year), ('profiles', year)])
+            scheduler.add_task(('eac', year), calculate_eac, year, dependencies=[('sizing', year)])
+            scheduler.add_task(('ensemble', year), simulate_ensemble, year, dependencies=[('sizing', year)])
+        pipeline_results = scheduler.run()
+        outputs = {year: pipeline_results[('eac', year)] for year in main.simulation_years}
     elif main.streem_mode == "res_and_storage_dispatch":
+        # Dispatch years stay sequential: every year starts from the storage capacity degraded in the previous year
         sampled_res_capacities = pd.read_excel(main.input_data_path + "res_data/input/" + "(dispatch) sampled res capacities" + ".xlsx", header=0, index_col=0)
         storage_capacities = storage.get_battery_capacity()
         for year in main.simulation_years:
-            print ("Starting simulations for year " + str(year))
-            demand = demand_projections.calculate_demand(year) # projects demand timeseries for current simulated year
+            instrumentation.log("Starting simulations for year " + str(year))
+            with instrumentation.stage('demand projection'):
+                demand = demand_projections.calculate_demand(year) # projects demand timeseries for current simulated year
             demand = demand[~((demand.index.month == 2) & (demand.index.day == 29))]
             yearly_sampled_res_capacities = sampled_res_capacities.loc[sampled_res_capacities['year']==year]
             yearly_storage_capacity = storage_capacities.loc[storage_capacities['year']==year]
-            res_generation_projections.calculate_res_generation_profile(year, yearly_sampled_res_capacities) # projects generation timeseries for each sampled RES capacity for the current simulated year
-            degraded_storage_capacity = storage.simulate_res_and_storage_dispatch(year, demand, yearly_sampled_res_capacities, yearly_storage_capacity)
+            with instrumentation.stage('res profile generation'):
+                res_generation_projections.calculate_res_generation_profile(year, yearly_sampled_res_capacities) # projects generation timeseries for each sampled RES capacity for the current simulated year
+            with instrumentation.stage('storage dispatch'):
+                degraded_storage_capacity = storage.simulate_res_and_storage_dispatch(year, demand, yearly_sampled_res_capacities, yearly_storage_capacity)
+            outputs[year] = storage.output_df.copy()
             storage_capacities.loc[storage_capacities.shape[0],'year'] = year+1
             storage_capacities.loc[len(storage_capacities)-1, 'battery_capacity (MWh)'] = degraded_storage_capacity
-    import ipdb;ipdb.set_trace()
\ No newline at end of file
+    else:
+        raise ValueError('streem_mode must be res_and_storage_sizing or res_and_storage_dispatch, got ' + str(main.streem_mode))
+    if main.get_simulation_option('run_report', True):
+        instrumentation.write_report(storage.output_path + 'run report')
+    return outputs
+
+
+if __name__ == "__main__":
+    main = Main()
+    instrumentation.configure_from_main(main) # verbosity, progress bars and dispatch profiling
+    demand_projections, res_generation_projections = preprocess(main)
+    run(main, demand_projections, res_generation_projections)
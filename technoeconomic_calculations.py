@@ -1,4 +1,8 @@
+import itertools
+import numpy as np
 import pandas as pd
+from sensitivity import SensitivityAnalysis
+from instrumentation import instrumentation
 
 
 class TechnoeconomicCalculations:
@@ -7,69 +11,129 @@ class TechnoeconomicCalculations:
         
         self.cwd = main.cwd
         self.input_data_path = main.input_data_path
-        self.output_data_path = self.input_data_path + 'results/'
+        self.output_data_path = main.results_path
         self.technoeconomic_assumptions_file = "technoeconomic_assumptions.xlsx"
         
         self.simulation_details = main.simulation_details
         self.technoeconomic_assumptions = pd.read_excel(self.input_data_path + self.technoeconomic_assumptions_file, index_col=0, header=0)
         
         self.storage_specifications = {}
-        self.storage_technologies = main.simulation_details.loc['storage_technology']['value'].values
+        self.storage_technologies = main.simulation_details.loc[['storage_technology'], 'value'].values
         for storage_technology in self.storage_technologies:
             self.storage_specifications[storage_technology] = pd.read_excel(self.input_data_path + storage_technology + '_characteristics.xlsx', index_col=0, header=0)
+        
+        # Optional sheet of technoeconomic assumption sets (one set per row, one assumption per column) evaluated on top of the base assumptions
+        self.assumption_sets_file = main.get_simulation_option('technoeconomic_assumption_sets_file', None)
+        if pd.isna(self.assumption_sets_file):
+            self.assumption_sets_file = None
+        # Optional one-at-a-time and Monte Carlo sensitivity of EAC/MWh to every assumption (see sensitivity.py)
+        self.sensitivity_analysis = bool(main.get_simulation_option('sensitivity_analysis', False))
+        self.sensitivity = SensitivityAnalysis(main, self)
         return
     
     
-    def calculate_eac(self, year):
+    def calculate_eac(self, year, output_df=None):
+        '''Adds capital cost, EAC and EAC/MWh to the sizing results of a year. output_df is the output_df of StorageSimulations,
+        the sizing Excel file of the year is read when it is not given'''
+        if output_df is None:
+            output_df = pd.read_excel(self.output_data_path + 'res and storage sizing - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '.xlsx', index_col=0, header=0)
+        output_file = output_df.copy()
         
-        output_file = pd.read_excel(self.output_data_path + 'res and storage sizing - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '.xlsx', index_col=0, header=0)
+        eac_results = self.evaluate_eac(output_file)
+        output_file['Capital Cost (M€)'] = eac_results['Capital Cost (M€)'][0]
+        output_file['EAC (€)'] = eac_results['EAC (€)'][0]
+        output_file['EAC/MWh (€/MWh)'] = eac_results['EAC/MWh (€/MWh)'][0]
+        with instrumentation.stage('output I/O'):
+            output_file.to_excel(self.output_data_path + 'res and storage sizing - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '_with_EAC.xlsx')
         
-        pv_capital_recovery_factor = self.technoeconomic_assumptions.loc['interest']['value']/(1-(1+self.technoeconomic_assumptions.loc['interest']['value'])**(-self.technoeconomic_assumptions.loc['lifetime-pv (years)']['value']))
-        wind_capital_recovery_factor = self.technoeconomic_assumptions.loc['interest']['value']/(1-(1+self.technoeconomic_assumptions.loc['interest']['value'])**(-self.technoeconomic_assumptions.loc['lifetime-wind (years)']['value']))
-        hydro_capital_recovery_factor = self.technoeconomic_assumptions.loc['interest']['value']/(1-(1+self.technoeconomic_assumptions.loc['interest']['value'])**(-self.technoeconomic_assumptions.loc['lifetime-hydro (years)']['value']))
-        bess_capital_recovery_factor = self.technoeconomic_assumptions.loc['interest']['value']/(1-(1+self.technoeconomic_assumptions.loc['interest']['value'])**(-self.technoeconomic_assumptions.loc['lifetime-bess (years)']['value']))
+        if self.assumption_sets_file is not None:
+            assumption_sets = pd.read_excel(self.input_data_path + self.assumption_sets_file, index_col=0, header=0)
+            instrumentation.log('     Evaluating EAC of ' + str(len(output_file.index)) + ' scenarios for ' + str(len(assumption_sets.index)) + ' technoeconomic assumption sets')
+            eac_sweep = self.calculate_eac_sweep(output_file, assumption_sets)
+            with instrumentation.stage('output I/O'):
+                eac_sweep.to_excel(self.output_data_path + 'res and storage sizing - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '_EAC_sweep.xlsx')
         
-        for scenario in output_file.index:
-            if not pd.isna(output_file.loc[scenario, 'pv capacity (MW)']):
-                pv_capital_cost = output_file.loc[scenario]['pv capacity (MW)'] * self.technoeconomic_assumptions.loc['CC-pv (€/MW)']['value']
-                pv_o_m_cost = output_file.loc[scenario]['pv capacity (MW)'] * self.technoeconomic_assumptions.loc['O&M-pv  (€/MW)']['value']
-            else:
-                pv_capital_cost = 0
-                pv_o_m_cost = 0
-            
-            if not pd.isna(output_file.loc[scenario, 'wind capacity (MW)']):
-                wind_capital_cost = output_file.loc[scenario]['wind capacity (MW)'] * self.technoeconomic_assumptions.loc['CC-wind (€/MW)']['value']
-                wind_o_m_cost = output_file.loc[scenario]['wind capacity (MW)'] * self.technoeconomic_assumptions.loc['O&M-wind  (€/MW)']['value']
-            else:
-                wind_capital_cost = 0
-                wind_o_m_cost = 0
-               
-            if not pd.isna(output_file.loc[scenario, 'hydro capacity (MW)']):
-                hydro_capital_cost = output_file.loc[scenario]['hydro capacity (MW)'] * self.technoeconomic_assumptions.loc['CC-hydro (€/MW)']['value']
-                hydro_o_m_cost = output_file.loc[scenario]['hydro capacity (MW)'] * self.technoeconomic_assumptions.loc['O&M-hydro  (€/MW)']['value']
-            else:
-                hydro_capital_cost = 0
-                hydro_o_m_cost = 0
-                
-            if not pd.isna(output_file.loc[scenario, 'battery_capacity (MWh)']):
-                bess_power_component = max(output_file.loc[scenario]['battery_power (MW)'], output_file.loc[scenario]['battery_capacity (MWh)']/(100/self.storage_specifications["battery"].loc['charging rate (%)']['value']))
-                bess_capital_cost = output_file.loc[scenario]['battery_capacity (MWh)'] * self.technoeconomic_assumptions.loc['CC-bess (€/MWh)']['value'] + bess_power_component * self.technoeconomic_assumptions.loc['CC-bess (€/MW)']['value']
-                bess_o_m_cost = bess_power_component * self.technoeconomic_assumptions.loc['O&M-bess (€/MW)']['value']
+        if self.sensitivity_analysis:
+            sensitivity_tables = self.sensitivity.run(year, output_file)
+            if sensitivity_tables is not None:
+                with instrumentation.stage('output I/O'):
+                    with pd.ExcelWriter(self.output_data_path + 'res and storage sizing - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '_EAC_sensitivity.xlsx') as writer:
+                        for sheet_name, table in sensitivity_tables.items():
+                            table.to_excel(writer, sheet_name=sheet_name)
+        return output_file
+    
+    def calculate_eac_sweep(self, output_df, assumption_sets):
+        '''EAC of every scenario of output_df under every row of assumption_sets (columns named like the rows of technoeconomic_assumptions.xlsx).
+        Returns a frame indexed by (assumption set, scenario), no dispatch is re-run'''
+        eac_results = self.evaluate_eac(output_df, assumption_sets)
+        index = pd.MultiIndex.from_product([assumption_sets.index, output_df.index], names=['assumption set', 'scenario'])
+        eac_sweep = pd.DataFrame({column: values.ravel() for column, values in eac_results.items()}, index=index)
+        for assumption in assumption_sets.columns:
+            eac_sweep.insert(eac_sweep.columns.get_loc('Capital Cost (M€)'), assumption, np.repeat(assumption_sets[assumption].to_numpy(), len(output_df.index)))
+        return eac_sweep
+    
+    def build_assumption_grid(self, assumption_values):
+        '''Full factorial grid of assumption sets from {assumption: list of values}'''
+        assumption_sets = pd.DataFrame(list(itertools.product(*assumption_values.values())), columns=list(assumption_values.keys()))
+        assumption_sets.index.name = 'assumption set'
+        return assumption_sets
+    
+    def get_assumption_values(self, assumption_sets=None):
+        '''(assumption sets x 1) array of every assumption, assumptions missing from assumption_sets keep their technoeconomic_assumptions.xlsx value'''
+        number_of_sets = 1 if assumption_sets is None else len(assumption_sets.index)
+        unknown_assumptions = [] if assumption_sets is None else [assumption for assumption in assumption_sets.columns if assumption not in self.technoeconomic_assumptions.index]
+        if len(unknown_assumptions) > 0:
+            raise KeyError('Unknown technoeconomic assumptions: ' + ', '.join(unknown_assumptions))
+        assumption_values = {}
+        for assumption in self.technoeconomic_assumptions.index:
+            if assumption_sets is not None and assumption in assumption_sets.columns:
+                assumption_values[assumption] = assumption_sets[assumption].to_numpy(dtype=float).reshape(-1, 1)
             else:
-                bess_capital_cost = 0
-                bess_o_m_cost = 0
-            
-            ''' Αφαίρεση επιδοτήσεων από το capital cost'''
-            total_capital_cost = pv_capital_cost + wind_capital_cost + hydro_capital_cost + bess_capital_cost - self.technoeconomic_assumptions.loc['national subsidy (€)']['value']
-            ''' Αφαίρεση επιδοτήσεων από το capital cost'''
-            total_o_m_cost = pv_o_m_cost + wind_o_m_cost + hydro_o_m_cost + bess_o_m_cost
-            total_equivalent_annual_cost = total_capital_cost * pv_capital_recovery_factor + total_o_m_cost
-                                           
-            eac_per_mwh = total_equivalent_annual_cost / output_file.loc[scenario]['RES penetration (MWh)']
-            output_file.loc[scenario, 'Capital Cost (M€)'] = total_capital_cost/1000000
-            output_file.loc[scenario, 'EAC (€)'] = total_equivalent_annual_cost
-            output_file.loc[scenario, 'EAC/MWh (€/MWh)'] = eac_per_mwh
+                assumption_values[assumption] = np.full((number_of_sets, 1), float(self.technoeconomic_assumptions.loc[assumption]['value']))
+        return assumption_values
+    
+    def capital_recovery_factor(self, interest, lifetime):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(interest == 0, 1/lifetime, interest/(1-(1+interest)**(-lifetime)))
+    
+    def get_scenario_column(self, output_df, column):
+        '''(1 x scenarios) array of a column of output_df, NaN when output_df does not have it'''
+        if column not in output_df.columns:
+            return np.full((1, len(output_df.index)), np.nan)
+        return pd.to_numeric(output_df[column], errors='coerce').to_numpy(dtype=float).reshape(1, -1)
+    
+    def evaluate_eac_components(self, output_df, assumption_sets=None):
+        '''Capital cost, capital recovery factor, O&M cost and EAC of every technology component (pv, wind, hydro, bess) as
+        (assumption sets x scenarios) arrays. Every component is annualized over its own lifetime'''
+        assumptions = self.get_assumption_values(assumption_sets)
+        capacities = {technology: np.nan_to_num(self.get_scenario_column(output_df, technology + ' capacity (MW)')) for technology in ['pv', 'wind', 'hydro']}
+        battery_capacity = self.get_scenario_column(output_df, 'battery_capacity (MWh)')
+        
+        components = {}
+        for technology, capacity in capacities.items():
+            components[technology] = {'capital cost': capacity * assumptions['CC-' + technology + ' (€/MW)'], 'O&M cost': capacity * assumptions['O&M-' + technology + '  (€/MW)']}
+        bess_power_component = np.maximum(self.get_scenario_column(output_df, 'battery_power (MW)'), battery_capacity/(100/self.storage_specifications["battery"].loc['charging rate (%)']['value']))
+        has_battery = ~np.isnan(battery_capacity)
+        components['bess'] = {'capital cost': np.where(has_battery, battery_capacity * assumptions['CC-bess (€/MWh)'] + bess_power_component * assumptions['CC-bess (€/MW)'], 0),
+                              'O&M cost': np.where(has_battery, bess_power_component * assumptions['O&M-bess (€/MW)'], 0)}
+        for technology, component in components.items():
+            component['capital recovery factor'] = self.capital_recovery_factor(assumptions['interest'], assumptions['lifetime-' + technology + ' (years)'])
+            component['EAC'] = component['capital cost'] * component['capital recovery factor'] + component['O&M cost']
+        return components, assumptions
+    
+    def evaluate_eac(self, output_df, assumption_sets=None):
+        '''Capital cost, EAC and EAC/MWh as (assumption sets x scenarios) arrays, a single set of the base assumptions when assumption_sets is None'''
+        components, assumptions = self.evaluate_eac_components(output_df, assumption_sets)
+        gross_capital_cost = sum(component['capital cost'] for component in components.values())
+        annualized_capital_cost = sum(component['capital cost'] * component['capital recovery factor'] for component in components.values())
+        total_o_m_cost = sum(component['O&M cost'] for component in components.values())
         
-        output_file.to_excel(self.output_data_path + 'res and storage sizing - objective ' + self.simulation_details.loc['target']['value'] +' - '+ str(year) + '_with_EAC.xlsx')
+        ''' Αφαίρεση επιδοτήσεων από το capital cost'''
+        # the subsidy is shared by the components in proportion to their capital cost, so it is annualized with their capital-weighted recovery factor
+        with np.errstate(divide='ignore', invalid='ignore'):
+            subsidy_recovery_factor = np.where(gross_capital_cost > 0, annualized_capital_cost/gross_capital_cost, components['pv']['capital recovery factor'])
+        total_capital_cost = gross_capital_cost - assumptions['national subsidy (€)']
+        total_equivalent_annual_cost = annualized_capital_cost - assumptions['national subsidy (€)'] * subsidy_recovery_factor + total_o_m_cost
         
-        return
\ No newline at end of file
+        eac_per_mwh = total_equivalent_annual_cost / self.get_scenario_column(output_df, 'RES penetration (MWh)')
+        return {'Capital Cost (M€)': total_capital_cost/1000000, 'EAC (€)': total_equivalent_annual_cost, 'EAC/MWh (€/MWh)': eac_per_mwh}
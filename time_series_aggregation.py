@@ -0,0 +1,215 @@
+'''Representative-day aggregation of the simulated year for fast screening runs.
+
+The days of the year are clustered on their demand and normalized RES shapes (every series divided by its maximum)
+either hierarchically (Ward linkage) or with k-medoids, and every cluster is represented by its medoid, a real day
+of the year. The chronology maps every day of the year to its representative day.
+The dispatch has a state that carries over from day to day, so the representative days are not dispatched once
+from a fixed state. Every representative day is dispatched by the recurrence of the array kernel from
+aggregation_soc_levels battery levels between the minimum discharge level and the capacity (and as many PHS levels
+when PHS is enabled). The year is then chained in its chronological order: every day starts from the levels the
+previous day ended with, and its results and end levels are interpolated between the dispatched levels of its
+representative day. Annual results are the sums of the chained days, so they refer to the year rebuilt from
+representative days. Periods since battery state change are counted within the representative days only, and the
+dispatch runs in float64 whatever dispatch_precision is.'''
+import numpy as np
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import pdist, squareform
+from dispatch_kernel import njit, prepare_dispatch_inputs, dispatch_recurrence
+
+AGGREGATION_METHODS = ('hierarchical', 'k_medoids')
+K_MEDOIDS_MAX_ITERATIONS = 100
+# results of every dispatched day that are chained: the end levels, then the sums and the peaks of the day
+DAY_RESULTS = ['battery_soc', 'phs_soc', 'curtailment', 'RES penetration', 'energy shortage', 'battery throughput energy (MWh)',
+               'max hourly curtailment', 'peak missing energy', 'max periods since battery state change']
+SUMMED_RESULTS = 4
+
+
+def get_medoids(distances, labels, clusters):
+    '''Day of every cluster with the smallest sum of distances to the other days of the cluster'''
+    medoids = np.zeros(clusters, dtype=np.int64)
+    for cluster in range(clusters):
+        members = np.flatnonzero(labels == cluster)
+        medoids[cluster] = members[np.argmin(distances[np.ix_(members, members)].sum(axis=1))]
+    return medoids
+
+
+def cluster_days(features, representative_days, method='hierarchical'):
+    '''Cluster of every day (numbered in the chronological order of their medoids) and the medoid day of every cluster'''
+    if method not in AGGREGATION_METHODS:
+        raise ValueError('aggregation_method must be one of ' + ', '.join(AGGREGATION_METHODS) + ', got ' + str(method))
+    representative_days = min(max(int(representative_days), 1), features.shape[0])
+    distances = squareform(pdist(features))
+    if representative_days == 1:
+        labels = np.zeros(features.shape[0], dtype=np.int64)
+    elif representative_days == features.shape[0]:
+        labels = np.arange(features.shape[0]) # every day is its own cluster, the maxclust cut of the linkage can merge the closest ones
+    else:
+        labels = fcluster(linkage(features, 'ward'), representative_days, 'maxclust')
+    labels = np.unique(labels, return_inverse=True)[1] # identical days may leave fewer clusters than asked for
+    clusters = labels.max() + 1
+    medoids = get_medoids(distances, labels, clusters)
+    if method == 'k_medoids':
+        # alternate assignment and medoid update, starting from the hierarchical medoids
+        for iteration in range(K_MEDOIDS_MAX_ITERATIONS):
+            labels = np.argmin(distances[:, medoids], axis=1)
+            labels[medoids] = np.arange(clusters) # keeps every cluster when medoids coincide
+            updated_medoids = get_medoids(distances, labels, clusters)
+            if np.array_equal(updated_medoids, medoids):
+                break
+            medoids = updated_medoids
+    order = np.argsort(medoids)
+    return np.argsort(order)[labels], medoids[order]
+
+
+@njit(cache=True)
+def _grid_position(level, lowest, highest, levels):
+    '''Lower grid index and interpolation weight of level on a uniform grid'''
+    if levels == 1 or highest <= lowest:
+        return 0, 0.0
+    position = min(max((level - lowest)/(highest - lowest)*(levels - 1), 0.0), levels - 1.0)
+    index = min(int(position), levels - 2)
+    return index, position - index
+
+
+@njit(cache=True)
+def dispatch_days(demand, surplus, energy_to_be_stored, missing_energy, base_penetration, storage_capacities, battery_levels, phs_levels,
+                  bess_charging_ratio, bess_discharging_ratio, min_soc_ratio, bess_rte, phs_capacity, phs_pch_max, phs_pdis_max, phs_min_discharge_level,
+                  phs_rte, phs_enabled, hv_to_lv_factor, time_step_hours):
+    '''Dispatches every (combination, representative day) of the (combinations, representative days, steps) inputs for every storage
+    capacity of (combinations, candidates) from every battery and PHS level. Returns the DAY_RESULTS of every (member, representative day,
+    battery level, PHS level), with members in (combination, candidate) order'''
+    combinations, days, steps = demand.shape
+    candidates = storage_capacities.shape[1]
+    battery_grid = battery_levels.shape[2]
+    phs_grid = phs_levels.shape[0]
+    tables = np.zeros((combinations*candidates, days, battery_grid, phs_grid, 9))
+    outputs = np.zeros((14, steps))
+    charge_state = np.zeros(steps, dtype=np.int8)
+    for combination in range(combinations):
+        for candidate in range(candidates):
+            storage_capacity = storage_capacities[combination, candidate]
+            member = combination*candidates + candidate
+            for day in range(days):
+                for i in range(battery_grid):
+                    for j in range(phs_grid):
+                        dispatch_recurrence(demand[combination, day], surplus[combination, day], energy_to_be_stored[combination, day], missing_energy[combination, day], base_penetration[combination, day],
+                                            storage_capacity, storage_capacity*bess_charging_ratio*time_step_hours, storage_capacity*bess_discharging_ratio*time_step_hours, storage_capacity*min_soc_ratio, bess_rte,
+                                            phs_capacity, phs_pch_max*time_step_hours, phs_pdis_max*time_step_hours, phs_min_discharge_level, phs_rte, phs_enabled, hv_to_lv_factor,
+                                            battery_levels[combination, candidate, i], phs_levels[j], 0, 0.0,
+                                            outputs[0], outputs[1], outputs[2], outputs[3], outputs[4], charge_state, outputs[5], outputs[6], outputs[7], outputs[8],
+                                            outputs[9], outputs[10], outputs[11], outputs[12], outputs[13])
+                        table = tables[member, day, i, j]
+                        table[0] = outputs[2, steps - 1]
+                        table[1] = outputs[7, steps - 1]
+                        table[2] = outputs[10].sum()
+                        table[3] = outputs[9].sum()
+                        table[4] = outputs[11].sum()
+                        table[5] = outputs[4].sum()
+                        table[6] = outputs[10].max()/time_step_hours
+                        table[7] = outputs[11].max()/time_step_hours
+                        table[8] = outputs[13].max()
+    return tables
+
+
+@njit(cache=True)
+def chain_days(chronology, tables, battery_levels, phs_levels):
+    '''Chains the days of the year for every member. tables holds the DAY_RESULTS of every (member, representative day,
+    battery level, PHS level). Returns the sums and the peaks of the year of every member'''
+    members, days, battery_grid, phs_grid, results = tables.shape
+    totals = np.zeros((members, SUMMED_RESULTS))
+    peaks = np.full((members, results - 2 - SUMMED_RESULTS), -np.inf)
+    for member in range(members):
+        soc = battery_levels[member, 0]
+        phs_level = phs_levels[0]
+        for day in range(chronology.shape[0]):
+            table = tables[member, chronology[day]]
+            i, f = _grid_position(soc, battery_levels[member, 0], battery_levels[member, battery_grid - 1], battery_grid)
+            j, g = _grid_position(phs_level, phs_levels[0], phs_levels[phs_grid - 1], phs_grid)
+            next_i = min(i + 1, battery_grid - 1)
+            next_j = min(j + 1, phs_grid - 1)
+            values = (1 - f)*(1 - g)*table[i, j] + f*(1 - g)*table[next_i, j] + (1 - f)*g*table[i, next_j] + f*g*table[next_i, next_j]
+            soc = values[0]
+            phs_level = values[1]
+            for result in range(SUMMED_RESULTS):
+                totals[member, result] += values[2 + result]
+            for result in range(peaks.shape[1]):
+                peaks[member, result] = max(peaks[member, result], values[2 + SUMMED_RESULTS + result])
+    return totals, peaks
+
+
+class RepresentativeDays:
+
+    def __init__(self, demand, shapes, steps_per_day, representative_days=12, method='hierarchical', soc_levels=5):
+        series = [np.asarray(demand, dtype=float)] + [np.asarray(shapes[technology], dtype=float) for technology in sorted(shapes)]
+        frames = series[0].shape[0]
+        if frames % steps_per_day != 0:
+            raise ValueError('The simulated year (' + str(frames) + ' steps) does not split into days of ' + str(steps_per_day) + ' steps')
+        self.steps_per_day = steps_per_day
+        self.days = frames//steps_per_day
+        features = []
+        for values in series:
+            peak = np.abs(values).max()
+            features.append((values/peak if peak > 0 else values).reshape(self.days, steps_per_day))
+        self.method = method
+        self.chronology, self.medoids = cluster_days(np.hstack(features), representative_days, method)
+        self.weights = np.bincount(self.chronology, minlength=self.medoids.shape[0])
+        self.steps = self.medoids[:, None]*steps_per_day + np.arange(steps_per_day) # steps of every representative day
+        self.soc_levels = max(int(soc_levels), 2)
+        return
+
+    def reduce(self, values):
+        '''(..., frames) series as (..., representative days, steps per day)'''
+        return np.asarray(values)[..., self.steps]
+
+    def rebuild(self, values):
+        '''(..., frames) series of the year rebuilt from representative days'''
+        return np.asarray(values)[..., self.steps[self.chronology].reshape(-1)]
+
+    def get_totals(self, values):
+        '''Annual sums of (..., frames) series over the year rebuilt from representative days'''
+        return (self.reduce(values).sum(axis=-1)*self.weights).sum(axis=-1)
+
+    def get_profile_error(self, values):
+        '''Root mean square difference between a series and its rebuilt year, in % of the mean of the series'''
+        values = np.asarray(values, dtype=float)
+        return np.sqrt(np.mean((self.rebuild(values) - values)**2))/np.abs(values).mean()*100
+
+    def get_phs_levels(self, parameters):
+        if parameters['phs_enabled'] and parameters['phs_capacity'] > parameters['phs_min_discharge_level']:
+            return np.linspace(parameters['phs_min_discharge_level'], parameters['phs_capacity'], self.soc_levels)
+        return np.array([parameters['phs_min_discharge_level']], dtype=float)
+
+    def get_dispatched_days(self, parameters):
+        '''Days dispatched for every member of simulate_dispatch'''
+        return self.medoids.shape[0]*self.soc_levels*self.get_phs_levels(parameters).shape[0]
+
+    def simulate_dispatch(self, res_generation, demand, hydro_generation, net_billing_cap, storage_capacities, parameters):
+        '''Dispatch of the rebuilt year, with the arguments and the summaries of simulate_batched_dispatch'''
+        res_generation = np.atleast_2d(np.asarray(res_generation, dtype=np.float64))
+        combinations, frames = res_generation.shape
+        demand = np.broadcast_to(np.asarray(demand, dtype=np.float64), (combinations, frames))
+        hydro_generation = np.broadcast_to(np.asarray(hydro_generation, dtype=np.float64), (combinations, frames))
+        net_billing_cap = np.asarray(net_billing_cap, dtype=np.float64).reshape(combinations)
+        storage_capacities = np.asarray(storage_capacities, dtype=np.float64)
+        if storage_capacities.ndim == 1:
+            storage_capacities = np.broadcast_to(storage_capacities, (combinations, storage_capacities.shape[0]))
+        candidates = storage_capacities.shape[1]
+
+        # storage-independent quantities of the representative days, (combinations, representative days, steps)
+        demand, surplus, energy_to_be_stored, missing_energy, base_penetration = prepare_dispatch_inputs(
+            self.reduce(res_generation), self.reduce(demand), self.reduce(hydro_generation), net_billing_cap[:, None, None]*parameters['time_step_hours'], parameters['hv_to_lv_factor'])
+        base_penetration = np.ascontiguousarray(np.broadcast_to(base_penetration, demand.shape))
+        min_soc_ratio = (100 - parameters['bess_depth_of_discharge'])/100
+        battery_levels = np.ascontiguousarray(storage_capacities[..., None]*(min_soc_ratio + (1 - min_soc_ratio)*np.linspace(0, 1, self.soc_levels))) # (combinations, candidates, levels)
+        phs_levels = self.get_phs_levels(parameters)
+        tables = dispatch_days(demand, surplus, energy_to_be_stored, missing_energy, base_penetration, np.ascontiguousarray(storage_capacities), battery_levels, phs_levels,
+                               parameters['bess_charging_rate']/100, 1/parameters['bess_duration'], min_soc_ratio, parameters['bess_rte'], parameters['phs_capacity'],
+                               parameters['phs_pch_max'], parameters['phs_pdis_max'], parameters['phs_min_discharge_level'], parameters['phs_rte'], parameters['phs_enabled'],
+                               parameters['hv_to_lv_factor'], parameters['time_step_hours'])
+        totals, peaks = chain_days(self.chronology, tables, battery_levels.reshape(combinations*candidates, self.soc_levels), phs_levels)
+
+        summaries = {result: totals[:, i] for i, result in enumerate(DAY_RESULTS[2:2 + SUMMED_RESULTS])}
+        summaries.update({result: peaks[:, i] for i, result in enumerate(DAY_RESULTS[2 + SUMMED_RESULTS:])})
+        summaries['storage capacity'] = storage_capacities.reshape(-1)
+        summaries['bess_pdis_max'] = storage_capacities.reshape(-1)/parameters['bess_duration']
+        return {key: value.reshape(combinations, candidates) for key, value in summaries.items()}
@@ -0,0 +1,144 @@
+'''Columnar output of the hourly storage simulation traces.
+
+trace_level in simulation_customization.xlsx selects what is kept of the simulations_df of every res combination:
+ - none: nothing (the default)
+ - summary: daily means of every simulation column
+ - full: every simulated hour
+Traces of a year are buffered and appended in chunks of trace_chunk_size combinations to one compressed
+.npz archive per year and stage (e.g. "simulations - sizing - 2030.npz"). Every chunk holds a
+(combinations x frames x columns) float array and the res combinations it contains; load_traces reads an archive
+back into a DataFrame indexed by (res combination, time). trace_excel_export (on by default) additionally writes the
+"simulations - res combination N.xlsx" files of the original model.
+When a run resumes from a checkpoint the archive of the year is kept and new chunks are appended to it. Traces that
+were still buffered when the previous run stopped are missing from it.'''
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+from dispatch_kernel import CHARGING, DISCHARGING, CHARGE_STATE_LABELS
+
+TRACE_LEVELS = ('none', 'summary', 'full')
+
+
+class TraceWriter:
+
+    def __init__(self, output_path, level='summary', export_excel=False, chunk_size=64):
+        if level not in TRACE_LEVELS:
+            raise ValueError('trace_level must be one of ' + ', '.join(TRACE_LEVELS) + ', got ' + str(level))
+        self.output_path = output_path
+        self.level = level
+        self.export_excel = export_excel
+        self.chunk_size = max(int(chunk_size), 1)
+        self.file_path = None
+        self.pending = [] # (res combination, trace DataFrame) not yet written
+        self.written_chunks = 0
+        self.archived_combinations = set() # res combinations already in the archive of a resumed run
+        return
+
+    def open(self, year, stage, resume=False):
+        '''Starts the archive of one year and stage. An archive left by a previous run is replaced, or appended to when resume is set'''
+        self.pending = []
+        self.written_chunks = 0
+        self.archived_combinations = set()
+        self.file_path = None
+        if self.level == 'none':
+            return
+        self.file_path = self.output_path + 'simulations - ' + stage + ' - ' + str(year) + '.npz'
+        if os.path.exists(self.file_path) and not (resume and self.read_archived_combinations()):
+            os.remove(self.file_path)
+        return
+
+    def read_archived_combinations(self):
+        '''Finds the chunks and res combinations of an existing archive. Returns False when it cannot be read'''
+        try:
+            with zipfile.ZipFile(self.file_path) as archive:
+                chunk_names = [name for name in archive.namelist() if name.startswith('combinations_')]
+                for chunk_name in chunk_names:
+                    with archive.open(chunk_name) as file:
+                        self.archived_combinations.update(np.lib.format.read_array(file, allow_pickle=False).tolist())
+        except (OSError, zipfile.BadZipFile, ValueError):
+            self.archived_combinations = set()
+            return False
+        self.written_chunks = len(chunk_names)
+        return True
+
+    def get_trace(self, simulations_df):
+        '''Numeric copy of simulations_df (charge state labels become the CHARGING/DISCHARGING codes of dispatch_kernel), averaged per day at summary level'''
+        trace = simulations_df.copy()
+        codes = {CHARGE_STATE_LABELS[CHARGING]: CHARGING, CHARGE_STATE_LABELS[DISCHARGING]: DISCHARGING, CHARGE_STATE_LABELS[0]: 0}
+        for column in trace.columns[trace.dtypes == object]:
+            trace[column] = pd.to_numeric(trace[column].map(lambda value: codes.get(value, value)), errors='coerce').fillna(0)
+        trace = trace.astype(float)
+        if self.level == 'summary':
+            return trace.groupby(pd.DatetimeIndex(trace.index).normalize()).mean()
+        return trace
+
+    def is_recording(self):
+        return self.level != 'none' or self.export_excel
+
+    def record(self, res_combination, simulations_df):
+        if self.export_excel:
+            simulations_df.to_excel(self.output_path + 'simulations - res combination ' + str(res_combination) + '.xlsx')
+        if self.level == 'none' or res_combination in self.archived_combinations:
+            return
+        self.pending.append((res_combination, self.get_trace(simulations_df)))
+        if self.file_path is not None and len(self.pending) >= self.chunk_size:
+            self.flush()
+        return
+
+    def take_pending(self):
+        '''Hands over the buffered traces, used by process pool workers that have no archive of their own'''
+        pending, self.pending = self.pending, []
+        return pending
+
+    def extend(self, pending):
+        for res_combination, trace in pending:
+            if res_combination in self.archived_combinations:
+                continue
+            self.pending.append((res_combination, trace))
+            if self.file_path is not None and len(self.pending) >= self.chunk_size:
+                self.flush()
+        return
+
+    def flush(self):
+        if self.file_path is None or len(self.pending) == 0:
+            return
+        first_trace = self.pending[0][1]
+        with zipfile.ZipFile(self.file_path, 'a', compression=zipfile.ZIP_DEFLATED) as archive:
+            if self.written_chunks == 0:
+                self.write_array(archive, 'index', pd.DatetimeIndex(first_trace.index).to_numpy(dtype='datetime64[ns]').astype(np.int64))
+                self.write_array(archive, 'columns', np.array([str(column) for column in first_trace.columns]))
+            chunk_name = '_' + str(self.written_chunks).zfill(5)
+            self.write_array(archive, 'combinations' + chunk_name, np.array([res_combination for res_combination, trace in self.pending]))
+            self.write_array(archive, 'traces' + chunk_name, np.stack([trace.to_numpy() for res_combination, trace in self.pending]))
+        self.written_chunks += 1
+        self.pending = []
+        return
+
+    def write_array(self, archive, name, array):
+        with archive.open(name + '.npy', 'w', force_zip64=True) as file:
+            np.lib.format.write_array(file, np.ascontiguousarray(array), allow_pickle=False)
+        return
+
+    def close(self):
+        self.flush()
+        self.file_path = None
+        return
+
+
+def load_traces(file_path, res_combinations=None):
+    '''Reads a trace archive into a DataFrame indexed by (res combination, time), optionally only for some res combinations'''
+    traces = []
+    with np.load(file_path, allow_pickle=False) as archive:
+        index = pd.DatetimeIndex(archive['index'].astype('datetime64[ns]'))
+        columns = archive['columns'].tolist()
+        chunk_names = sorted(name[len('traces'):] for name in archive.files if name.startswith('traces_'))
+        for chunk_name in chunk_names:
+            combinations = archive['combinations' + chunk_name]
+            chunk = archive['traces' + chunk_name]
+            for position, res_combination in enumerate(combinations):
+                if res_combinations is None or res_combination in res_combinations:
+                    traces.append(pd.DataFrame(chunk[position], index=pd.MultiIndex.from_product([[res_combination], index], names=['res combination', 'time']), columns=columns))
+    if len(traces) == 0:
+        return pd.DataFrame(None, columns=columns)
+    return pd.concat(traces)